@@ -18,6 +18,14 @@
 /* This version modified by Robin Becker */
 
 #include <Python.h>
+#include <stdlib.h>
+#include <string.h>
+#include <ctype.h>
+#ifdef _WIN32
+#	include <windows.h>
+#else
+#	include <time.h>
+#endif
 #include "rlbidi_version.h"
 #define __STR(x) #x
 #define STRINGIFY(x) __STR(x)
@@ -29,152 +37,2676 @@
 #endif
 #include <fribidi.h>
 #ifdef Py_LIMITED_API
-#	define RLPYUNICODE_GETLENGTH(u) PyUnicode_GetLength(u)
-#else
-#	define RLPYUNICODE_GETLENGTH(u) PyUnicode_GET_LENGTH(u)
+#	define RLPYUNICODE_GETLENGTH(u) PyUnicode_GetLength(u)
+#else
+#	define RLPYUNICODE_GETLENGTH(u) PyUnicode_GET_LENGTH(u)
+#endif
+#if !defined(Py_LIMITED_API) || Py_LIMITED_API+0 >= 0x030B0000
+#	define RLBIDI_HAVE_BUFFER 1	/* the buffer protocol is usable */
+#endif
+
+static PyObject *DeletePyList(PyObject *L){
+	if(L){
+		PyList_SetSlice(L, 0, PY_SSIZE_T_MAX, NULL);
+		Py_DecRef(L);
+	}
+	return NULL;
+}
+
+static int _checkBaseDirection(FriBidiParType base){
+	if(!(base == (FriBidiParType)FRIBIDI_TYPE_RTL
+	  || base == (FriBidiParType)FRIBIDI_TYPE_LTR
+	  || base == (FriBidiParType)FRIBIDI_TYPE_ON
+	  || base == (FriBidiParType)FRIBIDI_TYPE_WRTL
+	  || base == (FriBidiParType)FRIBIDI_TYPE_WLTR
+	  )){
+		PyErr_Format(PyExc_ValueError, "invalid value %d: use either RTL, LTR or ON", base);
+		return 0;
+		}
+	return 1;
+	}
+
+/* PyArg_Parse O& converter for a base direction given either as one of
+   the integer constants or by name eg "RTL"; the name is case insensitive.
+*/
+static int _baseDirectionConverter(PyObject *obj, void *addr){
+	static const struct {const char *name; FriBidiParType base;} names[] = {
+		{"LTR", FRIBIDI_PAR_LTR}, {"ON", FRIBIDI_PAR_ON}, {"RTL", FRIBIDI_PAR_RTL},
+		{"WLTR", FRIBIDI_PAR_WLTR}, {"WRTL", FRIBIDI_PAR_WRTL}, {NULL, 0}};
+	FriBidiParType	base;
+	int				i;
+	if(PyUnicode_Check(obj)){
+		PyObject *upper = PyObject_CallMethod(obj, "upper", NULL);
+		if(!upper) return 0;
+		for(i=0; names[i].name && PyUnicode_CompareWithASCIIString(upper, names[i].name); i++);
+		Py_DecRef(upper);
+		if(!names[i].name){
+			PyErr_Format(PyExc_ValueError, "argument base_direction=%U is invalid; should be one of (LTR, ON, RTL, WLTR, WRTL)", obj);
+			return 0;
+			}
+		base = names[i].base;
+		}
+	else{
+		long v = PyLong_AsLong(obj);
+		if(v==-1 && PyErr_Occurred()) return 0;
+		base = (FriBidiParType)v;
+		}
+	if(!_checkBaseDirection(base)) return 0;
+	*(FriBidiParType*)addr = base;
+	return 1;
+	}
+
+/* the characters of unicode object u as fribidi characters; FriBidiChar
+   and Py_UCS4 are both 32 bit so a 4 byte kind str is used in place and
+   anything else is copied into buf which must hold length characters.
+   Returns NULL with an exception set on failure.
+*/
+static const FriBidiChar *_readUnicode(PyObject *u, Py_ssize_t length, FriBidiChar *buf){
+#ifdef Py_LIMITED_API
+	if(length && !PyUnicode_AsUCS4(u, (Py_UCS4*)buf, length, 0)) return NULL;
+#else
+	Py_ssize_t	i;
+	const void	*data;
+	if(PyUnicode_READY(u)) return NULL;
+	data = PyUnicode_DATA(u);
+	switch(PyUnicode_KIND(u)){
+		case PyUnicode_1BYTE_KIND:
+			for(i=0; i<length; ++i) buf[i] = ((const Py_UCS1*)data)[i];
+			break;
+		case PyUnicode_2BYTE_KIND:
+			for(i=0; i<length; ++i) buf[i] = ((const Py_UCS2*)data)[i];
+			break;
+		default:
+			return (const FriBidiChar*)data;
+		}
+#endif
+	return buf;
+	}
+
+/* a str of the visual characters; both ways give the narrowest kind
+   which holds them so hebrew text comes back as a 2 byte kind str */
+static PyObject *_makeUnicode(const FriBidiChar *visual, Py_ssize_t length){
+#ifdef Py_LIMITED_API
+	return PyUnicode_DecodeUTF32((const char *)visual, length*4, "strict", NULL);
+#else
+	return PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND,(const void*)visual, length);
+#endif
+	}
+
+/* new list of python ints from n entries of an index or level array */
+static PyObject *_makeIndexList(const FriBidiStrIndex *a, Py_ssize_t n){
+	PyObject	*L, *obj;
+	Py_ssize_t	i;
+	if(!(L = PyList_New(n))) return NULL;
+	for(i=0;i<n;i++){
+		if(!(obj = PyLong_FromLong((long)a[i]))){
+			Py_DecRef(L);
+			return NULL;
+			}
+		PyList_SetItem(L,i,obj);
+		}
+	return L;
+	}
+static PyObject *_makeLevelList(const FriBidiLevel *a, Py_ssize_t n){
+	PyObject	*L, *obj;
+	Py_ssize_t	i;
+	if(!(L = PyList_New(n))) return NULL;
+	for(i=0;i<n;i++){
+		if(!(obj = PyLong_FromLong((long)a[i]))){
+			Py_DecRef(L);
+			return NULL;
+			}
+		PyList_SetItem(L,i,obj);
+		}
+	return L;
+	}
+
+/* strings at least this long are reordered with the GIL released */
+#ifndef RLBIDI_NOGIL_MINSIZE
+#	define RLBIDI_NOGIL_MINSIZE 256
+#endif
+
+/* the flags fribidi_log2vis uses by default */
+#define RLBIDI_FLAGS (FRIBIDI_FLAGS_DEFAULT | FRIBIDI_FLAGS_ARABIC)
+
+/* the flags chosen by the shape argument */
+#define RLBIDI_SHAPE_ARABIC (FRIBIDI_FLAG_SHAPE_ARAB_PRES | FRIBIDI_FLAG_SHAPE_ARAB_LIGA | FRIBIDI_FLAG_SHAPE_ARAB_CONSOLE)
+#define RLBIDI_SHAPE_MASK (FRIBIDI_FLAG_SHAPE_MIRRORING | RLBIDI_SHAPE_ARABIC)
+
+/* the fribidi flags for the shaping bits and reordernsm */
+#define RLBIDI_FLAGS_FOR(shape, reordernsm) ((RLBIDI_FLAGS & ~(RLBIDI_SHAPE_MASK | FRIBIDI_FLAG_REORDER_NSM)) \
+				| (shape) | ((reordernsm) ? FRIBIDI_FLAG_REORDER_NSM : 0))
+
+/* PyArg_Parse O& converter for the shape argument; True means mirroring
+   and arabic presentation forms with ligatures, False means no shaping at
+   all and an int is an or of the SHAPE_ constants.
+*/
+static int _shapeConverter(PyObject *obj, void *addr){
+	long	v;
+	if(PyBool_Check(obj)) v = obj==Py_True ? (long)(RLBIDI_FLAGS & RLBIDI_SHAPE_MASK) : 0L;
+	else{
+		v = PyLong_AsLong(obj);
+		if(v==-1 && PyErr_Occurred()) return 0;
+		if(v & ~(long)RLBIDI_SHAPE_MASK){
+			PyErr_Format(PyExc_ValueError, "argument shape=%ld is invalid; should be True, False or an or of the SHAPE_ constants", v);
+			return 0;
+			}
+		}
+	*(FriBidiFlags*)addr = (FriBidiFlags)v;
+	return 1;
+	}
+
+/* Runs of visually consecutive characters of one level whose logical
+   positions are consecutive as well; each run is 4 indices: its logical
+   start and end, its level and its visual start.
+*/
+typedef struct {
+	FriBidiStrIndex	*a;		/* malloc'ed so it can grow without the GIL */
+	Py_ssize_t		n;		/* number of runs or -1 when out of memory */
+	Py_ssize_t		size;
+	} rlbidiRuns;
+
+/* Working storage for reordering; all the arrays live in one block which
+   only ever grows so it can be reused for many strings. The block comes
+   from the caller's stack buffer when that is big enough and otherwise
+   from the arena.
+*/
+typedef struct {
+	Py_ssize_t			size;		/* capacity in characters */
+	void				*block;		/* the heap block or NULL */
+	FriBidiChar			*stack;		/* a buffer of RLBIDI_STACK_CHARS characters or NULL */
+	const FriBidiChar	*input;		/* logical or the str's own characters */
+	FriBidiChar			*logical;
+	FriBidiChar			*visual;
+	FriBidiStrIndex		*L_to_V;
+	FriBidiStrIndex		*V_to_L;
+	FriBidiCharType		*types;
+	FriBidiBracketType	*brackets;
+	FriBidiLevel		*levels;
+	FriBidiArabicProp	*ar_props;
+	rlbidiRuns			*runs;		/* level runs are wanted */
+	int					timing;		/* the call is being timed */
+	unsigned long long	t0, t;		/* start of the call and of the current phase */
+	unsigned long long	ns[4];		/* per phase nanoseconds of the call */
+	Py_ssize_t			chars;		/* characters reordered by the call */
+	} rlbidiScratch;
+
+#define RLBIDI_SCRATCH_PERCHAR (2*sizeof(FriBidiChar) + 2*sizeof(FriBidiStrIndex) + sizeof(FriBidiCharType) \
+								+ sizeof(FriBidiBracketType) + sizeof(FriBidiLevel) + sizeof(FriBidiArabicProp))
+
+/* strings shorter than this use a scratch on the C stack */
+#ifndef RLBIDI_STACK_CHARS
+#	define RLBIDI_STACK_CHARS 128
+#endif
+/* declare scratch s with a stack buffer */
+#define RLBIDI_SCRATCH(s) \
+	FriBidiChar s##Stack[(RLBIDI_STACK_CHARS*RLBIDI_SCRATCH_PERCHAR + sizeof(FriBidiChar) - 1)/sizeof(FriBidiChar)]; \
+	rlbidiScratch s = {0}; \
+	s.stack = s##Stack
+
+/* Optional instrumentation, off by default. The counters are only changed
+   with the GIL held; the phases of a call are timed into its scratch.
+*/
+#define RLBIDI_PH_INPUT 0	/* decoding or copying the input */
+#define RLBIDI_PH_REORDER 1	/* the algorithm; fribidi_log2vis */
+#define RLBIDI_PH_CLEAN 2	/* fribidi_remove_bidi_marks */
+#define RLBIDI_PH_OUTPUT 3	/* building the result and the positions/levels outputs */
+#define RLBIDI_NPHASES 4
+static const char *_phaseNames[RLBIDI_NPHASES] = {"input_ns", "reorder_ns", "clean_ns", "output_ns"};
+static struct {
+	int					enabled;
+	unsigned long long	calls, strings, chars, fast, bytes_allocated, max_length;
+	unsigned long long	ns[RLBIDI_NPHASES];
+	PyObject			*slow_callback;
+	unsigned long long	slow_ns;
+	} _stats;
+
+static unsigned long long _nowNS(void){
+#ifdef _WIN32
+	static LARGE_INTEGER	freq;
+	LARGE_INTEGER			c;
+	if(!freq.QuadPart) QueryPerformanceFrequency(&freq);
+	QueryPerformanceCounter(&c);
+	return (unsigned long long)(c.QuadPart/freq.QuadPart)*1000000000ULL
+			+ (unsigned long long)(c.QuadPart%freq.QuadPart)*1000000000ULL/(unsigned long long)freq.QuadPart;
+#else
+	struct timespec	ts;
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	return (unsigned long long)ts.tv_sec*1000000000ULL + (unsigned long long)ts.tv_nsec;
+#endif
+	}
+
+/* start timing a call if the statistics are enabled */
+static void _statsStart(rlbidiScratch *s){
+	if((s->timing = _stats.enabled)) s->t0 = s->t = _nowNS();
+	}
+
+/* add the time since the last phase ended to phase ph; needs no GIL */
+static void _statsPhase(rlbidiScratch *s, int ph){
+	unsigned long long	t;
+	if(!s->timing) return;
+	t = _nowNS();
+	s->ns[ph] += t - s->t;
+	s->t = t;
+	}
+
+/* count one string of length characters, fast if fribidi was not needed */
+static void _statsString(rlbidiScratch *s, Py_ssize_t length, int fast){
+	if(!s->timing) return;
+	s->chars += length;
+	_stats.strings++;
+	if(fast) _stats.fast++;
+	if((unsigned long long)length > _stats.max_length) _stats.max_length = (unsigned long long)length;
+	}
+
+/* add a successful call to the statistics and pass it to the slow call
+   callback if it took long enough; errors from the callback are reported
+   as unraisable rather than failing the call.
+*/
+static void _statsEnd(rlbidiScratch *s, const char *name){
+	unsigned long long	ns;
+	int					i;
+	PyObject			*cb, *r;
+	if(!s->timing) return;
+	ns = _nowNS() - s->t0;
+	s->timing = 0;
+	_stats.calls++;
+	_stats.chars += (unsigned long long)s->chars;
+	for(i=0; i<RLBIDI_NPHASES; i++) _stats.ns[i] += s->ns[i];
+	if(!(cb = _stats.slow_callback) || ns < _stats.slow_ns) return;
+	Py_IncRef(cb);
+	if((r = PyObject_CallFunction(cb, "snd", name, s->chars, (double)ns/1e9))) Py_DecRef(r);
+	else PyErr_WriteUnraisable(cb);
+	Py_DecRef(cb);
+	}
+
+/* The arena keeps the heap blocks of finished calls for later ones so
+   that a steady stream of calls does no allocation. It holds at most
+   RLBIDI_ARENA_SLOTS blocks, keeping the biggest. The longest request of
+   each RLBIDI_SHRINK_CALLS is its high water mark; a block of more than
+   RLBIDI_SHRINK_MIN characters and over 4 times the high water mark is
+   freed rather than kept. The arena is only used with the GIL held; the
+   module has global state so every interpreter shares the GIL and arena.
+*/
+#ifndef RLBIDI_ARENA_SLOTS
+#	define RLBIDI_ARENA_SLOTS 4
+#endif
+#ifndef RLBIDI_SHRINK_CALLS
+#	define RLBIDI_SHRINK_CALLS 256
+#endif
+#ifndef RLBIDI_SHRINK_MIN
+#	define RLBIDI_SHRINK_MIN 4096
+#endif
+static struct {
+	int					enabled;
+	int					n;
+	void				*blocks[RLBIDI_ARENA_SLOTS];
+	Py_ssize_t			sizes[RLBIDI_ARENA_SLOTS];
+	int					window;		/* requests since the high water mark was set */
+	Py_ssize_t			longest;	/* the longest of them */
+	Py_ssize_t			high_water;
+	unsigned long long	requests, stack, reuses, allocations, releases;
+	} _arena = {1};
+
+static int _arenaTooBig(Py_ssize_t size){
+	Py_ssize_t hw = _arena.high_water > _arena.longest ? _arena.high_water : _arena.longest;
+	return size > RLBIDI_SHRINK_MIN && size > 4*hw;
+	}
+
+/* free the kept blocks which the high water mark says are too big, or all */
+static void _arenaTrim(int all){
+	int	i, j;
+	for(i=j=0; i<_arena.n; i++){
+		if(all || _arenaTooBig(_arena.sizes[i])){
+			PyMem_Free(_arena.blocks[i]);
+			_arena.releases++;
+			}
+		else{
+			_arena.blocks[j] = _arena.blocks[i];
+			_arena.sizes[j++] = _arena.sizes[i];
+			}
+		}
+	_arena.n = j;
+	}
+
+/* note a request for length characters */
+static void _arenaRequest(Py_ssize_t length){
+	_arena.requests++;
+	if(length > _arena.longest) _arena.longest = length;
+	if(++_arena.window >= RLBIDI_SHRINK_CALLS){
+		_arena.high_water = _arena.longest;
+		_arena.longest = 0;
+		_arena.window = 0;
+		_arenaTrim(0);
+		}
+	}
+
+/* take the smallest kept block of at least *psize characters setting
+   *psize to its size; NULL if there is none */
+static void *_arenaTake(Py_ssize_t *psize){
+	int		i, best = -1;
+	void	*block;
+	for(i=0; i<_arena.n; i++){
+		if(_arena.sizes[i] >= *psize && (best<0 || _arena.sizes[i] < _arena.sizes[best])) best = i;
+		}
+	if(best<0) return NULL;
+	block = _arena.blocks[best];
+	*psize = _arena.sizes[best];
+	_arena.n--;
+	_arena.blocks[best] = _arena.blocks[_arena.n];
+	_arena.sizes[best] = _arena.sizes[_arena.n];
+	_arena.reuses++;
+	return block;
+	}
+
+/* keep a block of size characters or free it */
+static void _arenaGive(void *block, Py_ssize_t size){
+	int	i, smallest = 0;
+	if(_arena.enabled && !_arenaTooBig(size)){
+		if(_arena.n < RLBIDI_ARENA_SLOTS){
+			_arena.blocks[_arena.n] = block;
+			_arena.sizes[_arena.n++] = size;
+			return;
+			}
+		for(i=1; i<_arena.n; i++){
+			if(_arena.sizes[i] < _arena.sizes[smallest]) smallest = i;
+			}
+		if(_arena.sizes[smallest] < size){
+			void *b = _arena.blocks[smallest];
+			_arena.blocks[smallest] = block;
+			_arena.sizes[smallest] = size;
+			block = b;
+			}
+		}
+	PyMem_Free(block);
+	if(_arena.enabled) _arena.releases++;
+	}
+
+static int _scratchEnsure(rlbidiScratch *s, Py_ssize_t length){
+	Py_ssize_t	size;
+	char		*p;
+	if(length < s->size) return 1;
+	if(length >= INT_MAX){
+		PyErr_SetString(PyExc_OverflowError, "string is too long to reorder");
+		return 0;
+		}
+	size = length + 1;
+	if(size < 2*s->size) size = 2*s->size;
+	if(size < 64) size = 64;
+	if(size > PY_SSIZE_T_MAX/(Py_ssize_t)RLBIDI_SCRATCH_PERCHAR){
+		PyErr_NoMemory();
+		return 0;
+		}
+	if(s->block){
+		_arenaGive(s->block, s->size);
+		s->block = NULL;
+		}
+	s->size = 0;
+	if(_arena.enabled){
+		_arenaRequest(length);
+		if(s->stack && size <= RLBIDI_STACK_CHARS){
+			size = RLBIDI_STACK_CHARS;
+			p = (char*)s->stack;
+			_arena.stack++;
+			goto layout;
+			}
+		s->block = _arenaTake(&size);
+		}
+	if(!s->block){
+		if(!(s->block = PyMem_Malloc(size*RLBIDI_SCRATCH_PERCHAR))){
+			PyErr_NoMemory();
+			return 0;
+			}
+		_arena.allocations++;
+		if(_stats.enabled) _stats.bytes_allocated += (unsigned long long)(size*RLBIDI_SCRATCH_PERCHAR);
+		}
+	p = (char*)s->block;
+layout:
+	s->size = size;
+	s->logical = (FriBidiChar*)p; p += size*sizeof(FriBidiChar);
+	s->visual = (FriBidiChar*)p; p += size*sizeof(FriBidiChar);
+	s->L_to_V = (FriBidiStrIndex*)p; p += size*sizeof(FriBidiStrIndex);
+	s->V_to_L = (FriBidiStrIndex*)p; p += size*sizeof(FriBidiStrIndex);
+	s->types = (FriBidiCharType*)p; p += size*sizeof(FriBidiCharType);
+	s->brackets = (FriBidiBracketType*)p; p += size*sizeof(FriBidiBracketType);
+	s->levels = (FriBidiLevel*)p; p += size*sizeof(FriBidiLevel);
+	s->ar_props = (FriBidiArabicProp*)p;
+	return 1;
+	}
+/* give up the scratch's block; it may still use its stack buffer */
+static void _scratchFree(rlbidiScratch *s){
+	FriBidiChar	*stack = s->stack;
+	if(s->block) _arenaGive(s->block, s->size);
+	memset(s,0,sizeof(*s));
+	s->stack = stack;
+	}
+
+/* Encodings which are converted in C straight between bytes and the
+   fribidi buffers. Only utf-8 and the single byte charsets fribidi knows
+   are handled; fribidi's own converters neither reject invalid input nor
+   report unencodable characters so the single byte tables are built from
+   the python codecs. Anything the C code can't convert is left to the
+   python codec which then raises the proper error.
+*/
+#define RLBIDI_NOCHAR 0xFFFFFFFFU
+typedef struct {
+	const char	*names;		/* python codec name and other spellings, space separated */
+	int			state;		/* 0 tables not built, 1 built, -1 unusable */
+	Py_UCS4		decode[256];	/* RLBIDI_NOCHAR for undefined bytes */
+	int			nencode;
+	Py_UCS4		encode[256];	/* sorted character<<8|byte */
+	} rlbidiCharset;
+static rlbidiCharset _charsets[] = {
+	{"utf-8 utf8 u8"},
+	{"iso8859-8 iso-8859-8 8859-8 hebrew iso-ir-138"},
+	{"cp1255 windows-1255"},
+	{"iso8859-6 iso-8859-6 8859-6 arabic iso-ir-127"},
+	{"cp1256 windows-1256"},
+	};
+#define RLBIDI_UTF8 (_charsets)
+
+static int _cmpUCS4(const void *a, const void *b){
+	Py_UCS4 x = *(const Py_UCS4*)a, y = *(const Py_UCS4*)b;
+	return x<y ? -1 : x>y;
+	}
+
+/* fill in the tables of a single byte charset from its python codec */
+static void _charsetBuild(rlbidiCharset *cs){
+	char		name[16];
+	size_t		n = strcspn(cs->names, " ");
+	int			b;
+	PyObject	*u;
+	if(n>=sizeof(name)) return;
+	memcpy(name, cs->names, n);
+	name[n] = 0;
+	cs->state = -1;
+	cs->nencode = 0;
+	for(b=0; b<256; b++){
+		char c = (char)b;
+		if(!(u = PyUnicode_Decode(&c, 1, name, "strict"))){
+			if(!PyErr_ExceptionMatches(PyExc_UnicodeDecodeError)){
+				PyErr_Clear();
+				return;
+				}
+			PyErr_Clear();
+			cs->decode[b] = RLBIDI_NOCHAR;
+			continue;
+			}
+		if(RLPYUNICODE_GETLENGTH(u)!=1){
+			Py_DecRef(u);
+			return;
+			}
+		cs->decode[b] = PyUnicode_ReadChar(u, 0);
+		Py_DecRef(u);
+		cs->encode[cs->nencode++] = cs->decode[b]<<8 | (Py_UCS4)b;
+		}
+	qsort(cs->encode, cs->nencode, sizeof(Py_UCS4), _cmpUCS4);
+	for(b=1; b<cs->nencode; b++){
+		/* two bytes for one character would not round trip */
+		if(cs->encode[b]>>8 == cs->encode[b-1]>>8) return;
+		}
+	cs->state = 1;
+	}
+
+/* the native charset for a python encoding name or NULL */
+static rlbidiCharset *_findCharset(const char *encoding){
+	char		name[32];
+	size_t		i, n = strlen(encoding);
+	const char	*p;
+	rlbidiCharset	*cs;
+	if(n>=sizeof(name)) return NULL;
+	for(i=0; i<n; i++) name[i] = encoding[i]=='_' ? '-' : (char)tolower((unsigned char)encoding[i]);
+	name[n] = 0;
+	for(cs=_charsets; cs<_charsets+sizeof(_charsets)/sizeof(_charsets[0]); cs++){
+		for(p=cs->names; (p=strstr(p,name)); p+=n){
+			if((p==cs->names || p[-1]==' ') && (!p[n] || p[n]==' ')) break;
+			}
+		if(!p) continue;
+		if(cs!=RLBIDI_UTF8 && !cs->state) _charsetBuild(cs);
+		return cs->state<0 ? NULL : cs;
+		}
+	return NULL;
+	}
+
+/* decode bytes b into s->logical; returns the number of characters, -1
+   with an exception set or -2 if the python codec must decode them.
+*/
+static Py_ssize_t _readBytes(rlbidiScratch *s, PyObject *b, const rlbidiCharset *cs){
+	const unsigned char	*p = (const unsigned char*)PyBytes_AsString(b);
+	Py_ssize_t			i, k, n = PyBytes_Size(b);
+	FriBidiChar			*buf, c;
+	if(!p || !_scratchEnsure(s, n)) return -1;
+	s->input = buf = s->logical;
+	if(cs!=RLBIDI_UTF8){
+		for(i=0; i<n; i++){
+			if((buf[i] = cs->decode[p[i]])==RLBIDI_NOCHAR) return -2;
+			}
+		return n;
+		}
+	for(i=k=0; i<n; k++){
+		c = p[i++];
+		if(c<0x80){
+			buf[k] = c;
+			continue;
+			}
+		if(c<0xC2 || c>0xF4) return -2;
+		if(c<0xE0){
+			if(i>=n || (p[i]&0xC0)!=0x80) return -2;
+			buf[k] = (c&0x1F)<<6 | (p[i]&0x3F);
+			i += 1;
+			}
+		else if(c<0xF0){
+			if(i+1>=n || (p[i]&0xC0)!=0x80 || (p[i+1]&0xC0)!=0x80) return -2;
+			c = (c&0x0F)<<12 | (p[i]&0x3F)<<6 | (p[i+1]&0x3F);
+			if(c<0x800 || (c>=0xD800 && c<=0xDFFF)) return -2;
+			buf[k] = c;
+			i += 2;
+			}
+		else{
+			if(i+2>=n || (p[i]&0xC0)!=0x80 || (p[i+1]&0xC0)!=0x80 || (p[i+2]&0xC0)!=0x80) return -2;
+			c = (c&0x07)<<18 | (p[i]&0x3F)<<12 | (p[i+1]&0x3F)<<6 | (p[i+2]&0x3F);
+			if(c<0x10000 || c>0x10FFFF) return -2;
+			buf[k] = c;
+			i += 3;
+			}
+		}
+	return k;
+	}
+
+/* encode the visual characters as bytes; returns NULL with no exception
+   set if the python codec must encode them.
+*/
+static PyObject *_makeBytes(const FriBidiChar *visual, Py_ssize_t length, const rlbidiCharset *cs){
+	PyObject		*r;
+	unsigned char	*p;
+	Py_ssize_t		i, n = 0, lo, hi, mid;
+	FriBidiChar		c;
+	if(cs==RLBIDI_UTF8){
+		for(i=0; i<length; i++){
+			c = visual[i];
+			if(c>=0xD800 && (c<=0xDFFF || c>0x10FFFF)) return NULL;
+			n += c<0x80 ? 1 : c<0x800 ? 2 : c<0x10000 ? 3 : 4;
+			}
+		}
+	else n = length;
+	if(!(r = PyBytes_FromStringAndSize(NULL, n))) return NULL;
+	p = (unsigned char*)PyBytes_AsString(r);
+	for(i=0; i<length; i++){
+		c = visual[i];
+		if(cs!=RLBIDI_UTF8){
+			if(c<0x80 && cs->decode[c]==c){
+				*p++ = (unsigned char)c;
+				continue;
+				}
+			/* the last entry not above c<<8|0xFF is for c if c is encodable */
+			lo = 0;
+			hi = cs->nencode;
+			while(lo<hi){
+				mid = (lo+hi)/2;
+				if(cs->encode[mid]>>8 > c) hi = mid;
+				else lo = mid+1;
+				}
+			if(!lo || cs->encode[lo-1]>>8!=c) goto fail;
+			*p++ = (unsigned char)(cs->encode[lo-1]&0xFF);
+			}
+		else if(c<0x80) *p++ = (unsigned char)c;
+		else if(c<0x800){
+			*p++ = (unsigned char)(0xC0 | c>>6);
+			*p++ = (unsigned char)(0x80 | (c&0x3F));
+			}
+		else if(c<0x10000){
+			*p++ = (unsigned char)(0xE0 | c>>12);
+			*p++ = (unsigned char)(0x80 | (c>>6&0x3F));
+			*p++ = (unsigned char)(0x80 | (c&0x3F));
+			}
+		else{
+			*p++ = (unsigned char)(0xF0 | c>>18);
+			*p++ = (unsigned char)(0x80 | (c>>12&0x3F));
+			*p++ = (unsigned char)(0x80 | (c>>6&0x3F));
+			*p++ = (unsigned char)(0x80 | (c&0x3F));
+			}
+		}
+	return r;
+fail:
+	Py_DecRef(r);
+	return NULL;
+	}
+
+/* the result of reordering: a str when there is no encoding, otherwise
+   the visual characters encoded natively or by the python codec */
+static PyObject *_makeResult(const FriBidiChar *visual, Py_ssize_t length, const rlbidiCharset *cs, const char *encoding){
+	PyObject	*r, *v;
+	if(!encoding) return _makeUnicode(visual, length);
+	if(cs && ((r = _makeBytes(visual, length, cs)) || PyErr_Occurred())) return r;
+	if(!(v = _makeUnicode(visual, length))) return NULL;
+	r = PyUnicode_AsEncodedString(v, encoding, "strict");
+	Py_DecRef(v);
+	return r;
+	}
+
+/* The bidi types in a fixed order; bidi_types gives each character the
+   index of its type here and BIDI_TYPE_NAMES lists the names.
+*/
+static const struct {FriBidiCharType type; const char *name;} _bidiTypes[] = {
+	{FRIBIDI_TYPE_LTR, "L"}, {FRIBIDI_TYPE_RTL, "R"}, {FRIBIDI_TYPE_AL, "AL"},
+	{FRIBIDI_TYPE_EN, "EN"}, {FRIBIDI_TYPE_AN, "AN"}, {FRIBIDI_TYPE_ES, "ES"},
+	{FRIBIDI_TYPE_ET, "ET"}, {FRIBIDI_TYPE_CS, "CS"}, {FRIBIDI_TYPE_NSM, "NSM"},
+	{FRIBIDI_TYPE_BN, "BN"}, {FRIBIDI_TYPE_WS, "WS"}, {FRIBIDI_TYPE_BS, "B"},
+	{FRIBIDI_TYPE_SS, "S"}, {FRIBIDI_TYPE_ON, "ON"}, {FRIBIDI_TYPE_LRE, "LRE"},
+	{FRIBIDI_TYPE_RLE, "RLE"}, {FRIBIDI_TYPE_LRO, "LRO"}, {FRIBIDI_TYPE_RLO, "RLO"},
+	{FRIBIDI_TYPE_PDF, "PDF"}, {FRIBIDI_TYPE_LRI, "LRI"}, {FRIBIDI_TYPE_RLI, "RLI"},
+	{FRIBIDI_TYPE_FSI, "FSI"}, {FRIBIDI_TYPE_PDI, "PDI"}, {0, NULL}};
+#define RLBIDI_ON_CODE 13
+
+static unsigned char _bidiTypeCode(FriBidiCharType t){
+	unsigned char i;
+	for(i=0; _bidiTypes[i].name; i++) if(_bidiTypes[i].type==t) return i;
+	return RLBIDI_ON_CODE;
+	}
+
+/* The bidi classes of the latin-1 characters which decide whether such
+   text needs reordering; latin-1 has no RTL, AN, explicit or isolate
+   characters so most of it is visually in logical order already.
+*/
+#define RLBIDI_L1_OTHER 0	/* weak or neutral */
+#define RLBIDI_L1_L 1		/* strong left to right */
+#define RLBIDI_L1_EN 2		/* european number */
+#define RLBIDI_L1_SEP 3		/* segment or paragraph separator */
+#define RLBIDI_L1_BN 4		/* boundary neutral; may be removed by clean */
+static unsigned char _latin1Class[256];
+static unsigned char _latin1Code[256];	/* the bidi type codes of latin-1 */
+static void _initLatin1Class(void){
+	int c;
+	for(c=0; c<256; c++){
+		_latin1Code[c] = _bidiTypeCode(fribidi_get_bidi_type((FriBidiChar)c));
+		if((c>='A' && c<='Z') || (c>='a' && c<='z') || c==0xAA || c==0xB5 || c==0xBA
+			|| (c>=0xC0 && c<=0xFF && c!=0xD7 && c!=0xF7)) _latin1Class[c] = RLBIDI_L1_L;
+		else if((c>='0' && c<='9') || c==0xB2 || c==0xB3 || c==0xB9) _latin1Class[c] = RLBIDI_L1_EN;
+		else if(c==0x09 || c==0x0A || c==0x0B || c==0x0D || (c>=0x1C && c<=0x1F) || c==0x85) _latin1Class[c] = RLBIDI_L1_SEP;
+		else if(c<=0x08 || (c>=0x0E && c<=0x1B) || (c>=0x7F && c<=0x9F) || c==0xAD) _latin1Class[c] = RLBIDI_L1_BN;
+		else _latin1Class[c] = RLBIDI_L1_OTHER;
+		}
+	}
+
+/* Decide whether text is visually in logical order without running fribidi.
+   That holds for latin-1 text without boundary neutrals when the resolved
+   direction is LTR (every level is 0) or, with an RTL paragraph, when the
+   text starts with a strong L, ends with L or EN and has no separators
+   (every character resolves to level 2). The characters are read from
+   logical if given, otherwise from a 1 byte kind u. Returns the common
+   level and sets *pbase to the resolved direction, or returns -1.
+*/
+static int _latin1Level(PyObject *u, const FriBidiChar *logical, Py_ssize_t length, FriBidiParType *pbase){
+	const unsigned char	*data = NULL;
+	Py_ssize_t			i;
+	int					c, sep = 0, hasL = 0;
+	FriBidiParType		base = *pbase;
+	if(!logical){
+#ifdef Py_LIMITED_API
+		return -1;
+#else
+		if(PyUnicode_READY(u) || PyUnicode_KIND(u)!=PyUnicode_1BYTE_KIND){
+			PyErr_Clear();
+			return -1;
+			}
+		data = (const unsigned char *)PyUnicode_DATA(u);
+#endif
+		}
+	for(i=0; i<length; i++){
+		if(logical){
+			if(logical[i]>0xFF) return -1;
+			c = _latin1Class[logical[i]];
+			}
+		else c = _latin1Class[data[i]];
+		if(c==RLBIDI_L1_BN) return -1;
+		if(c==RLBIDI_L1_L) hasL = 1;
+		else if(c==RLBIDI_L1_SEP) sep = 1;
+		}
+	if(base==FRIBIDI_PAR_WRTL) base = hasL ? FRIBIDI_PAR_LTR : FRIBIDI_PAR_RTL;
+	if(base!=FRIBIDI_PAR_RTL){
+		*pbase = FRIBIDI_PAR_LTR;
+		return 0;
+		}
+	if(!length){
+		*pbase = base;
+		return 0;
+		}
+	if(sep) return -1;
+#define RLBIDI_L1_CLASS(i) (logical ? _latin1Class[logical[i]] : _latin1Class[data[i]])
+	if(RLBIDI_L1_CLASS(0)!=RLBIDI_L1_L || (c=RLBIDI_L1_CLASS(length-1), c!=RLBIDI_L1_L && c!=RLBIDI_L1_EN)) return -1;
+#undef RLBIDI_L1_CLASS
+	return 2;
+	}
+
+/* fill in the identity maps and a constant level for any non NULL array */
+static void _identityMaps(FriBidiStrIndex *L_to_V, FriBidiStrIndex *V_to_L, FriBidiLevel *levels, Py_ssize_t length, int level){
+	Py_ssize_t	i;
+	for(i=0; i<length; i++){
+		if(L_to_V) L_to_V[i] = (FriBidiStrIndex)i;
+		if(V_to_L) V_to_L[i] = (FriBidiStrIndex)i;
+		if(levels) levels[i] = (FriBidiLevel)level;
+		}
+	}
+
+/* This is fribidi_log2vis, but the flags are passed in rather than taken
+   from fribidi's global state and all the working arrays come from the
+   scratch so nothing is allocated; it touches no python objects and can
+   run without the GIL. V_to_L and levels are always computed, L_to_V
+   only when wanted. Returns max_level+1 or 0 on failure.
+*/
+static FriBidiLevel _reorder(rlbidiScratch *s, FriBidiStrIndex len, FriBidiParType *pbase, FriBidiFlags flags, int wantL_to_V){
+	FriBidiStrIndex	i;
+	FriBidiLevel	max_level;
+
+	if(!len) return 1;
+	fribidi_get_bidi_types(s->input, len, s->types);
+	fribidi_get_bracket_types(s->input, len, s->types, s->brackets);
+	if(!(max_level = fribidi_get_par_embedding_levels_ex(s->types, s->brackets, len, pbase, s->levels))) return 0;
+	for(i=0; i<len; i++) s->V_to_L[i] = i;
+	if(s->visual!=s->input) memcpy(s->visual, s->input, len*sizeof(FriBidiChar));
+	if(flags & RLBIDI_SHAPE_ARABIC){
+		fribidi_get_joining_types(s->input, len, s->ar_props);
+		fribidi_join_arabic(s->types, len, s->levels, s->ar_props);
+		fribidi_shape(flags, s->levels, len, s->ar_props, s->visual);
+		}
+	else if(flags & FRIBIDI_FLAG_SHAPE_MIRRORING) fribidi_shape(flags, s->levels, len, NULL, s->visual);
+	if(!(max_level = fribidi_reorder_line(flags, s->types, len, 0, *pbase, s->levels, s->visual, s->V_to_L))) return 0;
+	if(wantL_to_V){
+		for(i=0; i<len; i++) s->L_to_V[i] = -1;
+		for(i=0; i<len; i++) s->L_to_V[s->V_to_L[i]] = i;
+		}
+	return max_level;
+	}
+
+/* the characters fribidi_remove_bidi_marks removes */
+#define RLBIDI_IS_MARK(c) ((c)==FRIBIDI_CHAR_LRM || (c)==FRIBIDI_CHAR_RLM \
+		|| FRIBIDI_IS_EXPLICIT_OR_BN(fribidi_get_bidi_type(c)) || FRIBIDI_IS_ISOLATE(fribidi_get_bidi_type(c)))
+
+/* Find the level runs of a reordered but not yet cleaned string; with
+   clean the marks are skipped, the visual starts are those of the cleaned
+   string and a run may span removed marks. Returns 0 when out of memory.
+*/
+static int _levelRuns(rlbidiScratch *s, Py_ssize_t length, int clean){
+	rlbidiRuns		*r = s->runs;
+	FriBidiStrIndex	*run = NULL, l, k, lo, hi, first = 0, last = 0, w = 0;
+	FriBidiLevel	level = 0;
+	Py_ssize_t		v;
+	r->n = 0;
+	for(v=0; v<length; v++){
+		if(clean && RLBIDI_IS_MARK(s->visual[v])) continue;
+		l = s->V_to_L[v];
+		if(run && s->levels[l]==level){
+			/* odd levels run backwards through the logical positions */
+			lo = level&1 ? l : last;
+			hi = level&1 ? last : l;
+			if(lo<hi){
+				for(k=lo+1; k<hi && clean && RLBIDI_IS_MARK(s->input[k]); k++);
+				if(k==hi){
+					last = l;
+					w++;
+					continue;
+					}
+				}
+			}
+		if(run){
+			run[0] = level&1 ? last : first;
+			run[1] = (level&1 ? first : last) + 1;
+			}
+		if(r->n==r->size){
+			Py_ssize_t		size = r->size ? 2*r->size : 16;
+			FriBidiStrIndex	*a = (FriBidiStrIndex*)realloc(r->a, size*4*sizeof(FriBidiStrIndex));
+			if(!a) return 0;
+			r->a = a;
+			r->size = size;
+			}
+		run = r->a + 4*r->n++;
+		run[2] = level = s->levels[l];
+		run[3] = w++;
+		first = last = l;
+		}
+	if(run){
+		run[0] = level&1 ? last : first;
+		run[1] = (level&1 ? first : last) + 1;
+		}
+	return 1;
+	}
+
+/* the reordering and cleaning, which need no GIL; *pr is as for _reorder */
+static Py_ssize_t _reorderClean(rlbidiScratch *s, Py_ssize_t length, FriBidiParType *pbase, FriBidiFlags flags, int clean, int wantL_to_V, FriBidiLevel *pr){
+	*pr = _reorder(s, (FriBidiStrIndex)length, pbase, flags, wantL_to_V);
+	_statsPhase(s, RLBIDI_PH_REORDER);
+	if(*pr && s->runs && !_levelRuns(s, length, clean)) s->runs->n = -1;
+	if(*pr && clean){
+		length = fribidi_remove_bidi_marks(s->visual, (const FriBidiStrIndex)length, wantL_to_V ? s->L_to_V : NULL, s->V_to_L, s->levels);
+		_statsPhase(s, RLBIDI_PH_CLEAN);
+		}
+	return length;
+	}
+
+/* reorder the length characters in s->input, optionally removing the
+   bidi marks; returns the final length or -1 with an exception set.
+*/
+static Py_ssize_t _log2visScratch(rlbidiScratch *s, Py_ssize_t length, FriBidiParType *pbase, FriBidiFlags flags, int clean, int wantL_to_V){
+	FriBidiLevel	r;
+	if(length >= RLBIDI_NOGIL_MINSIZE){
+		Py_BEGIN_ALLOW_THREADS
+		length = _reorderClean(s, length, pbase, flags, clean, wantL_to_V, &r);
+		Py_END_ALLOW_THREADS
+		}
+	else length = _reorderClean(s, length, pbase, flags, clean, wantL_to_V, &r);
+	if(!r){
+		PyErr_SetString(PyExc_RuntimeError, "fribidi failed to order string");
+		return -1;
+		}
+	if(s->runs && s->runs->n<0){
+		PyErr_NoMemory();
+		return -1;
+		}
+	return length;
+	}
+
+/* replace the contents of list L with (logical_start, logical_end, level, visual_start) tuples */
+static int _storeRuns(PyObject *L, const rlbidiRuns *r){
+	PyObject	*R, *t, *v;
+	Py_ssize_t	i;
+	int			j, e;
+	if(!(R = PyList_New(r->n))) return 0;
+	for(i=0; i<r->n; i++){
+		if(!(t = PyTuple_New(4))) goto fail;
+		PyList_SetItem(R, i, t);
+		for(j=0; j<4; j++){
+			if(!(v = PyLong_FromLong((long)r->a[4*i+j]))) goto fail;
+			PyTuple_SetItem(t, j, v);
+			}
+		}
+	e = PyList_SetSlice(L, 0, PY_SSIZE_T_MAX, R);
+	Py_DecRef(R);
+	return !e;
+fail:
+	Py_DecRef(R);
+	return 0;
+	}
+
+/* append n python ints to list L */
+static int _extendIndexList(PyObject *L, const FriBidiStrIndex *a, Py_ssize_t n){
+	PyObject	*obj;
+	Py_ssize_t	i;
+	int			r;
+	for(i=0;i<n;i++){
+		if(!(obj = PyLong_FromLong((long)a[i]))) return 0;
+		r = PyList_Append(L,obj);
+		Py_DecRef(obj);
+		if(r<0) return 0;
+		}
+	return 1;
+	}
+static int _extendLevelList(PyObject *L, const FriBidiLevel *a, Py_ssize_t n){
+	PyObject	*obj;
+	Py_ssize_t	i;
+	int			r;
+	for(i=0;i<n;i++){
+		if(!(obj = PyLong_FromLong((long)a[i]))) return 0;
+		r = PyList_Append(L,obj);
+		Py_DecRef(obj);
+		if(r<0) return 0;
+		}
+	return 1;
+	}
+
+/* An optional positions/levels output argument; either a list which is
+   cleared and then extended or a writable buffer of integers which is
+   filled in. fribidi writes straight into buffers with the right item size.
+*/
+#define RLBIDI_OUT_NONE 1
+#define RLBIDI_OUT_LIST 2
+#define RLBIDI_OUT_BUFFER 3
+typedef struct {
+	const char	*name;
+	PyObject	*obj;
+	int			kind;
+	int			isLevels;	/* FriBidiLevel rather than FriBidiStrIndex items */
+	Py_ssize_t	itemsize;
+	void		*direct;	/* the caller's memory when fribidi can write there */
+#ifdef RLBIDI_HAVE_BUFFER
+	Py_buffer	view;
+#else
+	PyObject	*view;		/* memoryview of obj */
+#endif
+	} rlbidiOutput;
+
+/* check a struct module format is a native integer one */
+static int _intFormat(const char *fmt){
+	static const int one = 1;
+	if(!fmt) return 1;	/* unsigned bytes */
+	if(*fmt=='@' || *fmt=='=' || *fmt==(*(const char*)&one ? '<' : '>')) fmt++;
+	return fmt[0] && !fmt[1] && strchr("bBhHiIlLqQnN",fmt[0]);
+	}
+
+/* initialise o for obj which must have room for length items each able
+   to hold values up to maxValue */
+static int _outputInitEx(rlbidiOutput *o, const char *name, PyObject *obj, Py_ssize_t length, Py_ssize_t maxValue, int isLevels){
+	Py_ssize_t	nitems, maxv;
+	int			isSigned;
+	const char	*fmt;
+#ifndef RLBIDI_HAVE_BUFFER
+	char		fbuf[8] = {0};
+#endif
+	memset(o,0,sizeof(*o));
+	o->name = name;
+	o->isLevels = isLevels;
+	if(!obj || obj==Py_None){
+		o->kind = RLBIDI_OUT_NONE;
+		return 1;
+		}
+	o->obj = obj;
+	if(PyList_Check(obj)){
+		if(PyList_SetSlice(obj, 0, PY_SSIZE_T_MAX, NULL)<0) return 0;
+		o->kind = RLBIDI_OUT_LIST;
+		return 1;
+		}
+#ifdef RLBIDI_HAVE_BUFFER
+	if(!PyObject_CheckBuffer(obj)) goto wrongType;
+	if(PyObject_GetBuffer(obj, &o->view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT | PyBUF_WRITABLE)<0){
+		PyErr_Clear();
+		PyErr_Format(PyExc_TypeError, "Argument %s must be a writable contiguous buffer", name);
+		return 0;
+		}
+	o->kind = RLBIDI_OUT_BUFFER;
+	o->itemsize = o->view.itemsize;
+	nitems = o->view.len/o->itemsize;
+	fmt = o->view.format;
+#else
+	{
+		PyObject	*v, *b;
+		int			ok;
+		if(!(o->view = PyMemoryView_FromObject(obj))){
+			PyErr_Clear();
+			goto wrongType;
+			}
+		o->kind = RLBIDI_OUT_BUFFER;
+		if(!(v = PyObject_GetAttrString(o->view, "readonly"))) return 0;
+		ok = PyObject_Not(v);
+		Py_DecRef(v);
+		if(ok<=0){
+			if(!ok) PyErr_Format(PyExc_TypeError, "Argument %s must be a writable contiguous buffer", name);
+			return 0;
+			}
+		if(!(v = PyObject_GetAttrString(o->view, "c_contiguous"))) return 0;
+		ok = PyObject_IsTrue(v);
+		Py_DecRef(v);
+		if(ok<=0){
+			if(!ok) PyErr_Format(PyExc_TypeError, "Argument %s must be a writable contiguous buffer", name);
+			return 0;
+			}
+		if(!(v = PyObject_GetAttrString(o->view, "itemsize"))) return 0;
+		o->itemsize = PyLong_AsSsize_t(v);
+		Py_DecRef(v);
+		if(!(v = PyObject_GetAttrString(o->view, "nbytes"))) return 0;
+		nitems = PyLong_AsSsize_t(v)/(o->itemsize>0 ? o->itemsize : 1);
+		Py_DecRef(v);
+		if(!(v = PyObject_GetAttrString(o->view, "format"))) return 0;
+		b = PyUnicode_AsUTF8String(v);
+		Py_DecRef(v);
+		if(!b) return 0;
+		fmt = PyBytes_AsString(b);
+		strncpy(fbuf, strlen(fmt)<sizeof(fbuf) ? fmt : "?", sizeof(fbuf)-1);
+		Py_DecRef(b);
+		fmt = fbuf;
+		if(PyErr_Occurred()) return 0;
+	}
+#endif
+	if(!_intFormat(fmt) || (o->itemsize!=1 && o->itemsize!=2 && o->itemsize!=4 && o->itemsize!=8)){
+		PyErr_Format(PyExc_TypeError, "Argument %s must be a buffer of integers", name);
+		return 0;
+		}
+	isSigned = !fmt || islower(fmt[strlen(fmt)-1]);
+	if(nitems < length){
+		PyErr_Format(PyExc_ValueError, "Argument %s is too small: %zd items needed, %zd available", name, length, nitems);
+		return 0;
+		}
+	maxv = o->itemsize>=(Py_ssize_t)sizeof(Py_ssize_t) ? PY_SSIZE_T_MAX : ((Py_ssize_t)1<<(8*o->itemsize-isSigned))-1;
+	if(maxValue > maxv){
+		PyErr_Format(PyExc_OverflowError, "Argument %s items are too small for values up to %zd", name, maxValue);
+		return 0;
+		}
+#ifdef RLBIDI_HAVE_BUFFER
+	if(o->itemsize==(Py_ssize_t)(isLevels ? sizeof(FriBidiLevel) : sizeof(FriBidiStrIndex))) o->direct = o->view.buf;
+#endif
+	return 1;
+wrongType:
+	PyErr_Format(PyExc_TypeError,"Argument %s is of wrong type", name);
+	return 0;
+	}
+static int _outputInit(rlbidiOutput *o, const char *name, PyObject *obj, Py_ssize_t length, int isLevels){
+	return _outputInitEx(o, name, obj, length, isLevels ? 125 : length-1, isLevels);
+	}
+
+/* the array fribidi should fill in for output o */
+#define RLBIDI_OUTPUT_ARRAY(o,scratch_array) ((o).direct ? (void*)(o).direct : (void*)(scratch_array))
+
+/* move n computed items from src to the caller's object from item start
+   on unless fribidi wrote them there already; lists are just extended */
+static int _outputStoreAt(rlbidiOutput *o, const void *src, Py_ssize_t start, Py_ssize_t n){
+	void		*dst;
+	Py_ssize_t	i;
+	int			r = 1;
+	if(o->kind==RLBIDI_OUT_NONE || o->direct) return 1;
+	if(o->kind==RLBIDI_OUT_LIST)
+		return o->isLevels ? _extendLevelList(o->obj, (const FriBidiLevel*)src, n)
+							: _extendIndexList(o->obj, (const FriBidiStrIndex*)src, n);
+#ifdef RLBIDI_HAVE_BUFFER
+	dst = (char*)o->view.buf + start*o->itemsize;
+#else
+	if(!(dst = PyMem_Malloc(n*o->itemsize+1))){
+		PyErr_NoMemory();
+		return 0;
+		}
+#endif
+#define RLBIDI_STORE(T) for(i=0;i<n;i++) ((T*)dst)[i] = (T)(o->isLevels ? ((const FriBidiLevel*)src)[i] : ((const FriBidiStrIndex*)src)[i])
+	switch(o->itemsize){
+		case 1: RLBIDI_STORE(signed char); break;
+		case 2: RLBIDI_STORE(short); break;
+		case 4: RLBIDI_STORE(int32_t); break;
+		default: RLBIDI_STORE(int64_t); break;
+		}
+#undef RLBIDI_STORE
+#ifndef RLBIDI_HAVE_BUFFER
+	{
+		/* memoryview(obj).cast('B')[start:start+nbytes] = bytes */
+		PyObject	*b = PyBytes_FromStringAndSize((const char*)dst, n*o->itemsize);
+		PyObject	*c = b ? PyObject_CallMethod(o->view, "cast", "s", "B") : NULL;
+		r = c && PySequence_SetSlice(c, start*o->itemsize, (start+n)*o->itemsize, b)==0;
+		Py_XDECREF(c);
+		Py_XDECREF(b);
+		PyMem_Free(dst);
+	}
+#endif
+	return r;
+	}
+#define _outputStore(o, src, n) _outputStoreAt(o, src, 0, n)
+
+static void _outputRelease(rlbidiOutput *o){
+#ifdef RLBIDI_HAVE_BUFFER
+	if(o->kind==RLBIDI_OUT_BUFFER) PyBuffer_Release(&o->view);
+#else
+	Py_XDECREF(o->view);	/* releases the export too */
+	o->view = NULL;
+#endif
+	o->kind = RLBIDI_OUT_NONE;
+	}
+
+/* A read only contiguous buffer of integers; without the buffer protocol
+   a bytes copy of it is held instead.
+*/
+typedef struct {
+	const char	*buf;
+	Py_ssize_t	itemsize;
+	Py_ssize_t	nitems;
+	int			isSigned;
+#ifdef RLBIDI_HAVE_BUFFER
+	Py_buffer	view;
+#endif
+	PyObject	*obj;	/* the exporter or the bytes copy; NULL if not initialised */
+	} rlbidiInput;
+
+static int _inputInit(rlbidiInput *in, const char *name, PyObject *obj){
+	const char	*fmt;
+#ifndef RLBIDI_HAVE_BUFFER
+	PyObject	*mv, *v;
+	char		fbuf[8] = {0};
+#endif
+	memset(in,0,sizeof(*in));
+#ifdef RLBIDI_HAVE_BUFFER
+	if(PyObject_GetBuffer(obj, &in->view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT)<0){
+		PyErr_Clear();
+		PyErr_Format(PyExc_TypeError, "Argument %s must be a contiguous buffer", name);
+		return 0;
+		}
+	in->obj = obj;
+	in->buf = (const char*)in->view.buf;
+	in->itemsize = in->view.itemsize;
+	in->nitems = in->view.len/in->itemsize;
+	fmt = in->view.format;
+#else
+	if(!(mv = PyMemoryView_FromObject(obj))){
+		PyErr_Clear();
+		PyErr_Format(PyExc_TypeError, "Argument %s must be a contiguous buffer", name);
+		return 0;
+		}
+	if((v = PyObject_GetAttrString(mv, "c_contiguous"))){
+		int ok = PyObject_IsTrue(v);
+		Py_DecRef(v);
+		if(!ok) PyErr_Format(PyExc_TypeError, "Argument %s must be a contiguous buffer", name);
+		}
+	if(!PyErr_Occurred() && (v = PyObject_GetAttrString(mv, "itemsize"))){
+		in->itemsize = PyLong_AsSsize_t(v);
+		Py_DecRef(v);
+		}
+	if(!PyErr_Occurred() && (v = PyObject_GetAttrString(mv, "format"))){
+		PyObject *b = PyUnicode_AsUTF8String(v);
+		Py_DecRef(v);
+		if(b){
+			fmt = PyBytes_AsString(b);
+			strncpy(fbuf, strlen(fmt)<sizeof(fbuf) ? fmt : "?", sizeof(fbuf)-1);
+			Py_DecRef(b);
+			}
+		}
+	if(!PyErr_Occurred()) in->obj = PyObject_Bytes(mv);
+	Py_DecRef(mv);
+	if(!in->obj) return 0;
+	in->buf = PyBytes_AsString(in->obj);
+	in->nitems = PyBytes_Size(in->obj)/(in->itemsize>0 ? in->itemsize : 1);
+	fmt = fbuf;
+#endif
+	if(!_intFormat(fmt) || (in->itemsize!=1 && in->itemsize!=2 && in->itemsize!=4 && in->itemsize!=8)){
+		PyErr_Format(PyExc_TypeError, "Argument %s must be a buffer of integers", name);
+		return 0;
+		}
+	in->isSigned = !fmt || islower(fmt[strlen(fmt)-1]);
+	return 1;
+	}
+
+/* item i of an input buffer */
+static long long _inputItem(const rlbidiInput *in, Py_ssize_t i){
+	switch(in->itemsize){
+		case 1: return in->isSigned ? (long long)((const signed char*)in->buf)[i] : (long long)((const unsigned char*)in->buf)[i];
+		case 2: return in->isSigned ? (long long)((const short*)in->buf)[i] : (long long)((const unsigned short*)in->buf)[i];
+		case 4: return in->isSigned ? (long long)((const int32_t*)in->buf)[i] : (long long)((const uint32_t*)in->buf)[i];
+		default: return ((const long long*)in->buf)[i];
+		}
+	}
+
+static void _inputRelease(rlbidiInput *in){
+#ifdef RLBIDI_HAVE_BUFFER
+	if(in->obj) PyBuffer_Release(&in->view);
+#else
+	Py_XDECREF(in->obj);
+#endif
+	in->obj = NULL;
+	}
+
+static PyObject * _rlbidi_log2vis(PyObject * self, PyObject * args, PyObject * kw){
+	PyObject *u=NULL;	/* input str or encoded bytes object */
+	FriBidiParType base = FRIBIDI_TYPE_RTL;	/* optional direction */
+	PyObject *positions_L_to_V=NULL, *positions_V_to_L=NULL, *embedding_levels=NULL;
+	int clean = 0; /* optional flag to clean the string */
+	int reordernsm = 1; /* optional flag to allow reordering of non spacing marks*/
+	const char *encoding = "utf-8";	/* of bytes input and its result */
+	FriBidiFlags shape = RLBIDI_FLAGS & RLBIDI_SHAPE_MASK;	/* optional mirroring and arabic shaping */
+	PyObject *runsObj = NULL;	/* optional list for the level runs */
+
+	static char *kwargs[] = { "logical", "base_direction", "clean", "reordernsm", "positions_L_to_V", "positions_V_to_L", "embedding_levels", "encoding", "shape", "runs", NULL };
+
+	if(!PyArg_ParseTupleAndKeywords(args, kw, "O|iiiOOOzO&O", kwargs,
+				&u, &base, &clean, &reordernsm, &positions_L_to_V, &positions_V_to_L, &embedding_levels, &encoding,
+				_shapeConverter, &shape, &runsObj)
+			) return NULL;
+
+	/* Validate base */
+	if(!_checkBaseDirection(base)) return NULL;
+	if(runsObj==Py_None) runsObj = NULL;
+	if(runsObj && !PyList_Check(runsObj)){
+		PyErr_Format(PyExc_TypeError, "Argument runs must be a list not %R", (PyObject*)Py_TYPE(runsObj));
+		return NULL;
+		}
+
+	Py_ssize_t length = 0;
+	RLBIDI_SCRATCH(scratch);
+	rlbidiRuns runs = {NULL, 0, 0};
+	rlbidiOutput L_to_V, V_to_L, levels;
+	FriBidiStrIndex *sL_to_V, *sV_to_L;
+	FriBidiLevel *slevels;
+	int level;
+	PyObject *text = u;	/* the str to read or NULL when bytes were decoded natively */
+	PyObject *decoded = NULL;
+	const rlbidiCharset *cs = NULL;
+
+	PyObject *result = NULL;
+
+	_outputInit(&L_to_V, "positions_L_to_V", NULL, 0, 0);
+	_outputInit(&V_to_L, "positions_V_to_L", NULL, 0, 0);
+	_outputInit(&levels, "embedding_levels", NULL, 0, 1);
+	_statsStart(&scratch);
+	if(PyUnicode_Check(u)) encoding = NULL;
+	else if(!PyBytes_Check(u)){
+		PyErr_Format(PyExc_TypeError, "log2vis argument logical must be str or bytes not %R", (PyObject*)Py_TYPE(u));
+		goto cleanup;
+		}
+	else if(!encoding){
+		PyErr_SetString(PyExc_TypeError, "log2vis needs an encoding for bytes");
+		goto cleanup;
+		}
+	else{
+		/* decode natively if possible else with the python codec */
+		if((cs = _findCharset(encoding))){
+			if((length = _readBytes(&scratch, u, cs))==-1) goto cleanup;
+			if(length>=0) text = NULL;
+			else cs = NULL;
+			}
+		if(text){
+			if(!(text = decoded = PyUnicode_Decode(PyBytes_AsString(u), PyBytes_Size(u), encoding, "strict"))) goto cleanup;
+			}
+		}
+	if(text && (length = RLPYUNICODE_GETLENGTH(text))<0) goto cleanup;
+
+	if(!_outputInit(&L_to_V, "positions_L_to_V", positions_L_to_V, length, 0)
+		|| !_outputInit(&V_to_L, "positions_V_to_L", positions_V_to_L, length, 0)
+		|| !_outputInit(&levels, "embedding_levels", embedding_levels, length, 1)) goto cleanup;
+
+	/* Text which needs no reordering is returned as it is */
+	if(text){
+		level = _latin1Level(text, NULL, length, &base);
+
+		/* Allocate fribidi buffers */
+		if(level<0 || L_to_V.kind!=RLBIDI_OUT_NONE || V_to_L.kind!=RLBIDI_OUT_NONE || levels.kind!=RLBIDI_OUT_NONE){
+			if(!_scratchEnsure(&scratch, length)) goto cleanup;
+			}
+
+		if(level<0){
+			if(!(scratch.input = _readUnicode(text, length, scratch.logical))) goto cleanup;
+#ifdef Py_LIMITED_API
+			level = _latin1Level(text, scratch.input, length, &base);
+#endif
+			}
+		}
+	else level = _latin1Level(NULL, scratch.input, length, &base);
+	_statsPhase(&scratch, RLBIDI_PH_INPUT);
+	_statsString(&scratch, length, level>=0);
+
+	/* let fribidi write directly into suitable caller buffers */
+	sL_to_V = scratch.L_to_V;
+	sV_to_L = scratch.V_to_L;
+	slevels = scratch.levels;
+	scratch.L_to_V = RLBIDI_OUTPUT_ARRAY(L_to_V, sL_to_V);
+	scratch.V_to_L = RLBIDI_OUTPUT_ARRAY(V_to_L, sV_to_L);
+	scratch.levels = RLBIDI_OUTPUT_ARRAY(levels, slevels);
+
+	if(level>=0){
+		_identityMaps(scratch.L_to_V, scratch.V_to_L, scratch.levels, length, level);
+		if(runsObj && length){
+			if(!(runs.a = (FriBidiStrIndex*)malloc(4*sizeof(FriBidiStrIndex)))){
+				PyErr_NoMemory();
+				goto restore;
+				}
+			runs.a[0] = runs.a[3] = 0;
+			runs.a[1] = (FriBidiStrIndex)length;
+			runs.a[2] = (FriBidiStrIndex)level;
+			runs.n = runs.size = 1;
+			}
+		if(decoded) result = PyUnicode_AsEncodedString(decoded, encoding, "strict");
+		else{
+			/* natively decoded bytes round trip exactly */
+			Py_IncRef(u);
+			result = u;
+			}
+		}
+	else{
+		/* Convert to unicode and order visually, cleaning the string if requested */
+		if(runsObj) scratch.runs = &runs;
+		length = _log2visScratch(&scratch, length, &base, RLBIDI_FLAGS_FOR(shape, reordernsm),
+						clean, L_to_V.kind!=RLBIDI_OUT_NONE);
+		if(length>=0) result = _makeResult(scratch.visual, length, cs, encoding);
+		}
+	if(result
+		&& !(_outputStore(&L_to_V, scratch.L_to_V, length)
+			&& _outputStore(&V_to_L, scratch.V_to_L, length)
+			&& _outputStore(&levels, scratch.levels, length)
+			&& (!runsObj || _storeRuns(runsObj, &runs)))){
+		Py_DecRef(result);
+		result = NULL;
+		}
+	_statsPhase(&scratch, RLBIDI_PH_OUTPUT);
+	if(result) _statsEnd(&scratch, "log2vis");
+restore:
+	scratch.L_to_V = sL_to_V;
+	scratch.V_to_L = sV_to_L;
+	scratch.levels = slevels;
+
+cleanup:
+	/* Delete fribidi buffers */
+	_outputRelease(&L_to_V);
+	_outputRelease(&V_to_L);
+	_outputRelease(&levels);
+	_scratchFree(&scratch);
+	free(runs.a);
+	Py_XDECREF(decoded);
+
+	return (PyObject *)result;
+	}
+
+/* reorder one str item, or bytes item when encoding is given, using the
+   scratch buffers; returns a new reference */
+static PyObject *_log2visItem(PyObject *u, const char *encoding, const rlbidiCharset *cs, FriBidiParType base, FriBidiFlags flags, int clean, int maps, rlbidiScratch *s){
+	Py_ssize_t	length = 0;
+	PyObject	*result = NULL, *r = NULL;
+	PyObject	*text = u, *decoded = NULL;
+	int			level;
+
+	if(encoding){
+		if(cs){
+			if((length = _readBytes(s, u, cs))==-1) return NULL;
+			if(length>=0) text = NULL;
+			else cs = NULL;
+			}
+		if(text){
+			if(!(text = decoded = PyUnicode_Decode(PyBytes_AsString(u), PyBytes_Size(u), encoding, "strict"))) return NULL;
+			}
+		}
+	if(text){
+		if((length = RLPYUNICODE_GETLENGTH(text))<0) goto fail;
+		if((level = _latin1Level(text, NULL, length, &base))<0 || maps){
+			if(!_scratchEnsure(s, length)) goto fail;
+			}
+		if(level<0){
+			if(!(s->input = _readUnicode(text, length, s->logical))) goto fail;
+#ifdef Py_LIMITED_API
+			level = _latin1Level(text, s->input, length, &base);
 #endif
-
-static Py_ssize_t _checkOptionalList(const char* name, PyObject *obj, void **ptr, size_t nelem, size_t elsize){
-	if(!obj || obj==Py_None) return 1;
-	if(PyList_SetSlice(obj, 0, PY_SSIZE_T_MAX, NULL)<0){
-		PyErr_Clear();
-		PyErr_Format(PyExc_TypeError,"Argument %s is of wrong type", name);
-		return 0;
+			}
 		}
-	*ptr = PyMem_Calloc(nelem,elsize);
-	if(!*ptr){
-		PyErr_Clear();
-		PyErr_Format(PyExc_MemoryError,"Argument %s storage allocation failed", name);
-		return 0;
+	else level = _latin1Level(NULL, s->input, length, &base);
+	_statsPhase(s, RLBIDI_PH_INPUT);
+	_statsString(s, length, level>=0);
+	if(level>=0){
+		if(maps) _identityMaps(s->L_to_V, s->V_to_L, s->levels, length, level);
+		if(decoded) result = PyUnicode_AsEncodedString(decoded, encoding, "strict");
+		else{
+			Py_IncRef(u);
+			result = u;
+			}
 		}
-	return 2;
-	}
-static PyObject *DeletePyList(PyObject *L){
-	if(L){
-		PyList_SetSlice(L, 0, PY_SSIZE_T_MAX, NULL);
-		Py_DecRef(L);
-	}
+	else{
+		if((length = _log2visScratch(s, length, &base, flags, clean, maps))<0) goto fail;
+		result = _makeResult(s->visual, length, cs, encoding);
+		}
+	Py_XDECREF(decoded);
+	decoded = NULL;
+	if(!result || !maps){
+		_statsPhase(s, RLBIDI_PH_OUTPUT);
+		return result;
+		}
+	if((r = PyTuple_New(4))){
+		PyTuple_SetItem(r, 0, result);
+		result = NULL;
+		if(!(result = _makeIndexList(s->L_to_V, length))) goto fail;
+		PyTuple_SetItem(r, 1, result);
+		if(!(result = _makeIndexList(s->V_to_L, length))) goto fail;
+		PyTuple_SetItem(r, 2, result);
+		if(!(result = _makeLevelList(s->levels, length))) goto fail;
+		PyTuple_SetItem(r, 3, result);
+		_statsPhase(s, RLBIDI_PH_OUTPUT);
+		return r;
+		}
+fail:
+	Py_XDECREF(decoded);
+	Py_XDECREF(result);
+	Py_XDECREF(r);
 	return NULL;
-}
+	}
 
-static PyObject * _rlbidi_log2vis(PyObject * self, PyObject * args, PyObject * kw){
-	PyObject *u=NULL;	/* input unicode or string object */
-	FriBidiParType base = FRIBIDI_TYPE_RTL;	/* optional direction */
-	PyObject *positions_L_to_V=NULL, *positions_V_to_L=NULL, *embedding_levels=NULL;
-	int clean = 0; /* optional flag to clean the string */
-	int reordernsm = 1; /* optional flag to allow reordering of non spacing marks*/
+static PyObject * _rlbidi_log2vis_many(PyObject * self, PyObject * args, PyObject * kw){
+	PyObject *lines=NULL;	/* iterable of str or bytes */
+	FriBidiParType base = FRIBIDI_TYPE_RTL;
+	int clean = 0;
+	int reordernsm = 1;
+	const char *encoding = "utf-8";	/* used for bytes items */
+	int maps = 0;	/* return (visual, L_to_V, V_to_L, levels) tuples */
+	FriBidiFlags shape = RLBIDI_FLAGS & RLBIDI_SHAPE_MASK, flags;
+	PyObject *it=NULL, *item, *r, *result=NULL;
+	RLBIDI_SCRATCH(scratch);
+	const rlbidiCharset *cs = NULL;
+	int csFound = 0;
 
-	static char *kwargs[] = { "logical", "base_direction", "clean", "reordernsm", "positions_L_to_V", "positions_V_to_L", "embedding_levels", NULL };
+	static char *kwargs[] = { "lines", "base_direction", "clean", "reordernsm", "encoding", "maps", "shape", NULL };
 
-	if(!PyArg_ParseTupleAndKeywords(args, kw, "U|iiiOOO", kwargs,
-				&u, &base, &clean, &reordernsm, &positions_L_to_V, &positions_V_to_L, &embedding_levels)
+	if(!PyArg_ParseTupleAndKeywords(args, kw, "O|iiisiO&", kwargs,
+				&lines, &base, &clean, &reordernsm, &encoding, &maps, _shapeConverter, &shape)
 			) return NULL;
+	if(!_checkBaseDirection(base)) return NULL;
+	if(!(it = PyObject_GetIter(lines))) return NULL;
+	if(!(result = PyList_New(0))) goto fail;
+	_statsStart(&scratch);
 
-	/* Validate base */
-	if(!(base == (FriBidiParType)FRIBIDI_TYPE_RTL
-	  || base == (FriBidiParType)FRIBIDI_TYPE_LTR
-	  || base == (FriBidiParType)FRIBIDI_TYPE_ON
-	  || base == (FriBidiParType)FRIBIDI_TYPE_WRTL
-	  || base == (FriBidiParType)FRIBIDI_TYPE_WLTR
-	  ))
-		return PyErr_Format(PyExc_ValueError, "invalid value %d: use either RTL, LTR or ON", base);
-
-	Py_ssize_t length = RLPYUNICODE_GETLENGTH(u), i;
-	FriBidiChar *logical = NULL;	/* input fribidi unicode buffer */
-	FriBidiChar *visual = NULL;		/* output fribidi unicode buffer */
-	FriBidiStrIndex *L_to_V = NULL;
-	FriBidiStrIndex *V_to_L = NULL;
-	FriBidiLevel *levels = NULL;
-	PyObject *obj;
-	int	r;
+	flags = RLBIDI_FLAGS_FOR(shape, reordernsm);
 
-	PyObject *result = NULL;
+	while((item = PyIter_Next(it))){
+		if(PyUnicode_Check(item)){
+			r = _log2visItem(item, NULL, NULL, base, flags, clean, maps, &scratch);
+			}
+		else if(PyBytes_Check(item)){
+			if(!csFound){
+				cs = _findCharset(encoding);
+				csFound = 1;
+				}
+			r = _log2visItem(item, encoding, cs, base, flags, clean, maps, &scratch);
+			}
+		else{
+			PyErr_Format(PyExc_TypeError, "log2vis_many items must be str or bytes not %R", (PyObject*)Py_TYPE(item));
+			r = NULL;
+			}
+		Py_DecRef(item);
+		if(!r) goto fail;
+		if(PyList_Append(result, r)<0){
+			Py_DecRef(r);
+			goto fail;
+			}
+		Py_DecRef(r);
+		}
+	if(PyErr_Occurred()) goto fail;
+	_statsEnd(&scratch, "log2vis_many");
+	goto done;
+fail:
+	Py_XDECREF(result);
+	result = NULL;
+done:
+	Py_XDECREF(it);
+	_scratchFree(&scratch);
+	return result;
+	}
+
+/* reorder the rows of a ragged batch of codepoints; rows are
+   codepoints[offsets[i]:offsets[i+1]] and the results are written at the
+   same offsets of the flat outputs. Needs no GIL; returns 0 on failure.
+*/
+static int _raggedRows(rlbidiScratch *s, const rlbidiInput *cp, const Py_ssize_t *offsets, Py_ssize_t nrows,
+				FriBidiChar *visual, FriBidiStrIndex *L_to_V, FriBidiStrIndex *V_to_L, FriBidiLevel *levels,
+				FriBidiStrIndex *lengths, FriBidiParType base, FriBidiFlags flags, int clean){
+	FriBidiChar			*sVisual = s->visual;
+	FriBidiStrIndex		*sL_to_V = s->L_to_V, *sV_to_L = s->V_to_L;
+	FriBidiLevel		*sLevels = s->levels;
+	Py_ssize_t			row, off, i, len, n;
+	FriBidiParType		b;
+	int					level, r = 1;
+	for(row=0; row<nrows && r; row++){
+		off = offsets[row];
+		n = len = offsets[row+1] - off;
+		if(cp->itemsize==4) s->input = (const FriBidiChar*)cp->buf + off;
+		else{
+			for(i=0; i<len; i++) s->logical[i] = (FriBidiChar)_inputItem(cp, off+i);
+			s->input = s->logical;
+			}
+		s->visual = visual ? visual+off : sVisual;
+		s->L_to_V = L_to_V ? L_to_V+off : sL_to_V;
+		s->V_to_L = V_to_L ? V_to_L+off : sV_to_L;
+		s->levels = levels ? levels+off : sLevels;
+		_statsPhase(s, RLBIDI_PH_INPUT);
+		b = base;
+		if((level = _latin1Level(NULL, s->input, len, &b))>=0){
+			_identityMaps(s->L_to_V, s->V_to_L, s->levels, len, level);
+			if(s->visual!=s->input) memcpy(s->visual, s->input, len*sizeof(FriBidiChar));
+			}
+		else{
+			r = _reorder(s, (FriBidiStrIndex)len, &b, flags, L_to_V!=NULL) != 0;
+			_statsPhase(s, RLBIDI_PH_REORDER);
+			if(r && clean){
+				n = fribidi_remove_bidi_marks(s->visual, (FriBidiStrIndex)len, L_to_V ? s->L_to_V : NULL, s->V_to_L, s->levels);
+				for(i=n; i<len; i++){
+					s->visual[i] = 0;
+					s->V_to_L[i] = -1;
+					s->levels[i] = -1;
+					}
+				_statsPhase(s, RLBIDI_PH_CLEAN);
+				}
+			}
+		if(lengths) lengths[row] = (FriBidiStrIndex)n;
+		}
+	s->visual = sVisual;
+	s->L_to_V = sL_to_V;
+	s->V_to_L = sV_to_L;
+	s->levels = sLevels;
+	return r;
+	}
+
+static PyObject * _rlbidi_log2vis_ragged(PyObject * self, PyObject * args, PyObject * kw){
+	PyObject		*codepoints = NULL, *offsetsObj = NULL;
+	PyObject		*visualObj = NULL, *L_to_VObj = NULL, *V_to_LObj = NULL, *levelsObj = NULL, *lengthsObj = NULL;
+	FriBidiParType	base = FRIBIDI_TYPE_RTL;
+	int				clean = 0, reordernsm = 1, r = 1;
+	FriBidiFlags	shape = RLBIDI_FLAGS & RLBIDI_SHAPE_MASK;
+	rlbidiInput		cp, offs;
+	rlbidiOutput	out[5];		/* visual, L_to_V, V_to_L, levels, lengths */
+	void			*arrays[5] = {NULL, NULL, NULL, NULL, NULL}, *temps[5] = {NULL, NULL, NULL, NULL, NULL};
+	static const Py_ssize_t itemsizes[5] = {sizeof(FriBidiChar), sizeof(FriBidiStrIndex), sizeof(FriBidiStrIndex),
+											sizeof(FriBidiLevel), sizeof(FriBidiStrIndex)};
+	Py_ssize_t		*offsets = NULL, nrows, total, maxlen = 0, row, i, len;
+	long long		v;
+	RLBIDI_SCRATCH(scratch);
+	PyObject		*result = NULL;
 
-	if(!_checkOptionalList("positions_L_to_V",positions_L_to_V, (void**)&L_to_V, length+1, sizeof(FriBidiStrIndex))) return NULL;
-	if(!_checkOptionalList("positions_V_to_L",positions_V_to_L,(void**)&V_to_L, length+1, sizeof(FriBidiStrIndex))) return NULL;
-	if(!_checkOptionalList("embedding_levels",embedding_levels,(void**)&levels, length+1, sizeof(FriBidiLevel))) return NULL;
+	static char *kwargs[] = { "codepoints", "offsets", "visual", "positions_L_to_V", "positions_V_to_L", "embedding_levels",
+								"lengths", "base_direction", "clean", "reordernsm", "shape", NULL };
 
-	/* Allocate fribidi unicode buffers
-	   TODO - Don't copy strings if sizeof(FriBidiChar) == sizeof(Py_UNICODE)
-	*/
-	if(!(logical=PyMem_New(FriBidiChar, length + 1))){
+	if(!PyArg_ParseTupleAndKeywords(args, kw, "OO|OOOOOiiiO&:log2vis_ragged", kwargs,
+				&codepoints, &offsetsObj, &visualObj, &L_to_VObj, &V_to_LObj, &levelsObj, &lengthsObj,
+				&base, &clean, &reordernsm, _shapeConverter, &shape)
+			) return NULL;
+	if(!_checkBaseDirection(base)) return NULL;
+
+	memset(&cp, 0, sizeof(cp));
+	memset(&offs, 0, sizeof(offs));
+	for(i=0; i<5; i++) _outputInit(out+i, "", NULL, 0, 0);
+	_statsStart(&scratch);
+	if(!_inputInit(&cp, "codepoints", codepoints) || !_inputInit(&offs, "offsets", offsetsObj)) goto cleanup;
+
+	/* the offsets must be non-decreasing row boundaries within codepoints */
+	if((nrows = offs.nitems-1) < 0){
+		PyErr_SetString(PyExc_ValueError, "log2vis_ragged: offsets must have at least one item");
+		goto cleanup;
+		}
+	if(!(offsets = PyMem_New(Py_ssize_t, nrows+1))){
 		PyErr_NoMemory();
 		goto cleanup;
 		}
+	for(row=0; row<=nrows; row++){
+		v = _inputItem(&offs, row);
+		if(v<0 || v>(long long)cp.nitems || (row && v<offsets[row-1])){
+			PyErr_Format(PyExc_ValueError, "log2vis_ragged: invalid offsets[%zd]=%lld for %zd codepoints", row, v, cp.nitems);
+			goto cleanup;
+			}
+		offsets[row] = (Py_ssize_t)v;
+		if(row && (len = offsets[row]-offsets[row-1]) > maxlen) maxlen = len;
+		}
+	total = offsets[nrows];
+	for(i=offsets[0]; i<total; i++){
+		v = _inputItem(&cp, i);
+		if(v<0 || v>0x10FFFF){
+			PyErr_Format(PyExc_ValueError, "log2vis_ragged: invalid codepoint %lld at %zd", v, i);
+			goto cleanup;
+			}
+		}
+	if(clean && (!lengthsObj || lengthsObj==Py_None)){
+		PyErr_SetString(PyExc_ValueError, "log2vis_ragged: clean needs a lengths output for the shortened rows");
+		goto cleanup;
+		}
+	if(!_outputInitEx(out+0, "visual", visualObj, total, 0x10FFFF, 0)
+		|| !_outputInitEx(out+1, "positions_L_to_V", L_to_VObj, total, maxlen-1, 0)
+		|| !_outputInitEx(out+2, "positions_V_to_L", V_to_LObj, total, maxlen-1, 0)
+		|| !_outputInitEx(out+3, "embedding_levels", levelsObj, total, 125, 1)
+		|| !_outputInitEx(out+4, "lengths", lengthsObj, nrows, maxlen, 0)) goto cleanup;
 
-	if(!(visual=PyMem_New(FriBidiChar, length + 1))){
-		PyErr_NoMemory();
+	/* fribidi writes into suitable caller buffers, otherwise into temporary arrays */
+	for(i=0; i<5; i++){
+		if(out[i].kind==RLBIDI_OUT_NONE) continue;
+		if(!(arrays[i] = out[i].direct)){
+			if(!(arrays[i] = temps[i] = PyMem_Malloc((i==4 ? nrows : total)*itemsizes[i]+1))){
+				PyErr_NoMemory();
+				goto cleanup;
+				}
+			}
+		}
+	if(!_scratchEnsure(&scratch, maxlen)) goto cleanup;
+	_statsPhase(&scratch, RLBIDI_PH_INPUT);
+
+#define RLBIDI_RAGGED_ROWS() _raggedRows(&scratch, &cp, offsets, nrows, (FriBidiChar*)arrays[0], (FriBidiStrIndex*)arrays[1], \
+				(FriBidiStrIndex*)arrays[2], (FriBidiLevel*)arrays[3], (FriBidiStrIndex*)arrays[4], base, \
+				RLBIDI_FLAGS_FOR(shape, reordernsm), clean)
+	if(total-offsets[0] >= RLBIDI_NOGIL_MINSIZE){
+		Py_BEGIN_ALLOW_THREADS
+		r = RLBIDI_RAGGED_ROWS();
+		Py_END_ALLOW_THREADS
+		}
+	else r = RLBIDI_RAGGED_ROWS();
+#undef RLBIDI_RAGGED_ROWS
+	if(!r){
+		PyErr_SetString(PyExc_RuntimeError, "fribidi failed to order string");
 		goto cleanup;
 		}
 
+	/* rows before offsets[0] are not touched; items are stored from offsets[0] on */
+	for(i=0; i<5; i++){
+		Py_ssize_t start = i==4 ? 0 : offsets[0];
+		if(!temps[i]) continue;
+		if(start){
+			/* keep what precedes the first row */
+			if(out[i].kind==RLBIDI_OUT_LIST){
+				PyErr_Format(PyExc_ValueError, "log2vis_ragged: list %s needs offsets[0]==0", out[i].name);
+				goto cleanup;
+				}
+			}
+		if(!_outputStoreAt(out+i, (const char*)temps[i]+start*itemsizes[i], start, (i==4 ? nrows : total)-start)) goto cleanup;
+		}
+	_statsPhase(&scratch, RLBIDI_PH_OUTPUT);
+	if(scratch.timing){
+		for(row=0; row<nrows; row++) _statsString(&scratch, offsets[row+1]-offsets[row], 0);
+		_statsEnd(&scratch, "log2vis_ragged");
+		}
+	Py_IncRef(Py_None);
+	result = Py_None;
+
+cleanup:
+	for(i=0; i<5; i++){
+		_outputRelease(out+i);
+		PyMem_Free(temps[i]);
+		}
+	_inputRelease(&cp);
+	_inputRelease(&offs);
+	PyMem_Free(offsets);
+	_scratchFree(&scratch);
+	return result;
+	}
+
+/* Classification of str without reordering; each function takes a str or
+   an iterable of them and gives a result or a list of results. The
+   characters and types of an item are read into buffers reused for the
+   whole iterable.
+*/
+typedef struct {
+	FriBidiChar		*chars;
+	FriBidiCharType	*types;
+	Py_ssize_t		size;
+	} rlbidiCharBuf;
+
+static int _charBufEnsure(rlbidiCharBuf *b, Py_ssize_t length){
+	if(length > b->size){
+		Py_ssize_t size = length > 2*b->size ? length : 2*b->size;
+		PyMem_Free(b->chars);
+		PyMem_Free(b->types);
+		b->types = NULL;
+		b->size = 0;
+		if(!(b->chars = PyMem_New(FriBidiChar, size)) || !(b->types = PyMem_New(FriBidiCharType, size))){
+			PyErr_NoMemory();
+			return 0;
+			}
+		b->size = size;
+		}
+	return 1;
+	}
+
+/* the characters of str u, read into b unless they can be used in place */
+static const FriBidiChar *_charBufRead(rlbidiCharBuf *b, PyObject *u, Py_ssize_t *plength){
+	Py_ssize_t length = RLPYUNICODE_GETLENGTH(u);
+	if(length<0) return NULL;
+	if(length >= INT_MAX){
+		PyErr_SetString(PyExc_OverflowError, "string is too long to classify");
+		return NULL;
+		}
+	if(!_charBufEnsure(b, length ? length : 1)) return NULL;
+	*plength = length;
+	return _readUnicode(u, length, b->chars);
+	}
+
+/* the types of a character which can make text need reordering; nothing
+   below the hebrew block has one */
+#define RLBIDI_IS_RTL_TYPE(t) (FRIBIDI_IS_RTL(t) || FRIBIDI_IS_ARABIC(t))
+#define RLBIDI_MIN_RTL 0x0590
+
+static PyObject *_hasRTLItem(PyObject *u, rlbidiCharBuf *b){
+	Py_ssize_t	i, length;
 #ifdef Py_LIMITED_API
-	for(i=0; i<length; ++i){
-		logical[i] = PyUnicode_ReadChar(u,i);
+	const FriBidiChar *chars = _charBufRead(b, u, &length);
+	if(!chars) return NULL;
+	for(i=0; i<length; i++){
+		if(chars[i]>=RLBIDI_MIN_RTL && RLBIDI_IS_RTL_TYPE(fribidi_get_bidi_type(chars[i]))) Py_RETURN_TRUE;
 		}
 #else
-	void *data = NULL;
-	int	kind;
-	if(PyUnicode_READY(u)) goto cleanup;
-	data = PyUnicode_DATA(u);
-	kind = PyUnicode_KIND(u);
-	for(i=0; i<length; ++i){
-		logical[i] = PyUnicode_READ(kind,data,i);
+	int			kind;
+	const void	*data;
+	Py_UCS4		c;
+	if(PyUnicode_READY(u)) return NULL;
+	/* latin-1 has no RTL characters; the others are looked at until one is found */
+	if((kind = PyUnicode_KIND(u))!=PyUnicode_1BYTE_KIND){
+		data = PyUnicode_DATA(u);
+		length = PyUnicode_GET_LENGTH(u);
+		for(i=0; i<length; i++){
+			c = PyUnicode_READ(kind, data, i);
+			if(c>=RLBIDI_MIN_RTL && RLBIDI_IS_RTL_TYPE(fribidi_get_bidi_type(c))) Py_RETURN_TRUE;
+			}
+		}
+#endif
+	Py_RETURN_FALSE;
+	}
+
+static PyObject *_bidiTypesItem(PyObject *u, rlbidiCharBuf *b){
+	Py_ssize_t			i, length;
+	const FriBidiChar	*chars = _charBufRead(b, u, &length);
+	FriBidiCharType		t, last = FRIBIDI_TYPE_LTR;
+	unsigned char		*p, code = 0;
+	PyObject			*r;
+	if(!chars || !(r = PyBytes_FromStringAndSize(NULL, length))) return NULL;
+	p = (unsigned char *)PyBytes_AsString(r);
+	for(i=0; i<length; i++){
+		if(chars[i]<256) p[i] = _latin1Code[chars[i]];
+		else{
+			/* runs of one type are usual so the last lookup is kept */
+			if((t = fribidi_get_bidi_type(chars[i]))!=last){
+				last = t;
+				code = _bidiTypeCode(t);
+				}
+			p[i] = code;
+			}
+		}
+	return r;
+	}
+
+static PyObject *_parDirectionItem(PyObject *u, rlbidiCharBuf *b){
+	Py_ssize_t			length;
+	const FriBidiChar	*chars;
+#ifndef Py_LIMITED_API
+	/* latin-1 is LTR if it has a strong character at all */
+	if(PyUnicode_READY(u)) return NULL;
+	if(PyUnicode_KIND(u)==PyUnicode_1BYTE_KIND){
+		const Py_UCS1	*data = PyUnicode_1BYTE_DATA(u);
+		Py_ssize_t		i;
+		length = PyUnicode_GET_LENGTH(u);
+		for(i=0; i<length; i++) if(_latin1Class[data[i]]==RLBIDI_L1_L) return PyLong_FromLong((long)FRIBIDI_PAR_LTR);
+		return PyLong_FromLong((long)FRIBIDI_PAR_ON);
 		}
 #endif
+	if(!(chars = _charBufRead(b, u, &length))) return NULL;
+	fribidi_get_bidi_types(chars, (FriBidiStrIndex)length, b->types);
+	return PyLong_FromLong((long)fribidi_get_par_direction(b->types, (FriBidiStrIndex)length));
+	}
+
+static PyObject *_classify(PyObject *arg, PyObject *(*item)(PyObject *, rlbidiCharBuf *), const char *name){
+	rlbidiCharBuf	b = {NULL, NULL, 0};
+	PyObject		*it, *u, *r, *result = NULL;
+	if(PyUnicode_Check(arg)) result = item(arg, &b);
+	else if(!(it = PyObject_GetIter(arg))){
+		PyErr_Format(PyExc_TypeError, "%s argument must be str or an iterable of str not %R", name, (PyObject*)Py_TYPE(arg));
+		}
+	else{
+		if((result = PyList_New(0))){
+			while((u = PyIter_Next(it))){
+				if(!PyUnicode_Check(u)){
+					PyErr_Format(PyExc_TypeError, "%s items must be str not %R", name, (PyObject*)Py_TYPE(u));
+					r = NULL;
+					}
+				else r = item(u, &b);
+				Py_DecRef(u);
+				if(!r || PyList_Append(result, r)){
+					Py_XDECREF(r);
+					break;
+					}
+				Py_DecRef(r);
+				}
+			if(PyErr_Occurred()) Py_CLEAR(result);
+			}
+		Py_DecRef(it);
+		}
+	PyMem_Free(b.chars);
+	PyMem_Free(b.types);
+	return result;
+	}
+
+static PyObject *_rlbidi_has_rtl(PyObject *self, PyObject *arg){
+	return _classify(arg, _hasRTLItem, "has_rtl");
+	}
+static PyObject *_rlbidi_bidi_types(PyObject *self, PyObject *arg){
+	return _classify(arg, _bidiTypesItem, "bidi_types");
+	}
+static PyObject *_rlbidi_par_direction(PyObject *self, PyObject *arg){
+	return _classify(arg, _parDirectionItem, "par_direction");
+	}
+
+/* BidiParagraph: the paragraph level part of the algorithm is done once
+   and lines of the paragraph are then reordered individually.
+*/
+typedef struct {
+	PyObject_HEAD
+	PyObject			*text;		/* the logical str */
+	Py_ssize_t			length;
+	FriBidiParType		base;		/* the resolved paragraph direction */
+	FriBidiFlags		flags;
+	FriBidiLevel		max_level;
+	FriBidiChar			*shaped;	/* the text after arabic joining and shaping */
+	FriBidiCharType		*types;
+	FriBidiLevel		*levels;
+	} rlbidiParagraph;
+
+static PyObject *_rlbidiParagraph_new(PyTypeObject *type, PyObject *args, PyObject *kw){
+	PyObject			*u = NULL;
+	FriBidiParType		base = FRIBIDI_PAR_RTL;
+	int					reordernsm = 1;
+	FriBidiFlags		shape = RLBIDI_FLAGS & RLBIDI_SHAPE_MASK;
+	rlbidiParagraph		*self;
+	const FriBidiChar	*logical;
+	FriBidiBracketType	*brackets = NULL;
+	FriBidiArabicProp	*ar_props = NULL;
+	Py_ssize_t			length;
+	FriBidiStrIndex		len;
+	FriBidiLevel		max_level = 0;
 
-	/* Convert to unicode and order visually */
-	fribidi_set_reorder_nsm(reordernsm);
+	static char *kwargs[] = { "text", "base_direction", "reordernsm", "shape", NULL };
+	if(!PyArg_ParseTupleAndKeywords(args, kw, "U|O&iO&:BidiParagraph", kwargs,
+				&u, _baseDirectionConverter, &base, &reordernsm, _shapeConverter, &shape)) return NULL;
+	length = RLPYUNICODE_GETLENGTH(u);
+	if(length<0) return NULL;
+	if(length >= INT_MAX) return PyErr_Format(PyExc_OverflowError, "string is too long to reorder");
+	len = (FriBidiStrIndex)length;
+	if(!(self = (rlbidiParagraph*)PyType_GenericAlloc(type, 0))) return NULL;
+	Py_IncRef(u);
+	self->text = u;
+	self->length = length;
+	self->flags = RLBIDI_FLAGS_FOR(shape, reordernsm);
+	if(!(self->shaped = PyMem_New(FriBidiChar, length+1))
+		|| !(self->types = PyMem_New(FriBidiCharType, length+1))
+		|| !(self->levels = PyMem_New(FriBidiLevel, length+1))
+		|| !(brackets = PyMem_New(FriBidiBracketType, length+1))
+		|| !(ar_props = PyMem_New(FriBidiArabicProp, length+1))){
+		PyErr_NoMemory();
+		goto fail;
+		}
+	/* shaping only happens after the joining types are known so a
+	   copied str can be shaped where it is */
+	if(!(logical = _readUnicode(u, length, self->shaped))) goto fail;
+	if(len){
+		Py_BEGIN_ALLOW_THREADS
+		fribidi_get_bidi_types(logical, len, self->types);
+		fribidi_get_bracket_types(logical, len, self->types, brackets);
+		max_level = fribidi_get_par_embedding_levels_ex(self->types, brackets, len, &base, self->levels);
+		if(max_level){
+			if(logical!=self->shaped) memcpy(self->shaped, logical, len*sizeof(FriBidiChar));
+			if(self->flags & RLBIDI_SHAPE_ARABIC){
+				fribidi_get_joining_types(logical, len, ar_props);
+				fribidi_join_arabic(self->types, len, self->levels, ar_props);
+				fribidi_shape(self->flags, self->levels, len, ar_props, self->shaped);
+				}
+			else if(self->flags & FRIBIDI_FLAG_SHAPE_MIRRORING) fribidi_shape(self->flags, self->levels, len, NULL, self->shaped);
+			}
+		Py_END_ALLOW_THREADS
+		if(!max_level){
+			PyErr_SetString(PyExc_RuntimeError, "fribidi failed to order string");
+			goto fail;
+			}
+		max_level--;
+		}
+	else if(base!=FRIBIDI_PAR_LTR && base!=FRIBIDI_PAR_RTL)
+		base = base==FRIBIDI_PAR_WRTL ? FRIBIDI_PAR_RTL : FRIBIDI_PAR_LTR;
+	self->base = base;
+	self->max_level = max_level;
+	PyMem_Del(brackets);
+	PyMem_Del(ar_props);
+	return (PyObject*)self;
+fail:
+	PyMem_Del(brackets);
+	PyMem_Del(ar_props);
+	Py_DecRef((PyObject*)self);
+	return NULL;
+	}
+
+static void _rlbidiParagraph_dealloc(rlbidiParagraph *self){
+	PyTypeObject *tp = Py_TYPE((PyObject*)self);
+	freefunc tp_free = (freefunc)PyType_GetSlot(tp, Py_tp_free);
+	Py_XDECREF(self->text);
+	PyMem_Del(self->shaped);
+	PyMem_Del(self->types);
+	PyMem_Del(self->levels);
+	tp_free(self);
+	Py_DecRef((PyObject*)tp);
+	}
+
+static PyObject *_rlbidiParagraph_reorder_line(rlbidiParagraph *self, PyObject *args, PyObject *kw){
+	Py_ssize_t			start = 0, end = PY_SSIZE_T_MAX, length;
+	int					clean = 0, maps = 0;
+	RLBIDI_SCRATCH(scratch);
+	FriBidiStrIndex		i, len;
+	FriBidiLevel		r = 1;
+	PyObject			*result = NULL, *t = NULL, *o;
 
-	if(!fribidi_log2vis(logical, (const FriBidiStrIndex)length, &base, visual, L_to_V, V_to_L, levels)){
+	static char *kwargs[] = { "start", "end", "clean", "maps", NULL };
+	if(!PyArg_ParseTupleAndKeywords(args, kw, "|nnii:reorder_line", kwargs, &start, &end, &clean, &maps)) return NULL;
+	if(end > self->length) end = self->length;
+	if(start<0 || start>end) return PyErr_Format(PyExc_IndexError, "reorder_line: invalid line [%zd,%zd) for a paragraph of length %zd", start, end, self->length);
+	length = end - start;
+	len = (FriBidiStrIndex)length;
+	_statsStart(&scratch);
+	if(!_scratchEnsure(&scratch, length)) return NULL;
+	memcpy(scratch.visual, self->shaped+start, length*sizeof(FriBidiChar));
+	memcpy(scratch.levels, self->levels+start, length*sizeof(FriBidiLevel));	/* L1 changes the levels */
+	for(i=0; i<len; i++) scratch.V_to_L[i] = i;
+	_statsPhase(&scratch, RLBIDI_PH_INPUT);
+	_statsString(&scratch, length, 0);
+	if(len){
+		if(length >= RLBIDI_NOGIL_MINSIZE){
+			Py_BEGIN_ALLOW_THREADS
+			r = fribidi_reorder_line(self->flags, self->types+start, len, 0, self->base, scratch.levels, scratch.visual, scratch.V_to_L);
+			Py_END_ALLOW_THREADS
+			}
+		else
+			r = fribidi_reorder_line(self->flags, self->types+start, len, 0, self->base, scratch.levels, scratch.visual, scratch.V_to_L);
+		}
+	_statsPhase(&scratch, RLBIDI_PH_REORDER);
+	if(!r){
 		PyErr_SetString(PyExc_RuntimeError, "fribidi failed to order string");
-		goto cleanup;
+		goto done;
+		}
+	if(maps || clean){
+		for(i=0; i<len; i++) scratch.L_to_V[scratch.V_to_L[i]] = i;
+		}
+	if(clean){
+		length = fribidi_remove_bidi_marks(scratch.visual, len, scratch.L_to_V, scratch.V_to_L, scratch.levels);
+		_statsPhase(&scratch, RLBIDI_PH_CLEAN);
+		}
+	if(!(result = _makeUnicode(scratch.visual, length)) || !maps) goto done;
+	if(!(t = PyTuple_New(4))) goto done;
+	PyTuple_SetItem(t, 0, result);
+	result = NULL;
+	if(!(o = _makeIndexList(scratch.L_to_V, length))) goto done;
+	PyTuple_SetItem(t, 1, o);
+	if(!(o = _makeIndexList(scratch.V_to_L, length))) goto done;
+	PyTuple_SetItem(t, 2, o);
+	if(!(o = _makeLevelList(scratch.levels, length))) goto done;
+	PyTuple_SetItem(t, 3, o);
+	result = t;
+	t = NULL;
+done:
+	Py_XDECREF(t);
+	if(result){
+		_statsPhase(&scratch, RLBIDI_PH_OUTPUT);
+		_statsEnd(&scratch, "BidiParagraph.reorder_line");
 		}
+	_scratchFree(&scratch);
+	return result;
+	}
 
-	/* Cleanup the string if requested */
-	if(clean) length = fribidi_remove_bidi_marks(visual, (const FriBidiStrIndex)length,  L_to_V, V_to_L, levels);
-#ifdef Py_LIMITED_API
-	result = PyUnicode_DecodeUTF32((const char *)visual, length*4, "strict", NULL);
-#else
-	result = PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND,(void*)visual, length);
-#endif
-	if(L_to_V){
-		for(i=0;i<length;i++){
-			if(!(obj = PyLong_FromLong((long)L_to_V[i]))) goto cleanup;
-			r = PyList_Append(positions_L_to_V,obj);
-			Py_DecRef(obj);
-			if(r<0) goto cleanup;
+static PyObject *_rlbidiParagraph_get_text(rlbidiParagraph *self, void *closure){
+	Py_IncRef(self->text);
+	return self->text;
+	}
+static PyObject *_rlbidiParagraph_get_base_direction(rlbidiParagraph *self, void *closure){
+	return PyLong_FromLong((long)self->base);
+	}
+static PyObject *_rlbidiParagraph_get_max_level(rlbidiParagraph *self, void *closure){
+	return PyLong_FromLong((long)self->max_level);
+	}
+static PyObject *_rlbidiParagraph_get_embedding_levels(rlbidiParagraph *self, void *closure){
+	return _makeLevelList(self->levels, self->length);
+	}
+static Py_ssize_t _rlbidiParagraph_length(rlbidiParagraph *self){
+	return self->length;
+	}
+
+static PyMethodDef rlbidiParagraph_methods[] = {
+	{"reorder_line", (PyCFunction)_rlbidiParagraph_reorder_line, METH_VARARGS | METH_KEYWORDS,
+		"reorder_line(start=0, end=len, clean=False, maps=False)\n"
+		"return the visual form of the line text[start:end] or, if maps is true,\n"
+		"a tuple (visual, positions_L_to_V, positions_V_to_L, embedding_levels)\n"
+		"with positions relative to start."},
+	{NULL, NULL, 0, NULL}
+	};
+static PyGetSetDef rlbidiParagraph_getset[] = {
+	{"text", (getter)_rlbidiParagraph_get_text, NULL, "the logical text", NULL},
+	{"base_direction", (getter)_rlbidiParagraph_get_base_direction, NULL, "the resolved paragraph direction, LTR or RTL", NULL},
+	{"max_level", (getter)_rlbidiParagraph_get_max_level, NULL, "the highest embedding level", NULL},
+	{"embedding_levels", (getter)_rlbidiParagraph_get_embedding_levels, NULL, "list of the paragraph embedding levels", NULL},
+	{NULL, NULL, NULL, NULL, NULL}
+	};
+static PyType_Slot rlbidiParagraph_slots[] = {
+	{Py_tp_doc, "BidiParagraph(text, base_direction=RTL, reordernsm=True, shape=True)\n"
+				"resolve the embedding levels of a paragraph once so that each of its\n"
+				"lines can be reordered with reorder_line."},
+	{Py_tp_new, _rlbidiParagraph_new},
+	{Py_tp_dealloc, _rlbidiParagraph_dealloc},
+	{Py_tp_methods, rlbidiParagraph_methods},
+	{Py_tp_getset, rlbidiParagraph_getset},
+	{Py_sq_length, _rlbidiParagraph_length},
+	{0, NULL}
+	};
+static PyType_Spec rlbidiParagraph_spec = {
+	"rlbidi._rlbidi.BidiParagraph",
+	sizeof(rlbidiParagraph),
+	0,
+	Py_TPFLAGS_DEFAULT,
+	rlbidiParagraph_slots
+	};
+
+/* Reorderer: log2vis with its options validated once and its scratch
+   kept between calls; it is called with just the text. The scratch only
+   grows, except that it is freed when after RLBIDI_SHRINK_CALLS calls it
+   is over 4 times the longest of them and holds more than
+   RLBIDI_SHRINK_MIN characters. A call made while another has released
+   the GIL uses a scratch of its own.
+*/
+typedef struct {
+	PyObject_HEAD
+	FriBidiParType		base;
+	FriBidiFlags		flags;
+	int					clean;
+	char				*encoding;	/* copied, or NULL for None */
+	const rlbidiCharset	*cs;
+	rlbidiScratch		scratch;
+	int					busy;		/* the scratch is in use */
+	int					calls;		/* calls since the scratch size was last checked */
+	Py_ssize_t			longest;	/* the longest of them */
+	} rlbidiReorderer;
+
+static PyObject *_rlbidiReorderer_new(PyTypeObject *type, PyObject *args, PyObject *kw){
+	FriBidiParType		base = FRIBIDI_PAR_RTL;
+	int					clean = 1, reordernsm = 1;
+	const char			*encoding = "utf-8";
+	FriBidiFlags		shape = RLBIDI_FLAGS & RLBIDI_SHAPE_MASK;
+	rlbidiReorderer		*self;
+
+	static char *kwargs[] = { "base_direction", "clean", "reordernsm", "encoding", "shape", NULL };
+	if(!PyArg_ParseTupleAndKeywords(args, kw, "|O&iizO&:Reorderer", kwargs,
+				_baseDirectionConverter, &base, &clean, &reordernsm, &encoding, _shapeConverter, &shape)) return NULL;
+	if(!(self = (rlbidiReorderer*)PyType_GenericAlloc(type, 0))) return NULL;
+	self->base = base;
+	self->flags = RLBIDI_FLAGS_FOR(shape, reordernsm);
+	self->clean = clean;
+	if(encoding){
+		/* look the codec up now so a bad encoding fails here */
+		PyObject *codec = PyCodec_Encoder(encoding);
+		if(!codec) goto err;
+		Py_DecRef(codec);
+		if(!(self->encoding = PyMem_Malloc(strlen(encoding)+1))){
+			PyErr_NoMemory();
+			goto err;
 			}
+		strcpy(self->encoding, encoding);
+		self->cs = _findCharset(encoding);
+		}
+	return (PyObject*)self;
+err:
+	Py_DecRef((PyObject*)self);
+	return NULL;
+	}
+
+static void _rlbidiReorderer_dealloc(rlbidiReorderer *self){
+	PyTypeObject *tp = Py_TYPE((PyObject*)self);
+	freefunc tp_free = (freefunc)PyType_GetSlot(tp, Py_tp_free);
+	PyMem_Free(self->encoding);
+	_scratchFree(&self->scratch);
+	tp_free(self);
+	Py_DecRef((PyObject*)tp);
+	}
+
+static PyObject *_rlbidiReorderer_call(rlbidiReorderer *self, PyObject *args, PyObject *kw){
+	PyObject		*u, *result;
+	const char		*encoding = NULL;
+	rlbidiScratch	own = {0}, *s = &self->scratch;
+	Py_ssize_t		length;
+
+	if(PyTuple_Size(args)!=1 || (kw && PyDict_Size(kw))){
+		PyErr_SetString(PyExc_TypeError, "Reorderer takes exactly one positional argument, the text");
+		return NULL;
 		}
-	if(V_to_L){
-		for(i=0;i<length;i++){
-			if(!(obj = PyLong_FromLong((long)V_to_L[i]))) goto cleanup;
-			r = PyList_Append(positions_V_to_L,obj);
-			Py_DecRef(obj);
-			if(r<0) goto cleanup;
+	u = PyTuple_GetItem(args, 0);
+	if(PyUnicode_Check(u)) length = RLPYUNICODE_GETLENGTH(u);
+	else if(PyBytes_Check(u)){
+		if(!(encoding = self->encoding)){
+			PyErr_SetString(PyExc_TypeError, "Reorderer needs an encoding for bytes");
+			return NULL;
 			}
+		length = PyBytes_Size(u);
+		}
+	else return PyErr_Format(PyExc_TypeError, "Reorderer argument must be str or bytes not %R", (PyObject*)Py_TYPE(u));
+	if(self->busy) s = &own;
+	else{
+		self->busy = 1;
+		s->chars = 0;
+		memset(s->ns, 0, sizeof(s->ns));
+		}
+	_statsStart(s);
+	result = _log2visItem(u, encoding, encoding ? self->cs : NULL, self->base, self->flags, self->clean, 0, s);
+	if(result) _statsEnd(s, "Reorderer");
+	if(s==&own){
+		_scratchFree(&own);
+		return result;
+		}
+	self->busy = 0;
+	if(length > self->longest) self->longest = length;
+	if(++self->calls >= RLBIDI_SHRINK_CALLS){
+		if(s->size > RLBIDI_SHRINK_MIN && s->size > 4*self->longest) _scratchFree(s);
+		self->calls = 0;
+		self->longest = 0;
+		}
+	return result;
+	}
+
+static PyObject *_rlbidiReorderer_get_base_direction(rlbidiReorderer *self, void *closure){
+	return PyLong_FromLong((long)self->base);
+	}
+static PyObject *_rlbidiReorderer_get_clean(rlbidiReorderer *self, void *closure){
+	return PyBool_FromLong(self->clean);
+	}
+static PyObject *_rlbidiReorderer_get_reordernsm(rlbidiReorderer *self, void *closure){
+	return PyBool_FromLong((self->flags & FRIBIDI_FLAG_REORDER_NSM)!=0);
+	}
+static PyObject *_rlbidiReorderer_get_shape(rlbidiReorderer *self, void *closure){
+	return PyLong_FromLong((long)(self->flags & RLBIDI_SHAPE_MASK));
+	}
+static PyObject *_rlbidiReorderer_get_encoding(rlbidiReorderer *self, void *closure){
+	if(self->encoding) return PyUnicode_FromString(self->encoding);
+	Py_IncRef(Py_None);
+	return Py_None;
+	}
+static PyObject *_rlbidiReorderer_get_scratch_size(rlbidiReorderer *self, void *closure){
+	return PyLong_FromSsize_t(self->scratch.size);
+	}
+
+static PyGetSetDef rlbidiReorderer_getset[] = {
+	{"base_direction", (getter)_rlbidiReorderer_get_base_direction, NULL, "the base direction", NULL},
+	{"clean", (getter)_rlbidiReorderer_get_clean, NULL, "whether bidi marks are removed", NULL},
+	{"reordernsm", (getter)_rlbidiReorderer_get_reordernsm, NULL, "whether non spacing marks are reordered", NULL},
+	{"shape", (getter)_rlbidiReorderer_get_shape, NULL, "the SHAPE_ flags used", NULL},
+	{"encoding", (getter)_rlbidiReorderer_get_encoding, NULL, "the encoding of bytes text or None", NULL},
+	{"scratch_size", (getter)_rlbidiReorderer_get_scratch_size, NULL, "the characters the kept buffers can hold", NULL},
+	{NULL, NULL, NULL, NULL, NULL}
+	};
+static PyType_Slot rlbidiReorderer_slots[] = {
+	{Py_tp_doc, "Reorderer(base_direction=RTL, clean=True, reordernsm=True, encoding='utf-8', shape=True)\n"
+				"a callable doing log2vis(text, ...) with these options; reorderer(text)\n"
+				"returns text reordered visually, as str or bytes like text."},
+	{Py_tp_new, _rlbidiReorderer_new},
+	{Py_tp_dealloc, _rlbidiReorderer_dealloc},
+	{Py_tp_call, _rlbidiReorderer_call},
+	{Py_tp_getset, rlbidiReorderer_getset},
+	{0, NULL}
+	};
+static PyType_Spec rlbidiReorderer_spec = {
+	"rlbidi._rlbidi.Reorderer",
+	sizeof(rlbidiReorderer),
+	0,
+	Py_TPFLAGS_DEFAULT,
+	rlbidiReorderer_slots
+	};
+
+/* BidiLayout: the result of reordering one string with its maps and level
+   runs kept in C memory so that logical and visual offsets and ranges can
+   be mapped without building python lists. Logical offsets are into the
+   text as given and visual ones into the visual string; with clean the
+   removed marks map to -1. The maps are held in bytes objects and only
+   made into lists or memoryviews when asked for. The level runs are found
+   when first needed and are also kept sorted by logical start so a logical
+   range is found by bisection and mapped in time proportional to the runs
+   it touches.
+*/
+typedef struct {
+	PyObject_HEAD
+	PyObject			*visual;	/* str, or bytes for bytes logical text */
+	Py_ssize_t			length;		/* of the logical text */
+	Py_ssize_t			vlength;	/* of the visual text */
+	FriBidiParType		base;		/* the resolved paragraph direction */
+	PyObject			*L_to_V;	/* bytes of length FriBidiStrIndex */
+	PyObject			*V_to_L;	/* bytes of vlength FriBidiStrIndex */
+	PyObject			*levels;	/* bytes of length FriBidiLevel */
+	rlbidiRuns			runs;		/* in visual order */
+	FriBidiStrIndex		*byLogical;	/* pairs of logical start and run index sorted by logical start;
+									   NULL until the runs are found */
+	} rlbidiLayout;
+
+/* order pairs of indices by their first */
+static int _cmpFirstIndex(const void *a, const void *b){
+	FriBidiStrIndex x = *(const FriBidiStrIndex*)a, y = *(const FriBidiStrIndex*)b;
+	return x<y ? -1 : x>y;
+	}
+
+/* remove the marks from the reordered visual string keeping V_to_L in
+   logical offsets of the whole text and making L_to_V -1 for them */
+static Py_ssize_t _layoutClean(rlbidiScratch *s, Py_ssize_t length){
+	Py_ssize_t	v, j;
+	for(v=j=0; v<length; v++){
+		if(RLBIDI_IS_MARK(s->visual[v])) continue;
+		s->visual[j] = s->visual[v];
+		s->V_to_L[j++] = s->V_to_L[v];
+		}
+	for(v=0; v<length; v++) s->L_to_V[v] = -1;
+	for(v=0; v<j; v++) s->L_to_V[s->V_to_L[v]] = (FriBidiStrIndex)v;
+	return j;
+	}
+
+static PyObject *_rlbidiLayout_new(PyTypeObject *type, PyObject *args, PyObject *kw){
+	PyObject			*u = NULL, *text, *decoded = NULL;
+	FriBidiParType		base = FRIBIDI_PAR_RTL;
+	int					clean = 1, reordernsm = 1, level;
+	const char			*encoding = "utf-8";
+	const rlbidiCharset	*cs = NULL;
+	FriBidiFlags		shape = RLBIDI_FLAGS & RLBIDI_SHAPE_MASK;
+	RLBIDI_SCRATCH(scratch);
+	rlbidiLayout		*self = NULL;
+	Py_ssize_t			length = -2, vlength;
+
+	static char *kwargs[] = { "logical", "base_direction", "clean", "reordernsm", "encoding", "shape", NULL };
+	if(!PyArg_ParseTupleAndKeywords(args, kw, "O|O&iizO&:BidiLayout", kwargs,
+				&u, _baseDirectionConverter, &base, &clean, &reordernsm, &encoding, _shapeConverter, &shape)) return NULL;
+	_statsStart(&scratch);
+	text = u;
+	if(PyUnicode_Check(u)) encoding = NULL;
+	else if(!PyBytes_Check(u))
+		return PyErr_Format(PyExc_TypeError, "BidiLayout argument logical must be str or bytes not %R", (PyObject*)Py_TYPE(u));
+	else if(!encoding){
+		PyErr_SetString(PyExc_TypeError, "BidiLayout needs an encoding for bytes");
+		return NULL;
 		}
-	if(levels){
-		for(i=0;i<length;i++){
-			if(!(obj = PyLong_FromLong((long)levels[i]))) goto cleanup;
-			r = PyList_Append(embedding_levels,obj);
-			Py_DecRef(obj);
-			if(r<0) goto cleanup;
+	else{
+		if((cs = _findCharset(encoding)) && (length = _readBytes(&scratch, u, cs))==-1) goto fail;
+		if(length>=0) text = NULL;
+		else{
+			cs = NULL;
+			if(!(text = decoded = PyUnicode_Decode(PyBytes_AsString(u), PyBytes_Size(u), encoding, "strict"))) goto fail;
 			}
 		}
+	if(text){
+		if((length = RLPYUNICODE_GETLENGTH(text))<0 || !_scratchEnsure(&scratch, length)
+			|| !(scratch.input = _readUnicode(text, length, scratch.logical))) goto fail;
+		}
+	if(length >= INT_MAX){
+		PyErr_SetString(PyExc_OverflowError, "string is too long to reorder");
+		goto fail;
+		}
+	level = _latin1Level(NULL, scratch.input, length, &base);
+	_statsPhase(&scratch, RLBIDI_PH_INPUT);
+	_statsString(&scratch, length, level>=0);
+	if(!(self = (rlbidiLayout*)PyType_GenericAlloc(type, 0))) goto fail;
+	if(level>=0){
+		if(length && scratch.visual!=scratch.input) memcpy(scratch.visual, scratch.input, length*sizeof(FriBidiChar));
+		_identityMaps(scratch.L_to_V, scratch.V_to_L, scratch.levels, length, level);
+		vlength = length;
+		}
+	else{
+		/* fribidi would leave levels and L_to_V in visual order and short */
+		if(_log2visScratch(&scratch, length, &base, RLBIDI_FLAGS_FOR(shape, reordernsm), 0, 1)<0) goto fail;
+		vlength = clean ? _layoutClean(&scratch, length) : length;
+		_statsPhase(&scratch, RLBIDI_PH_CLEAN);
+		}
+	self->length = length;
+	self->vlength = vlength;
+	self->base = base;
+	if(!(self->visual = _makeResult(scratch.visual, vlength, cs, encoding))
+		|| !(self->L_to_V = PyBytes_FromStringAndSize((const char*)scratch.L_to_V, length*sizeof(FriBidiStrIndex)))
+		|| !(self->V_to_L = PyBytes_FromStringAndSize((const char*)scratch.V_to_L, vlength*sizeof(FriBidiStrIndex)))
+		|| !(self->levels = PyBytes_FromStringAndSize((const char*)scratch.levels, length*sizeof(FriBidiLevel)))) goto fail;
+	_statsPhase(&scratch, RLBIDI_PH_OUTPUT);
+	_statsEnd(&scratch, "BidiLayout");
+	_scratchFree(&scratch);
+	Py_XDECREF(decoded);
+	return (PyObject*)self;
+fail:
+	_scratchFree(&scratch);
+	Py_XDECREF(decoded);
+	Py_XDECREF((PyObject*)self);
+	return NULL;
+	}
 
-cleanup:
-	/* Delete unicode buffers */
-	PyMem_Del(logical);
-	PyMem_Del(visual);
-	PyMem_Del(L_to_V);
-	PyMem_Del(V_to_L);
-	PyMem_Del(levels);
+static void _rlbidiLayout_dealloc(rlbidiLayout *self){
+	PyTypeObject *tp = Py_TYPE((PyObject*)self);
+	freefunc tp_free = (freefunc)PyType_GetSlot(tp, Py_tp_free);
+	Py_XDECREF(self->visual);
+	Py_XDECREF(self->L_to_V);
+	Py_XDECREF(self->V_to_L);
+	Py_XDECREF(self->levels);
+	free(self->runs.a);
+	PyMem_Del(self->byLogical);
+	tp_free(self);
+	Py_DecRef((PyObject*)tp);
+	}
 
-	return (PyObject *)result;
+#define RLBIDI_LAYOUT_INDEX(o, i) (((const FriBidiStrIndex*)PyBytes_AsString(o))[i])
+
+/* find the level runs as _levelRuns does, but from the final maps in
+   which removed marks have no visual offset; returns 0 with an exception
+   set when out of memory.
+*/
+static int _layoutRuns(rlbidiLayout *self){
+	const FriBidiStrIndex	*L_to_V = (const FriBidiStrIndex*)PyBytes_AsString(self->L_to_V);
+	const FriBidiStrIndex	*V_to_L = (const FriBidiStrIndex*)PyBytes_AsString(self->V_to_L);
+	const FriBidiLevel		*levels = (const FriBidiLevel*)PyBytes_AsString(self->levels);
+	rlbidiRuns				*r = &self->runs;
+	FriBidiStrIndex			*run = NULL, l, k, lo, hi, first = 0, last = 0;
+	FriBidiLevel			level = 0;
+	Py_ssize_t				v;
+	if(self->byLogical) return 1;
+	r->n = 0;
+	for(v=0; v<self->vlength; v++){
+		l = V_to_L[v];
+		if(run && levels[l]==level){
+			lo = level&1 ? l : last;
+			hi = level&1 ? last : l;
+			if(lo<hi){
+				for(k=lo+1; k<hi && L_to_V[k]<0; k++);
+				if(k==hi){
+					last = l;
+					continue;
+					}
+				}
+			}
+		if(run){
+			run[0] = level&1 ? last : first;
+			run[1] = (level&1 ? first : last) + 1;
+			}
+		if(r->n==r->size){
+			Py_ssize_t		size = r->size ? 2*r->size : 16;
+			FriBidiStrIndex	*a = (FriBidiStrIndex*)realloc(r->a, size*4*sizeof(FriBidiStrIndex));
+			if(!a){
+				PyErr_NoMemory();
+				return 0;
+				}
+			r->a = a;
+			r->size = size;
+			}
+		run = r->a + 4*r->n++;
+		run[2] = level = levels[l];
+		run[3] = (FriBidiStrIndex)v;
+		first = last = l;
+		}
+	if(run){
+		run[0] = level&1 ? last : first;
+		run[1] = (level&1 ? first : last) + 1;
+		}
+	if(!(self->byLogical = PyMem_New(FriBidiStrIndex, 2*r->n+1))){
+		PyErr_NoMemory();
+		return 0;
+		}
+	for(v=0; v<r->n; v++){
+		self->byLogical[2*v] = r->a[4*v];
+		self->byLogical[2*v+1] = (FriBidiStrIndex)v;
+		}
+	qsort(self->byLogical, r->n, 2*sizeof(FriBidiStrIndex), _cmpFirstIndex);
+	return 1;
+	}
+
+/* item i of a map of length n, which may be negative as for a list */
+static PyObject *_layoutMapItem(PyObject *map, Py_ssize_t n, PyObject *arg, const char *name){
+	Py_ssize_t	i = PyLong_AsSsize_t(arg), j = i;
+	if(i==-1 && PyErr_Occurred()) return NULL;
+	if(j<0) j += n;
+	if(j<0 || j>=n) return PyErr_Format(PyExc_IndexError, "%s: index %zd out of range for length %zd", name, i, n);
+	i = j;
+	return PyLong_FromLong((long)RLBIDI_LAYOUT_INDEX(map, i));
+	}
+
+static PyObject *_rlbidiLayout_to_visual(rlbidiLayout *self, PyObject *arg){
+	return _layoutMapItem(self->L_to_V, self->length, arg, "to_visual");
+	}
+static PyObject *_rlbidiLayout_to_logical(rlbidiLayout *self, PyObject *arg){
+	return _layoutMapItem(self->V_to_L, self->vlength, arg, "to_logical");
+	}
+
+static PyObject *_rlbidiLayout_visual_spans(rlbidiLayout *self, PyObject *args){
+	Py_ssize_t				start, end, lo, hi, mid, n = 0, k;
+	const FriBidiStrIndex	*L_to_V = (const FriBidiStrIndex*)PyBytes_AsString(self->L_to_V), *run;
+	FriBidiStrIndex			a, b, *spans = NULL;
+	PyObject				*L = NULL, *t;
+
+	if(!PyArg_ParseTuple(args, "nn:visual_spans", &start, &end)) return NULL;
+	/* clamp as a slice would be */
+	if(start<0 && (start += self->length)<0) start = 0;
+	if(end<0 && (end += self->length)<0) end = 0;
+	if(end>self->length) end = self->length;
+	if(start>=end) return PyList_New(0);
+	if(!_layoutRuns(self)) return NULL;
+
+	/* the first run by logical start which ends after start */
+	lo = 0;
+	hi = self->runs.n;
+	while(lo<hi){
+		mid = (lo+hi)/2;
+		if(self->runs.a[4*self->byLogical[2*mid+1]+1] <= start) lo = mid+1;
+		else hi = mid;
+		}
+	for(k=lo; k<self->runs.n && self->byLogical[2*k]<end; k++);
+	if(!(spans = PyMem_New(FriBidiStrIndex, 2*(k-lo)+1))) return PyErr_NoMemory();
+
+	/* within a run the kept characters are visually consecutive */
+	for(; lo<k; lo++){
+		run = self->runs.a + 4*self->byLogical[2*lo+1];
+		a = run[0]>start ? run[0] : (FriBidiStrIndex)start;
+		b = run[1]<end ? run[1] : (FriBidiStrIndex)end;
+		while(a<b && L_to_V[a]<0) a++;
+		while(a<b && L_to_V[b-1]<0) b--;
+		if(a==b) continue;
+		spans[2*n] = run[2]&1 ? L_to_V[b-1] : L_to_V[a];
+		spans[2*n+1] = (run[2]&1 ? L_to_V[a] : L_to_V[b-1]) + 1;
+		n++;
+		}
+	qsort(spans, n, 2*sizeof(FriBidiStrIndex), _cmpFirstIndex);
+	for(lo=k=0; lo<n; lo++){
+		if(k && spans[2*k-1]==spans[2*lo]) spans[2*k-1] = spans[2*lo+1];
+		else{
+			spans[2*k] = spans[2*lo];
+			spans[2*k+1] = spans[2*lo+1];
+			k++;
+			}
+		}
+	if(!(L = PyList_New(k))) goto done;
+	for(lo=0; lo<k; lo++){
+		if(!(t = Py_BuildValue("(ii)", (int)spans[2*lo], (int)spans[2*lo+1]))){
+			Py_DecRef(L);
+			L = NULL;
+			goto done;
+			}
+		PyList_SetItem(L, lo, t);
+		}
+done:
+	PyMem_Del(spans);
+	return L;
+	}
+
+static PyObject *_rlbidiLayout_get_visual(rlbidiLayout *self, void *closure){
+	Py_IncRef(self->visual);
+	return self->visual;
+	}
+static PyObject *_rlbidiLayout_get_base_direction(rlbidiLayout *self, void *closure){
+	return PyLong_FromLong((long)self->base);
+	}
+static PyObject *_rlbidiLayout_get_runs(rlbidiLayout *self, void *closure){
+	PyObject *L;
+	if(!_layoutRuns(self)) return NULL;
+	L = PyList_New(0);
+	if(L && !_storeRuns(L, &self->runs)){
+		Py_DecRef(L);
+		return NULL;
+		}
+	return L;
+	}
+/* the names of the maps and their memoryview formats */
+static const char *_layoutMapNames[] = {"positions_L_to_V", "positions_V_to_L", "embedding_levels", NULL};
+static const char *_layoutMapFormats[] = {"i", "i", "b"};
+static PyObject *_layoutMapBytes(rlbidiLayout *self, int m){
+	return m==0 ? self->L_to_V : m==1 ? self->V_to_L : self->levels;
+	}
+static PyObject *_rlbidiLayout_get_map(rlbidiLayout *self, void *closure){
+	int			m = (int)(size_t)closure;
+	PyObject	*b = _layoutMapBytes(self, m);
+	if(m==2) return _makeLevelList((const FriBidiLevel*)PyBytes_AsString(b), PyBytes_Size(b)/sizeof(FriBidiLevel));
+	return _makeIndexList((const FriBidiStrIndex*)PyBytes_AsString(b), PyBytes_Size(b)/sizeof(FriBidiStrIndex));
+	}
+static PyObject *_rlbidiLayout_view(rlbidiLayout *self, PyObject *args){
+	const char	*name;
+	PyObject	*mv, *r;
+	int			m;
+	if(!PyArg_ParseTuple(args, "s:view", &name)) return NULL;
+	for(m=0; _layoutMapNames[m] && strcmp(name, _layoutMapNames[m]); m++);
+	if(!_layoutMapNames[m]) return PyErr_Format(PyExc_ValueError, "view: unknown map %s", name);
+	if(!(mv = PyMemoryView_FromObject(_layoutMapBytes(self, m)))) return NULL;
+	r = PyObject_CallMethod(mv, "cast", "s", _layoutMapFormats[m]);
+	Py_DecRef(mv);
+	return r;
+	}
+static Py_ssize_t _rlbidiLayout_length(rlbidiLayout *self){
+	return self->length;
+	}
+
+static PyMethodDef rlbidiLayout_methods[] = {
+	{"to_visual", (PyCFunction)_rlbidiLayout_to_visual, METH_O,
+		"to_visual(i)\n"
+		"the visual offset of logical character i or -1 if clean removed it."},
+	{"to_logical", (PyCFunction)_rlbidiLayout_to_logical, METH_O,
+		"to_logical(j)\n"
+		"the logical offset of visual character j."},
+	{"visual_spans", (PyCFunction)_rlbidiLayout_visual_spans, METH_VARARGS,
+		"visual_spans(start, end)\n"
+		"the fewest (visual_start, visual_end) ranges, in visual order, which\n"
+		"hold the characters of the logical range [start, end); start and end\n"
+		"are treated as slice bounds."},
+	{"view", (PyCFunction)_rlbidiLayout_view, METH_VARARGS,
+		"view(name)\n"
+		"a read only memoryview of the map called name, one of positions_L_to_V,\n"
+		"positions_V_to_L or embedding_levels, without copying it."},
+	{NULL, NULL, 0, NULL}
+	};
+static PyGetSetDef rlbidiLayout_getset[] = {
+	{"visual", (getter)_rlbidiLayout_get_visual, NULL, "the visual text, as log2vis returns it", NULL},
+	{"base_direction", (getter)_rlbidiLayout_get_base_direction, NULL, "the resolved paragraph direction, LTR or RTL", NULL},
+	{"runs", (getter)_rlbidiLayout_get_runs, NULL, "list of (logical_start, logical_end, level, visual_start) level runs", NULL},
+	{"positions_L_to_V", (getter)_rlbidiLayout_get_map, NULL, "new list of the visual offset of each logical character", (void*)0},
+	{"positions_V_to_L", (getter)_rlbidiLayout_get_map, NULL, "new list of the logical offset of each visual character", (void*)1},
+	{"embedding_levels", (getter)_rlbidiLayout_get_map, NULL, "new list of the level of each logical character", (void*)2},
+	{NULL, NULL, NULL, NULL, NULL}
+	};
+static PyType_Slot rlbidiLayout_slots[] = {
+	{Py_tp_doc, "BidiLayout(logical, base_direction=RTL, clean=True, reordernsm=True, encoding='utf-8', shape=True)\n"
+				"reorder logical as log2vis does and keep the maps between logical and\n"
+				"visual offsets for to_visual, to_logical and visual_spans and as lists\n"
+				"or memoryviews when asked for; len() is the number of logical characters."},
+	{Py_tp_new, _rlbidiLayout_new},
+	{Py_tp_dealloc, _rlbidiLayout_dealloc},
+	{Py_tp_methods, rlbidiLayout_methods},
+	{Py_tp_getset, rlbidiLayout_getset},
+	{Py_sq_length, _rlbidiLayout_length},
+	{0, NULL}
+	};
+static PyType_Spec rlbidiLayout_spec = {
+	"rlbidi._rlbidi.BidiLayout",
+	sizeof(rlbidiLayout),
+	0,
+	Py_TPFLAGS_DEFAULT,
+	rlbidiLayout_slots
+	};
+
+static PyObject *_rlbidi_stats(PyObject *self, PyObject *unused){
+	PyObject	*d, *v;
+	int			i, r = 0;
+	if(!(d = PyDict_New())) return NULL;
+#define RLBIDI_STAT(name, expr) \
+	if(!r){ \
+		if((v = (expr))){ \
+			r = PyDict_SetItemString(d, name, v); \
+			Py_DecRef(v); \
+			} \
+		else r = -1; \
+		}
+	RLBIDI_STAT("enabled", PyBool_FromLong(_stats.enabled));
+	RLBIDI_STAT("calls", PyLong_FromUnsignedLongLong(_stats.calls));
+	RLBIDI_STAT("strings", PyLong_FromUnsignedLongLong(_stats.strings));
+	RLBIDI_STAT("fast", PyLong_FromUnsignedLongLong(_stats.fast));
+	RLBIDI_STAT("chars", PyLong_FromUnsignedLongLong(_stats.chars));
+	RLBIDI_STAT("max_length", PyLong_FromUnsignedLongLong(_stats.max_length));
+	RLBIDI_STAT("bytes_allocated", PyLong_FromUnsignedLongLong(_stats.bytes_allocated));
+	for(i=0; i<RLBIDI_NPHASES; i++){
+		RLBIDI_STAT(_phaseNames[i], PyLong_FromUnsignedLongLong(_stats.ns[i]));
+		}
+	RLBIDI_STAT("slow_threshold", PyFloat_FromDouble((double)_stats.slow_ns/1e9));
+#undef RLBIDI_STAT
+	if(!r) r = PyDict_SetItemString(d, "slow_callback", _stats.slow_callback ? _stats.slow_callback : Py_None);
+	if(r){
+		Py_DecRef(d);
+		return NULL;
+		}
+	return d;
+	}
+
+static PyObject *_rlbidi_reset_stats(PyObject *self, PyObject *unused){
+	_stats.calls = _stats.strings = _stats.fast = _stats.chars = _stats.max_length = _stats.bytes_allocated = 0;
+	memset(_stats.ns, 0, sizeof(_stats.ns));
+	_arena.requests = _arena.stack = _arena.reuses = _arena.allocations = _arena.releases = 0;
+	Py_RETURN_NONE;
+	}
+
+static PyObject *_rlbidi_arena_stats(PyObject *self, PyObject *unused){
+	PyObject			*d, *v;
+	int					i, r = 0;
+	unsigned long long	bytes = 0;
+	if(!(d = PyDict_New())) return NULL;
+	for(i=0; i<_arena.n; i++) bytes += (unsigned long long)(_arena.sizes[i]*RLBIDI_SCRATCH_PERCHAR);
+#define RLBIDI_STAT(name, expr) \
+	if(!r){ \
+		if((v = (expr))){ \
+			r = PyDict_SetItemString(d, name, v); \
+			Py_DecRef(v); \
+			} \
+		else r = -1; \
+		}
+	RLBIDI_STAT("enabled", PyBool_FromLong(_arena.enabled));
+	RLBIDI_STAT("blocks", PyLong_FromLong((long)_arena.n));
+	RLBIDI_STAT("bytes", PyLong_FromUnsignedLongLong(bytes));
+	RLBIDI_STAT("high_water", PyLong_FromSsize_t(_arena.high_water));
+	RLBIDI_STAT("requests", PyLong_FromUnsignedLongLong(_arena.requests));
+	RLBIDI_STAT("stack", PyLong_FromUnsignedLongLong(_arena.stack));
+	RLBIDI_STAT("reuses", PyLong_FromUnsignedLongLong(_arena.reuses));
+	RLBIDI_STAT("allocations", PyLong_FromUnsignedLongLong(_arena.allocations));
+	RLBIDI_STAT("releases", PyLong_FromUnsignedLongLong(_arena.releases));
+	RLBIDI_STAT("reuse_rate", PyFloat_FromDouble(_arena.requests ? (double)(_arena.stack+_arena.reuses)/_arena.requests : 0.0));
+#undef RLBIDI_STAT
+	if(r){
+		Py_DecRef(d);
+		return NULL;
+		}
+	return d;
+	}
+
+static PyObject *_rlbidi_enable_arena(PyObject *self, PyObject *unused){
+	_arena.enabled = 1;
+	Py_RETURN_NONE;
+	}
+
+static PyObject *_rlbidi_disable_arena(PyObject *self, PyObject *unused){
+	_arenaTrim(1);
+	_arena.enabled = 0;
+	Py_RETURN_NONE;
+	}
+
+static PyObject *_rlbidi_enable_stats(PyObject *self, PyObject *args, PyObject *kw){
+	PyObject	*cb = Py_None, *old;
+	double		threshold = 0.0;
+	static char *kwargs[] = { "slow_callback", "slow_threshold", NULL };
+	if(!PyArg_ParseTupleAndKeywords(args, kw, "|Od:enable_stats", kwargs, &cb, &threshold)) return NULL;
+	if(cb!=Py_None && !PyCallable_Check(cb)) return PyErr_Format(PyExc_TypeError, "enable_stats: slow_callback must be callable or None");
+	if(!(threshold>=0.0 && threshold<1e9)){
+		PyErr_SetString(PyExc_ValueError, "enable_stats: slow_threshold must be a non-negative number of seconds");
+		return NULL;
+		}
+	old = _stats.slow_callback;
+	if(cb==Py_None) _stats.slow_callback = NULL;
+	else{
+		Py_IncRef(cb);
+		_stats.slow_callback = cb;
+		}
+	_stats.slow_ns = (unsigned long long)(threshold*1e9);
+	_stats.enabled = 1;
+	Py_XDECREF(old);
+	Py_RETURN_NONE;
+	}
+
+static PyObject *_rlbidi_disable_stats(PyObject *self, PyObject *unused){
+	PyObject	*old = _stats.slow_callback;
+	_stats.enabled = 0;
+	_stats.slow_callback = NULL;
+	Py_XDECREF(old);
+	Py_RETURN_NONE;
 	}
 
 static PyMethodDef rlbidiMethods[] = {
 	{"log2vis", (PyCFunction) _rlbidi_log2vis, METH_VARARGS | METH_KEYWORDS, NULL},
+	{"log2vis_many", (PyCFunction) _rlbidi_log2vis_many, METH_VARARGS | METH_KEYWORDS, NULL},
+	{"log2vis_ragged", (PyCFunction) _rlbidi_log2vis_ragged, METH_VARARGS | METH_KEYWORDS, NULL},
+	{"has_rtl", (PyCFunction) _rlbidi_has_rtl, METH_O,
+		"has_rtl(text) -> True if text has a character which can make it need reordering;\n"
+		"text may also be an iterable of str giving a list"},
+	{"bidi_types", (PyCFunction) _rlbidi_bidi_types, METH_O,
+		"bidi_types(text) -> bytes of the index in BIDI_TYPE_NAMES of each character's bidi type;\n"
+		"text may also be an iterable of str giving a list"},
+	{"par_direction", (PyCFunction) _rlbidi_par_direction, METH_O,
+		"par_direction(text) -> LTR, RTL or ON from the first strong character outside isolates;\n"
+		"text may also be an iterable of str giving a list"},
+	{"stats", (PyCFunction) _rlbidi_stats, METH_NOARGS,
+		"stats() -> dict of the counters and per phase nanoseconds collected while enabled"},
+	{"reset_stats", (PyCFunction) _rlbidi_reset_stats, METH_NOARGS,
+		"reset_stats()\nzero the counters and timers"},
+	{"enable_stats", (PyCFunction) _rlbidi_enable_stats, METH_VARARGS | METH_KEYWORDS,
+		"enable_stats(slow_callback=None, slow_threshold=0.0)\n"
+		"start collecting statistics; if given slow_callback(name, chars, seconds) is\n"
+		"called after each call which took at least slow_threshold seconds"},
+	{"disable_stats", (PyCFunction) _rlbidi_disable_stats, METH_NOARGS,
+		"disable_stats()\nstop collecting statistics; the counters are kept"},
+	{"arena_stats", (PyCFunction) _rlbidi_arena_stats, METH_NOARGS,
+		"arena_stats() -> dict of the kept scratch blocks and how the working storage of\n"
+		"calls was found: on the stack, reused from the arena or newly allocated"},
+	{"enable_arena", (PyCFunction) _rlbidi_enable_arena, METH_NOARGS,
+		"enable_arena()\nkeep scratch blocks for reuse and use the stack for short strings (the default)"},
+	{"disable_arena", (PyCFunction) _rlbidi_disable_arena, METH_NOARGS,
+		"disable_arena()\nfree the kept blocks and allocate working storage for every call"},
 	{NULL, NULL, 0, NULL}
 	};
 
@@ -191,7 +2723,9 @@ static struct PyModuleDef moduledef={
 	};
 
 PyMODINIT_FUNC PyInit__rlbidi(void){
-	PyObject *module=NULL;
+	PyObject *module=NULL, *type=NULL, *names=NULL;
+	Py_ssize_t i;
+	_initLatin1Class();
 	module = PyModule_Create(&moduledef);
 	if(!module) goto err;
 	if(		PyModule_AddIntConstant(module, "RTL", (long)FRIBIDI_TYPE_RTL)
@@ -199,14 +2733,37 @@ PyMODINIT_FUNC PyInit__rlbidi(void){
 		||	PyModule_AddIntConstant(module, "ON", (long)FRIBIDI_TYPE_ON)
 		||	PyModule_AddIntConstant(module, "WLTR", (long)FRIBIDI_PAR_WLTR)
 		||	PyModule_AddIntConstant(module, "WRTL", (long)FRIBIDI_PAR_WRTL)
+		||	PyModule_AddIntConstant(module, "SHAPE_MIRRORING", (long)FRIBIDI_FLAG_SHAPE_MIRRORING)
+		||	PyModule_AddIntConstant(module, "SHAPE_ARAB_PRES", (long)FRIBIDI_FLAG_SHAPE_ARAB_PRES)
+		||	PyModule_AddIntConstant(module, "SHAPE_ARAB_LIGA", (long)FRIBIDI_FLAG_SHAPE_ARAB_LIGA)
+		||	PyModule_AddIntConstant(module, "SHAPE_ARAB_CONSOLE", (long)FRIBIDI_FLAG_SHAPE_ARAB_CONSOLE)
+		||	PyModule_AddIntConstant(module, "SHAPE_ARABIC", (long)FRIBIDI_FLAGS_ARABIC)
 		||	PyModule_AddStringConstant(module, "rlbidiVersion", (const char *)STRINGIFY(RLBIDI_VERSION))
 		||	PyModule_AddStringConstant(module, "fribidiVersion", (const char *)FRIBIDI_VERSION)
 		||	PyModule_AddStringConstant(module, "fribidiInterfaceVersion", (const char *)FRIBIDI_INTERFACE_VERSION_STRING)
 		||	PyModule_AddStringConstant(module, "fribidiUnicodeVersion", (const char *)FRIBIDI_UNICODE_VERSION)
+#ifdef Py_LIMITED_API
+		||	PyModule_AddIntConstant(module, "limitedAPI", (long)Py_LIMITED_API)
+#else
+		||	PyModule_AddIntConstant(module, "limitedAPI", 0L)
+#endif
 		)
 		goto err;
+	if(!(type = PyType_FromSpec(&rlbidiParagraph_spec)) || PyModule_AddObject(module, "BidiParagraph", type)) goto err;
+	if(!(type = PyType_FromSpec(&rlbidiReorderer_spec)) || PyModule_AddObject(module, "Reorderer", type)) goto err;
+	if(!(type = PyType_FromSpec(&rlbidiLayout_spec)) || PyModule_AddObject(module, "BidiLayout", type)) goto err;
+	type = NULL;
+	if(!(names = PyTuple_New(sizeof(_bidiTypes)/sizeof(_bidiTypes[0])-1))) goto err;
+	for(i=0; _bidiTypes[i].name; i++){
+		PyObject *name = PyUnicode_FromString(_bidiTypes[i].name);
+		if(!name) goto err;
+		PyTuple_SetItem(names, i, name);
+		}
+	if(PyModule_AddObject(module, "BIDI_TYPE_NAMES", names)) goto err;
 	return module;
 err:/*Check for errors*/
+	Py_XDECREF(type);
+	Py_XDECREF(names);
 	Py_XDECREF(module);
 	return NULL;
 	}
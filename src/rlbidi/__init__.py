@@ -4,45 +4,363 @@ rlbidi uses libfribidi to order text visually using the unicode
 algorithm. rlbidi can also convert text from visual order to
 logical order, but the conversion may be wrong in certain cases.
 """
-__version__ = '0.1.1'
-__all__ = ('log2vis', 'LTR', 'ON', 'RTL', 'WLTR', 'WRTL',
+__version__ = '0.2.0'
+__all__ = ('log2vis', 'log2vis_ex', 'log2vis_many', 'log2vis_iter', 'log2vis_ragged', 'BidiParagraph', 'Reorderer', 'BidiLayout', 'LTR', 'ON', 'RTL', 'WLTR', 'WRTL',
            'rlbidiVersion', 'fribidiVersion', 'fribidiInterfaceVersion',
-           'fribidiUnicodeVersion', '_log2vis', 'bidiDirMap',
-           'bidiWordList')
-from . _rlbidi import LTR, ON, RTL, WLTR, WRTL, rlbidiVersion, fribidiVersion, \
-        fribidiInterfaceVersion, fribidiUnicodeVersion, log2vis as _log2vis
+           'fribidiUnicodeVersion', 'limitedAPI', '_log2vis', 'bidiDirMap',
+           'bidiWordList', '_log2vis_many', 'enable_cache', 'disable_cache',
+           'cache_info', 'cache_clear', 'CacheInfo', 'stats', 'reset_stats', 'enable_stats',
+           'disable_stats', 'arena_stats', 'enable_arena', 'disable_arena',
+           'SHAPE_MIRRORING', 'SHAPE_ARAB_PRES', 'SHAPE_ARAB_LIGA', 'SHAPE_ARAB_CONSOLE',
+           'SHAPE_ARABIC', 'has_rtl', 'bidi_types', 'par_direction', 'BIDI_TYPE_NAMES')
+from . _rlbidi import LTR, ON, RTL, WLTR, WRTL, BidiParagraph, Reorderer, BidiLayout, rlbidiVersion, fribidiVersion, \
+        fribidiInterfaceVersion, fribidiUnicodeVersion, limitedAPI, log2vis as _log2vis, log2vis_many as _log2vis_many, \
+        log2vis_ragged as _log2vis_ragged, \
+        stats, reset_stats, enable_stats, disable_stats, arena_stats, enable_arena, disable_arena, \
+        SHAPE_MIRRORING, SHAPE_ARAB_PRES, SHAPE_ARAB_LIGA, SHAPE_ARAB_CONSOLE, SHAPE_ARABIC, \
+        has_rtl, bidi_types, par_direction, BIDI_TYPE_NAMES
+from threading import Lock
+from collections import OrderedDict, namedtuple
+import os, re, codecs, itertools
 bidiDirMap = dict(LTR=LTR, ON=ON, RTL=RTL, WLTR=WLTR, WRTL=WRTL)
+_SHAPE_DEFAULT = SHAPE_MIRRORING | SHAPE_ARABIC     # what shape=True means
 
 assert __version__==rlbidiVersion, "Non matching version rlbidi=%s!= _rlbidi=%s" % (__version__,rlbidiVersion)
 
+def _baseDirection(base_direction):
+    if isinstance(base_direction,str):
+        _ = bidiDirMap.get(base_direction.upper(),None)
+        if _ is None:
+            raise ValueError(f'argument base_direction={base_direction} is invalid; should be one of ({", ".join(bidiDirMap.keys())})')
+        return _
+    return base_direction
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses bypasses maxsize currsize max_chars currchars')
+
+class _LRUCache:
+    '''thread safe least recently used cache of log2vis results bounded
+    by the number of entries and by their total characters'''
+    def __init__(self, maxsize, max_chars):
+        self.maxsize = maxsize
+        self.max_chars = max_chars
+        self.lock = Lock()
+        self.data = OrderedDict()
+        self.chars = 0
+        self.hits = self.misses = self.bypasses = 0
+
+    def get(self, key):
+        with self.lock:
+            res = self.data.get(key)
+            if res is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.data.move_to_end(key)
+            return res
+
+    def bypass(self):
+        with self.lock:
+            self.bypasses += 1
+
+    def put(self, key, res):
+        n = len(key[0]) + len(res)
+        if n > self.max_chars: return
+        with self.lock:
+            if key in self.data: return
+            self.data[key] = res
+            self.chars += n
+            while len(self.data) > self.maxsize or self.chars > self.max_chars:
+                k, r = self.data.popitem(last=False)
+                self.chars -= len(k[0]) + len(r)
+
+    def info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.bypasses, self.maxsize, len(self.data),
+                                self.max_chars, self.chars)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.chars = 0
+            self.hits = self.misses = self.bypasses = 0
+
+_cache = None
+
+def enable_cache(maxsize=1024, max_chars=1<<20):
+    """
+    Cache the results of log2vis for repeated strings. At most maxsize
+    results are kept and the total length of the cached inputs and
+    results is at most max_chars; the least recently used are evicted.
+    Calls which ask for positions_L_to_V, positions_V_to_L or
+    embedding_levels always bypass the cache. Enabling again replaces
+    the cache with an empty one.
+    """
+    global _cache
+    if maxsize<1 or max_chars<1:
+        raise ValueError(f'enable_cache: maxsize={maxsize} and max_chars={max_chars} must both be positive')
+    _cache = _LRUCache(maxsize, max_chars)
+
+def disable_cache():
+    """stop caching log2vis results and discard the cache"""
+    global _cache
+    _cache = None
+
+def cache_info():
+    """return a CacheInfo named tuple with the cache statistics or None if the cache is disabled"""
+    cache = _cache
+    return cache.info() if cache else None
+
+def cache_clear():
+    """empty the cache and reset its statistics"""
+    cache = _cache
+    if cache: cache.clear()
+
 def log2vis(logical, base_direction=RTL, encoding="utf-8", clean=True, reordernsm=True,
-                        positions_L_to_V=None, positions_V_to_L=None, embedding_levels=None):
+                        positions_L_to_V=None, positions_V_to_L=None, embedding_levels=None, shape=True, runs=None):
     """
     Return string reordered visually according to base direction.
     Return the same type of input string, either str or bytes using
     encoding.
 
     Note that this function does not handle line breaking. You should
-    call log2vis with each line.
+    call log2vis with each line, or use BidiParagraph to resolve a whole
+    paragraph once and then reorder each of its lines.
 
     Arguments:
     - logical: str or encoded bytes
     - base_direction: optional logical base direction. Accepts one of
       the constants LTR, RTL or ON, defined in this module. ON calculate
       the base direction according to the BiDi algorithm.
-    - encoding: optional string encoding (ignored for str input)
+    - encoding: optional string encoding (ignored for str input).
+      utf-8 and the hebrew and arabic charsets iso8859-8, cp1255,
+      iso8859-6 and cp1256 are converted without making a str.
+    - positions_L_to_V, positions_V_to_L, embedding_levels: optional
+      outputs. Either a list, whose contents are replaced, or a writable
+      buffer of integers with at least len(logical) items, eg array('i'),
+      array('B') or bytearray for the levels, or a numpy array. Only the
+      first len(result) items of a buffer are meaningful.
+    - shape: optional shaping done with the reordering. True mirrors
+      brackets etc in RTL runs and gives arabic presentation forms with
+      ligatures, False does neither and leaves the characters as they
+      are; otherwise an or of the SHAPE_ constants.
+    - runs: optional list whose contents are replaced by the level runs,
+      tuples (logical_start, logical_end, level, visual_start) in visual
+      order, each covering logical[logical_start:logical_end] which is
+      shown reversed when level is odd. With clean the visual starts are
+      those of the result and a run may include removed marks.
     """
-    if isinstance(base_direction,str):
-        _ = bidiDirMap.get(base_direction.upper(),None)
-        if _ is None:
-            raise ValueError(f'argument base_direction={base_direction} is invalid; should be one of ({", ".join(bidiDirMap.keys())})')
+    base_direction = _baseDirection(base_direction)
+    cache = _cache
+    key = None
+    if cache and type(logical) in (str,bytes):
+        if positions_L_to_V is None and positions_V_to_L is None and embedding_levels is None and runs is None:
+            key = (logical, base_direction, bool(clean), bool(reordernsm), None if type(logical) is str else encoding,
+                    _SHAPE_DEFAULT if shape is True else 0 if shape is False else shape)
+            res = cache.get(key)
+            if res is not None: return res
         else:
-            base_direction = _
-    if not isinstance(logical, str):
-        logical = str(logical, encoding)
-    else:
+            cache.bypass()
+    encode = None
+    if isinstance(logical, str):
         encoding = None
+    elif type(logical) is not bytes or not encoding:
+        logical = str(logical, encoding)
+        encode, encoding = encoding, None
     res = _log2vis(logical, base_direction=base_direction, clean=clean, reordernsm=reordernsm,
                         positions_L_to_V=positions_L_to_V, positions_V_to_L=positions_V_to_L,
-                        embedding_levels=embedding_levels)
-    return res.encode(encoding) if encoding else res
+                        embedding_levels=embedding_levels, encoding=encoding, shape=shape, runs=runs)
+    if encode: res = res.encode(encode)
+    if key: cache.put(key, res)
+    return res
+
+def log2vis_ex(logical, base_direction=RTL, encoding="utf-8", clean=True, reordernsm=True, shape=True):
+    """
+    Return a BidiLayout holding logical reordered visually as log2vis
+    does, in its visual attribute, with the resolved base direction and
+    the maps, which are only made into python objects when used.
+
+    The positions_L_to_V, positions_V_to_L and embedding_levels
+    attributes are new lists and view(name) gives a memoryview of a map
+    without copying it. The positions are offsets into logical and the
+    visual text; with clean the removed marks have positions_L_to_V -1
+    and the levels are in logical order for all of logical.
+
+    Arguments:
+    - logical, base_direction, encoding, clean, reordernsm & shape: as
+      for log2vis
+    """
+    return BidiLayout(logical, _baseDirection(base_direction), clean, reordernsm, encoding, shape)
+
+def log2vis_many(lines, base_direction=RTL, encoding="utf-8", clean=True, reordernsm=True, maps=False, shape=True):
+    """
+    Return a list of the lines reordered visually according to base
+    direction; each result has the same type as its input line.
+
+    This is equivalent to [log2vis(l,...) for l in lines], but the whole
+    iterable is processed in a single C call which reuses its working
+    buffers.
+
+    Arguments:
+    - lines: iterable of str or encoded bytes
+    - base_direction, encoding, clean, reordernsm & shape: as for log2vis
+    - maps: if true each result is a tuple
+      (visual, positions_L_to_V, positions_V_to_L, embedding_levels)
+    """
+    return _log2vis_many(lines, base_direction=_baseDirection(base_direction), clean=clean,
+                        reordernsm=reordernsm, encoding=encoding, maps=maps, shape=shape)
+
+def log2vis_ragged(codepoints, offsets, visual=None, positions_L_to_V=None, positions_V_to_L=None,
+                    embedding_levels=None, lengths=None, base_direction=RTL, clean=False, reordernsm=True, shape=True):
+    """
+    Reorder a ragged batch of rows of codepoints visually according to
+    base direction without making a python object per row; row i is
+    codepoints[offsets[i]:offsets[i+1]]. The results for each row are
+    written at the same offsets of the flat outputs, the positions being
+    relative to the start of the row. Nothing is returned.
+
+    Arguments:
+    - codepoints: a contiguous buffer of integers, eg array('I') or a
+      numpy uint32 array
+    - offsets: a buffer of len(rows)+1 non-decreasing integers
+    - visual: optional output for the visual codepoints
+    - positions_L_to_V, positions_V_to_L, embedding_levels: optional
+      outputs as for log2vis, but with room for offsets[-1] items
+    - lengths: optional output of the length of each visual row
+    - base_direction, reordernsm & shape: as for log2vis
+    - clean: if true the bidi marks are removed, which shortens rows so
+      lengths is needed; the rest of a shortened row is filled with 0
+      in visual and -1 in positions_V_to_L and embedding_levels
+
+    The outputs may be lists, whose contents are replaced, or writable
+    buffers of integers, eg array('I') for visual, array('i') for the
+    positions and bytearray or a numpy uint8 array for the levels.
+    """
+    _log2vis_ragged(codepoints, offsets, visual, positions_L_to_V, positions_V_to_L, embedding_levels,
+                    lengths, base_direction=_baseDirection(base_direction), clean=clean, reordernsm=reordernsm,
+                    shape=shape)
+
+# paragraph separators, the characters of bidi class B; \r\n is one separator
+_parSeps = '\n\r\x1c\x1d\x1e\x85\u2029'
+_parSepRes = {}
+
+def _parSepRe(encoding):
+    '''the compiled paragraph separator pattern for str (encoding None) or
+    for bytes in encoding; None if such bytes can't safely be split'''
+    try:
+        return _parSepRes[encoding]
+    except KeyError:
+        pass
+    if encoding is None:
+        r = re.compile('\r\n|[%s]' % _parSeps)
+    else:
+        name = codecs.lookup(encoding).name
+        if name in ('utf-8', 'ascii', 'latin-1') or name.startswith(('iso8859-', 'cp125')):
+            seps = []
+            for c in _parSeps:
+                try:
+                    seps.append(re.escape(c.encode(encoding)))
+                except UnicodeError:
+                    pass
+            r = re.compile(b'\r\n|' + b'|'.join(seps))
+        else:
+            r = None
+    _parSepRes[encoding] = r
+    return r
+
+def _paragraphs(chunks, sepRe):
+    '''yield (paragraph, separator) pairs from chunks of text which may
+    split paragraphs anywhere; the last separator may be empty'''
+    pending = None
+    for chunk in chunks:
+        if pending is None: pending = chunk[:0]
+        data = pending + chunk if pending else chunk
+        start = 0
+        for m in sepRe.finditer(data):
+            end = m.end()
+            if end==len(data) and data[-1:] in ('\r', b'\r'):
+                break   # may be the first half of \r\n
+            yield data[start:m.start()], m.group()
+            start = end
+        pending = data[start:]
+    if pending:
+        if pending[-1:] in ('\r', b'\r'):
+            yield pending[:-1], pending[-1:]
+        else:
+            yield pending, pending[:0]
+
+def _decodeChunks(chunks, encoding):
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for chunk in chunks:
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', True)
+
+def _mmapChunks(source):
+    '''yield a read only mmap of a file name or a binary file'''
+    import mmap
+    f = open(source, 'rb') if isinstance(source, (str, bytes, os.PathLike)) else None
+    try:
+        fd = (f or source).fileno()
+        if os.fstat(fd).st_size:
+            m = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            try:
+                yield m
+            finally:
+                m.close()
+    finally:
+        if f: f.close()
+
+def log2vis_iter(source, base_direction=RTL, encoding="utf-8", clean=True, reordernsm=True,
+                    keepends=True, mmap=False, batch=64, shape=True):
+    """
+    Generate the paragraphs of source reordered visually according to
+    base direction. Paragraphs end at the bidi paragraph separators
+    (\\n, \\r, \\r\\n, \\x1c-\\x1e, \\x85 and \\u2029) and are read lazily so
+    only one batch of them is in memory at a time; each batch is
+    reordered with one call of log2vis_many.
+
+    Arguments:
+    - source: a str or bytes, or an iterable of them such as a file,
+      which may split paragraphs anywhere. With mmap true it is the name
+      of a file or a binary file which is memory mapped instead of read
+      and bytes are generated.
+    - base_direction, encoding, clean, reordernsm & shape: as for log2vis
+    - keepends: if true each paragraph is followed by its separator
+    - batch: the number of paragraphs reordered together
+    """
+    base_direction = _baseDirection(base_direction)
+    if mmap:
+        chunks = _mmapChunks(source)
+        sepRe = _parSepRe(encoding)
+        if sepRe is None:
+            raise ValueError(f'log2vis_iter: mmap=True needs an ascii compatible encoding not {encoding!r}')
+    else:
+        chunks = iter((source,) if isinstance(source, (str, bytes)) else source)
+        first = next(chunks, None)
+        if first is None: return
+        chunks = itertools.chain((first,), chunks)
+        if isinstance(first, str):
+            sepRe = _parSepRe(None)
+        else:
+            sepRe = _parSepRe(encoding)
+            if sepRe is None:
+                # split the decoded text and encode each result
+                for r in log2vis_iter(_decodeChunks(chunks, encoding), base_direction, clean=clean, reordernsm=reordernsm,
+                                        keepends=keepends, batch=batch, shape=shape):
+                    yield r.encode(encoding)
+                return
+    texts = []
+    seps = []
+    paragraphs = _paragraphs(chunks, sepRe)
+    while True:
+        for text, sep in itertools.islice(paragraphs, batch):
+            texts.append(text)
+            seps.append(sep)
+        if not texts: break
+        results = _log2vis_many(texts, base_direction=base_direction, clean=clean,
+                                    reordernsm=reordernsm, encoding=encoding, shape=shape)
+        if keepends:
+            for r, sep in zip(results, seps):
+                yield r + sep if sep else r
+        else:
+            yield from results
+        del texts[:], seps[:], results
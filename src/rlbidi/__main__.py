@@ -0,0 +1,150 @@
+"""reorder text files or stdin visually from the command line.
+
+    python -m rlbidi [options] [FILE ...] [-o OUT]
+
+Each line, without its line ending, is reordered as log2vis would do it.
+With --csv the input is read as CSV and only the cells of the chosen
+--columns are reordered. The input is read in batches of --batch-lines
+lines or rows; with --jobs N the batches are reordered by N worker
+processes with at most 2*N batches in flight, and the results are
+written in the input order. Throughput statistics go to stderr at the
+end unless --quiet is given.
+"""
+import sys, io, csv, time
+from collections import deque
+import rlbidi
+
+def _reorderLines(lines, kw):
+    '''reorder each line keeping its line ending'''
+    bodies = [l.rstrip('\r\n') for l in lines]
+    visual = rlbidi.log2vis_many(bodies, **kw)
+    return [v + l[len(b):] for v, b, l in zip(visual, bodies, lines)]
+
+def _reorderRows(rows, columns, kw):
+    '''reorder the cells in columns (all if None) of each csv row'''
+    cells = [(r, c) for r, row in enumerate(rows) for c in (range(len(row)) if columns is None else columns)
+                if c < len(row)]
+    visual = rlbidi.log2vis_many([rows[r][c] for r, c in cells], **kw)
+    for (r, c), v in zip(cells, visual):
+        rows[r][c] = v
+    return rows
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch: yield batch
+
+def _columns(spec, header):
+    '''the 0 based indexes of a comma separated list of 1 based numbers or header names'''
+    columns = []
+    for c in spec.split(','):
+        c = c.strip()
+        if c.isdigit() and int(c) > 0:
+            columns.append(int(c) - 1)
+        elif header is not None and c in header:
+            columns.append(header.index(c))
+        else:
+            raise ValueError(f'column {c!r} is not a number from 1 or a header name')
+    return columns
+
+def _open(path, encoding, errors, write=False):
+    if path == '-':
+        stream = sys.stdout.buffer if write else sys.stdin.buffer
+        return io.TextIOWrapper(stream, encoding=encoding, errors=errors, newline='', write_through=write)
+    return open(path, 'w' if write else 'r', encoding=encoding, errors=errors, newline='')
+
+def _close(f, path):
+    '''close f but leave stdin and stdout open'''
+    if path == '-':
+        f.flush()
+        f.detach()
+    else:
+        f.close()
+
+def main(argv=None):
+    import argparse
+    P = argparse.ArgumentParser(prog='python -m rlbidi', description='reorder text visually with rlbidi')
+    P.add_argument('files', nargs='*', default=['-'], metavar='FILE', help='input files, - for stdin (the default)')
+    P.add_argument('-o', '--output', default='-', metavar='OUT', help='output file, - for stdout (the default)')
+    P.add_argument('-e', '--encoding', default='utf-8',
+                    help='input encoding, eg utf-8, utf-16, cp1255 or iso8859-8 (default %(default)s)')
+    P.add_argument('--output-encoding', help='output encoding (default the input encoding)')
+    P.add_argument('--errors', default='strict', help='codec error handling (default %(default)s)')
+    P.add_argument('-d', '--base-direction', default='RTL', type=str.upper, choices=sorted(rlbidi.bidiDirMap),
+                    help='paragraph base direction (default %(default)s)')
+    P.add_argument('--no-clean', dest='clean', action='store_false', help='keep the bidi marks')
+    P.add_argument('--no-reordernsm', dest='reordernsm', action='store_false', help='do not reorder non spacing marks')
+    P.add_argument('--no-shape', dest='shape', action='store_false', help='neither mirror nor shape arabic')
+    P.add_argument('--csv', action='store_true', help='read and write CSV')
+    P.add_argument('-c', '--columns', help='with --csv the columns to reorder, 1 based numbers or header names'
+                    ' separated by commas (default all)')
+    P.add_argument('--header', action='store_true', help='with --csv copy the first row unchanged')
+    P.add_argument('--delimiter', default=',', help='with --csv the field delimiter (default %(default)r)')
+    P.add_argument('-j', '--jobs', type=int, default=1, help='worker processes (default %(default)s)')
+    P.add_argument('-b', '--batch-lines', type=int, default=2000,
+                    help='lines or rows in a batch (default %(default)s)')
+    P.add_argument('-q', '--quiet', action='store_true', help='do not print the statistics')
+    args = P.parse_args(argv)
+    if args.jobs < 1 or args.batch_lines < 1:
+        P.error('--jobs and --batch-lines must be at least 1')
+    if (args.columns or args.header) and not args.csv:
+        P.error('--columns and --header need --csv')
+
+    kw = dict(base_direction=rlbidi.bidiDirMap[args.base_direction], clean=args.clean,
+                reordernsm=args.reordernsm, shape=args.shape)
+    pool = None
+    if args.jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(args.jobs)
+    nlines = nchars = 0
+    t0 = time.perf_counter()
+    try:
+        out = _open(args.output, args.output_encoding or args.encoding, args.errors, write=True)
+        try:
+            writer = csv.writer(out, delimiter=args.delimiter, lineterminator='\n') if args.csv else None
+            for path in args.files:
+                f = _open(path, args.encoding, args.errors)
+                try:
+                    if args.csv:
+                        items = csv.reader(f, delimiter=args.delimiter)
+                        header = next(items, None) if args.header else None
+                        columns = _columns(args.columns, header) if args.columns else None
+                        if header is not None: writer.writerow(header)
+                        fn, extra, write = _reorderRows, (columns,), writer.writerows
+                    else:
+                        items = f
+                        fn, extra, write = _reorderLines, (), out.writelines
+                    pending = deque()
+                    for batch in _batches(items, args.batch_lines):
+                        nlines += len(batch)
+                        nchars += sum(map(len, batch)) if not args.csv else sum(len(c) for r in batch for c in r)
+                        if pool is None:
+                            write(fn(batch, *extra, kw))
+                            continue
+                        pending.append(pool.submit(fn, batch, *extra, kw))
+                        if len(pending) >= 2*args.jobs:
+                            write(pending.popleft().result())
+                    while pending:
+                        write(pending.popleft().result())
+                finally:
+                    _close(f, path)
+        finally:
+            _close(out, args.output)
+    except (OSError, ValueError, csv.Error) as e:
+        print(f'python -m rlbidi: {e}', file=sys.stderr)
+        return 1
+    finally:
+        if pool is not None: pool.shutdown()
+    t = time.perf_counter() - t0
+    if not args.quiet:
+        unit = 'rows' if args.csv else 'lines'
+        print('%d %s, %d chars in %.3f s: %.0f chars/s, %.0f %s/s with %d jobs' % (nlines, unit, nchars, t,
+                nchars/t if t else 0, nlines/t if t else 0, unit, args.jobs), file=sys.stderr)
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""asyncio interface to rlbidi.
+
+    from rlbidi import aio
+    visual = await aio.log2vis(text)
+    lines = await aio.log2vis_many(lines)
+
+Inputs shorter than inline_chars are reordered inline, since handing them
+to an executor costs more than the work. Longer ones are run in an
+executor; log2vis_many groups its lines into chunks of about chunk_chars
+characters, keeps at most max_in_flight chunks submitted at a time and
+returns the results in order. The module variables below are the defaults
+and each can be given per call too.
+
+rlbidi releases the GIL for strings of 256 or more characters, so the
+default thread executor of the event loop does run chunks in parallel.
+A concurrent.futures.ProcessPoolExecutor may be used as well.
+"""
+import os, asyncio, functools
+import rlbidi
+from . import RTL, _baseDirection
+
+__all__ = ('log2vis', 'log2vis_many')
+
+executor = None         # None for the event loop's default executor
+inline_chars = 4096     # inputs with fewer characters are reordered inline
+chunk_chars = 65536     # log2vis_many chunks hold about this many characters
+max_in_flight = None    # chunks submitted at once; None for os.cpu_count()
+
+def _default(value, name):
+    '''value or, when it is None, the module default called name'''
+    return globals()[name] if value is None else value
+
+def _chunks(lines, size):
+    '''split lines into consecutive lists of about size characters'''
+    chunk = []
+    n = 0
+    for line in lines:
+        if chunk and n + len(line) > size:
+            yield chunk
+            chunk = []
+            n = 0
+        chunk.append(line)
+        n += len(line)
+    if chunk: yield chunk
+
+async def log2vis(logical, base_direction=RTL, encoding="utf-8", clean=True, reordernsm=True, shape=True,
+                    executor=None, inline_chars=None):
+    """
+    Return rlbidi.log2vis(logical, ...) without blocking the event loop
+    when logical has at least inline_chars characters.
+
+    Arguments:
+    - logical, base_direction, encoding, clean, reordernsm & shape: as
+      for rlbidi.log2vis
+    - executor, inline_chars: override the module defaults
+    """
+    fn = functools.partial(rlbidi.log2vis, logical, _baseDirection(base_direction), encoding=encoding,
+                            clean=clean, reordernsm=reordernsm, shape=shape)
+    if len(logical) < _default(inline_chars, 'inline_chars'):
+        return fn()
+    return await asyncio.get_running_loop().run_in_executor(_default(executor, 'executor'), fn)
+
+async def log2vis_many(lines, base_direction=RTL, encoding="utf-8", clean=True, reordernsm=True, shape=True,
+                        maps=False, executor=None, inline_chars=None, chunk_chars=None, max_in_flight=None):
+    """
+    Return rlbidi.log2vis_many(lines, ...) without blocking the event
+    loop when the lines hold at least inline_chars characters in all.
+
+    Arguments:
+    - lines: iterable of str or encoded bytes
+    - base_direction, encoding, clean, reordernsm, shape & maps: as for
+      rlbidi.log2vis_many
+    - executor, inline_chars, chunk_chars, max_in_flight: override the
+      module defaults
+    """
+    lines = list(lines)
+    fn = functools.partial(rlbidi.log2vis_many, base_direction=_baseDirection(base_direction), encoding=encoding,
+                            clean=clean, reordernsm=reordernsm, shape=shape, maps=maps)
+    if sum(map(len, lines)) < _default(inline_chars, 'inline_chars'):
+        return fn(lines)
+    executor = _default(executor, 'executor')
+    max_in_flight = _default(max_in_flight, 'max_in_flight') or os.cpu_count() or 1
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(max_in_flight)
+    futures = []
+    try:
+        for chunk in _chunks(lines, _default(chunk_chars, 'chunk_chars')):
+            await slots.acquire()
+            f = loop.run_in_executor(executor, fn, chunk)
+            f.add_done_callback(lambda f: slots.release())
+            futures.append(f)
+        results = []
+        for f in futures:
+            results.extend(await f)
+        return results
+    except BaseException:
+        for f in futures: f.cancel()
+        raise
@@ -0,0 +1,288 @@
+"""benchmarks for rlbidi.
+
+Run with
+
+    python -m rlbidi.bench [-k filter] [--json results.json] [--baseline old.json]
+
+Each case reorders one kind of text in one way; it is timed in a number
+of samples and the per call latency percentiles and the characters
+reordered per second are reported. The results can be written as JSON
+and a JSON file from an earlier run can be used as a baseline; any case
+whose median latency is worse than the baseline by more than the
+tolerance is reported as a regression and the exit status is 1.
+"""
+import sys, os, json, time, platform
+from array import array
+import rlbidi
+
+__all__ = ('Case', 'cases', 'run', 'compare', 'main')
+
+_HEB = u'שלום'        # shalom
+_ARA = u'سلام'        # salam
+_TEXTS = dict(
+    ltr = u'The quick brown fox, 42 jumps. ',
+    rtl = u'%s %s, \u05d7\u05b7 %s. ' % (_HEB, _HEB[::-1], _HEB),
+    mixed = u'Total %s 1,234.50 (%s) - %s 42%%. ' % (_HEB, _ARA, _HEB),
+    )
+_SIZES = dict(short=1, long=64)
+
+class Case:
+    '''a benchmark case; fn() does one call which reorders chars characters
+    and close(), if given, frees anything fn kept after the case is timed'''
+    def __init__(self, name, fn, chars, group, close=None):
+        self.name = name
+        self.fn = fn
+        self.chars = chars
+        self.group = group
+        self.close = close
+
+def _log2visCase(name, text, group='log2vis', **kw):
+    encoding = kw.get('encoding')
+    logical = text.encode(encoding) if encoding else text
+    outputs = kw.pop('outputs', None)
+    if outputs=='lists':
+        kw.update(positions_L_to_V=[], positions_V_to_L=[], embedding_levels=[])
+    elif outputs=='buffers':
+        n = len(text)
+        kw.update(positions_L_to_V=array('i', bytes(4*n)), positions_V_to_L=array('i', bytes(4*n)),
+                    embedding_levels=bytearray(n))
+    log2vis = rlbidi.log2vis
+    return Case(name, lambda: log2vis(logical, **kw), len(text), group)
+
+def _threadsCase(nthreads, text, calls=8):
+    '''calls reorderings of text shared among nthreads threads'''
+    log2vis = rlbidi.log2vis
+    pool = []
+    def work(n):
+        for i in range(n):
+            log2vis(text)
+    def fn():
+        if not pool:
+            from concurrent.futures import ThreadPoolExecutor
+            pool.append(ThreadPoolExecutor(nthreads))
+        list(pool[0].map(work, counts))
+    def close():
+        while pool: pool.pop().shutdown()
+    counts = [calls//nthreads + (i < calls%nthreads) for i in range(nthreads)]
+    return Case('threads-%d' % nthreads, fn, calls*len(text), 'threads', close)
+
+def _parallelCase(workers, texts):
+    '''rlbidi.parallel.reorder_corpus of texts with a pool of workers processes'''
+    from rlbidi.parallel import reorder_corpus
+    pool = []
+    def fn():
+        if workers > 1 and not pool:
+            from concurrent.futures import ProcessPoolExecutor
+            pool.append(ProcessPoolExecutor(workers))
+        reorder_corpus(texts, workers, executor=pool[0] if pool else None)
+    def close():
+        while pool: pool.pop().shutdown()
+    return Case('parallel-%d' % workers, fn, sum(map(len, texts)), 'parallel', close)
+
+def cases():
+    '''return the list of benchmark cases'''
+    C = []
+    for size, n in _SIZES.items():
+        for script, text in _TEXTS.items():
+            text *= n
+            C.append(_log2visCase('%s-%s' % (size, script), text))
+            C.append(_log2visCase('%s-%s-utf8' % (size, script), text, encoding='utf-8'))
+            if script!='mixed':
+                C.append(_log2visCase('%s-%s-cp1255' % (size, script), text, encoding='cp1255'))
+            C.append(_log2visCase('%s-%s-noclean' % (size, script), text, clean=False))
+            C.append(_log2visCase('%s-%s-nonsm' % (size, script), text, reordernsm=False))
+            C.append(_log2visCase('%s-%s-noshape' % (size, script), text, shape=False))
+            C.append(_log2visCase('%s-%s-lists' % (size, script), text, outputs='lists'))
+            C.append(_log2visCase('%s-%s-buffers' % (size, script), text, outputs='buffers'))
+            C.append(_log2visCase('%s-%s-runs' % (size, script), text, runs=[]))
+
+    # one str kind each; compare limited and full API builds with these
+    for name, text in (('1byte', u'Hello - shalom, hello 123. '), ('2byte', u'Hello - %s, hello 123. ' % _HEB),
+                        ('4byte', u'Hello - %s, \U0001F600 123. ' % _HEB)):
+        C.append(_log2visCase('kind-%s' % name, text*40, group='kinds'))
+
+    # many short strings; latin-1 ones skip fribidi entirely
+    ascii_corpus = ['INV-2024-%05d' % i for i in range(100)] + ['Widget model %d' % i for i in range(100)]
+    hebrew_corpus = [u'א' + t for t in ascii_corpus]
+    log2vis_many = rlbidi.log2vis_many
+    for name, corpus in (('ascii', ascii_corpus), ('hebrew', hebrew_corpus)):
+        C.append(Case('corpus-%s' % name, lambda corpus=corpus: [rlbidi.log2vis(t) for t in corpus],
+                        sum(map(len, corpus)), 'corpus'))
+        C.append(Case('corpus-%s-many' % name, lambda corpus=corpus: log2vis_many(corpus),
+                        sum(map(len, corpus)), 'corpus'))
+
+    # classifying the corpora without reordering
+    for name, corpus in (('ascii', ascii_corpus), ('hebrew', hebrew_corpus)):
+        C.append(Case('corpus-%s-has_rtl' % name, lambda corpus=corpus: rlbidi.has_rtl(corpus),
+                        sum(map(len, corpus)), 'corpus'))
+        C.append(Case('corpus-%s-par_direction' % name, lambda corpus=corpus: rlbidi.par_direction(corpus),
+                        sum(map(len, corpus)), 'corpus'))
+
+    # the same corpora as flat codepoint and offset buffers
+    for name, corpus in (('ascii', ascii_corpus), ('hebrew', hebrew_corpus)):
+        cps = array('I', [ord(c) for t in corpus for c in t])
+        offsets = array('q', [0])
+        for t in corpus: offsets.append(offsets[-1] + len(t))
+        n = len(cps)
+        visual, positions, levels = array('I', cps), array('i', [0])*n, bytearray(n)
+        C.append(Case('corpus-%s-ragged' % name, lambda cps=cps, offsets=offsets, visual=visual, positions=positions,
+                        levels=levels: rlbidi.log2vis_ragged(cps, offsets, visual, positions, embedding_levels=levels),
+                        n, 'corpus'))
+
+    # short strings through log2vis and through a Reorderer with the same options
+    reorder = rlbidi.Reorderer()
+    for script, text in _TEXTS.items():
+        C.append(_log2visCase('reorderer-%s-log2vis' % script, text, group='reorderer'))
+        C.append(Case('reorderer-%s' % script, lambda text=text: reorder(text), len(text), 'reorderer'))
+        data = text.encode('utf-8')
+        C.append(_log2visCase('reorderer-%s-utf8-log2vis' % script, text, group='reorderer', encoding='utf-8'))
+        C.append(Case('reorderer-%s-utf8' % script, lambda data=data: reorder(data), len(text), 'reorderer'))
+    C.append(Case('corpus-hebrew-reorderer', lambda: list(map(reorder, hebrew_corpus)),
+                    sum(map(len, hebrew_corpus)), 'corpus'))
+
+    # selection mapping: logical ranges to visual spans with a layout and by scanning log2vis maps
+    line = _TEXTS['mixed'] * 4
+    ranges = [(i, i + 7 + i % 23) for i in range(0, len(line) - 30, 3)]
+    layout = rlbidi.BidiLayout(line)
+    def scan():
+        L_to_V = []
+        rlbidi.log2vis(line, positions_L_to_V=L_to_V)
+        for start, end in ranges:
+            spans = []
+            for v in sorted(L_to_V[start:end]):
+                if spans and spans[-1][1]==v: spans[-1][1] = v + 1
+                else: spans.append([v, v + 1])
+    C.append(Case('layout-new', lambda: rlbidi.BidiLayout(line), len(line), 'layout'))
+    C.append(Case('layout-spans', lambda: [layout.visual_spans(start, end) for start, end in ranges], len(line), 'layout'))
+    C.append(Case('layout-spans-scan', scan, len(line), 'layout'))
+    C.append(_log2visCase('layout-log2vis-lists', line, group='layout', outputs='lists'))
+    C.append(Case('layout-log2vis_ex', lambda: rlbidi.log2vis_ex(line), len(line), 'layout'))
+    C.append(Case('layout-log2vis_ex-view', lambda: rlbidi.log2vis_ex(line).view('positions_L_to_V')[7],
+                    len(line), 'layout'))
+
+    paragraph = _TEXTS['mixed'] * 100
+    for nthreads in sorted(set([1, 2, 4, os.cpu_count() or 1])):
+        C.append(_threadsCase(nthreads, paragraph))
+
+    # a large corpus of records split among worker processes
+    records = [u'%s %s %d, %s' % (_HEB * (i % 5 + 1), _ARA, i, _TEXTS['mixed'] * (i % 3)) for i in range(20000)]
+    for workers in sorted(set([1, 2, 4, os.cpu_count() or 1])):
+        C.append(_parallelCase(workers, records))
+    return C
+
+def _percentile(values, p):
+    '''the p'th percentile of sorted values by linear interpolation'''
+    k = (len(values)-1)*p/100.0
+    i = int(k)
+    j = min(i+1, len(values)-1)
+    return values[i] + (values[j]-values[i])*(k-i)
+
+def run(cases, repeat=20, min_time=0.005, out=None):
+    '''time each case in repeat samples of at least min_time seconds and
+    return a dict of the per call statistics keyed by case name'''
+    timer = time.perf_counter
+    results = {}
+    for case in cases:
+        fn = case.fn
+        fn()
+        # calibrate the number of calls in a sample
+        number = 1
+        while True:
+            t0 = timer()
+            for i in range(number): fn()
+            t = timer() - t0
+            if t >= min_time or number >= 1<<20: break
+            number *= 2 if t*2 >= min_time else 10
+        samples = []
+        for r in range(repeat):
+            t0 = timer()
+            for i in range(number): fn()
+            samples.append((timer() - t0)/number)
+        if case.close: case.close()
+        samples.sort()
+        p50 = _percentile(samples, 50)
+        results[case.name] = res = dict(group=case.group, chars=case.chars, number=number, samples=repeat,
+                    min=samples[0], p50=p50, p90=_percentile(samples, 90), p99=_percentile(samples, 99),
+                    mean=sum(samples)/repeat, chars_per_sec=case.chars/p50 if p50 else 0.0)
+        if out:
+            out.write('%-24s %10.2f %10.2f %10.2f %10.2f usec %12.0f chars/s\n' % (case.name,
+                        1e6*res['min'], 1e6*p50, 1e6*res['p90'], 1e6*res['p99'], res['chars_per_sec']))
+            out.flush()
+    return results
+
+def compare(results, baseline, tolerance=0.1):
+    '''compare the median latency of results with those of baseline; return a
+    list of (name, old, new, ratio, status) where status is one of
+    "regression", "improvement" or "same"'''
+    rows = []
+    for name, res in results.items():
+        old = baseline.get(name)
+        if not old: continue
+        ratio = res['p50']/old['p50'] if old['p50'] else float('inf')
+        status = 'regression' if ratio > 1+tolerance else 'improvement' if ratio < 1-tolerance else 'same'
+        rows.append((name, old['p50'], res['p50'], ratio, status))
+    return rows
+
+def _environment():
+    return dict(rlbidi=rlbidi.__version__, fribidi=rlbidi.fribidiVersion,
+                fribidiUnicode=rlbidi.fribidiUnicodeVersion, limitedAPI=rlbidi.limitedAPI,
+                python=platform.python_version(), implementation=platform.python_implementation(),
+                machine=platform.machine(), system=platform.system(), cpus=os.cpu_count(),
+                time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+def main(argv=None):
+    import argparse
+    P = argparse.ArgumentParser(prog='python -m rlbidi.bench', description='benchmark rlbidi')
+    P.add_argument('-k', '--filter', action='append', default=[],
+                    help='only run cases whose name or group contains this; may be repeated')
+    P.add_argument('-l', '--list', action='store_true', help='list the cases and exit')
+    P.add_argument('-r', '--repeat', type=int, default=20, help='samples per case (default %(default)s)')
+    P.add_argument('-t', '--min-time', type=float, default=0.005,
+                    help='minimum seconds per sample (default %(default)s)')
+    P.add_argument('-j', '--json', metavar='PATH', help='write the results as JSON to PATH, - for stdout')
+    P.add_argument('-b', '--baseline', metavar='PATH', help='compare with the JSON results in PATH')
+    P.add_argument('--tolerance', type=float, default=0.1,
+                    help='fraction by which a median may exceed the baseline (default %(default)s)')
+    P.add_argument('-q', '--quiet', action='store_true', help='do not print the timings')
+    args = P.parse_args(argv)
+
+    C = cases()
+    if args.filter:
+        C = [c for c in C if any(f in c.name or f==c.group for f in args.filter)]
+    if args.list:
+        for c in C: print('%-24s %-8s %d chars' % (c.name, c.group, c.chars))
+        return 0
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    out = None if args.quiet or args.json=='-' else sys.stdout
+    if out:
+        env = _environment()
+        out.write('rlbidi %(rlbidi)s fribidi %(fribidi)s python %(python)s limitedAPI=%(limitedAPI)s\n' % env)
+        out.write('%-24s %10s %10s %10s %10s\n' % ('case', 'min', 'p50', 'p90', 'p99'))
+    results = run(C, repeat=args.repeat, min_time=args.min_time, out=out)
+
+    if args.json:
+        data = json.dumps(dict(environment=_environment(), results=results), indent=1, sort_keys=True)
+        if args.json=='-':
+            print(data)
+        else:
+            with open(args.json, 'w') as f:
+                f.write(data)
+    status = 0
+    if baseline is not None:
+        rows = compare(results, baseline, args.tolerance)
+        err = sys.stderr if args.json=='-' else sys.stdout
+        err.write('\n%-24s %10s %10s %8s\n' % ('case', 'base p50', 'p50', 'ratio'))
+        for name, old, new, ratio, s in rows:
+            err.write('%-24s %10.2f %10.2f %8.3f %s\n' % (name, 1e6*old, 1e6*new, ratio, '' if s=='same' else s))
+        regressions = [r for r in rows if r[4]=='regression']
+        if regressions:
+            err.write('%d regressions beyond tolerance %g\n' % (len(regressions), args.tolerance))
+            status = 1
+    return status
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""reorder a large corpus of texts using several processes.
+
+    from rlbidi.parallel import reorder_corpus
+    visual = reorder_corpus(texts, workers=8)
+
+The texts are packed once into a multiprocessing.shared_memory block as
+UTF-32 codepoints with an offsets array, and the workers reorder slices
+of rows with log2vis_ragged, writing the visual codepoints and any maps
+straight back into the same block; only the row ranges are pickled. The
+rows are split into chunks of about chunk_chars characters which depend
+only on the texts and chunk_chars, and the results come back in order.
+"""
+import os, sys
+from array import array
+from bisect import bisect_right
+from multiprocessing import shared_memory
+import rlbidi
+from . import RTL, _baseDirection
+
+__all__ = ('reorder_corpus',)
+
+def _layout(nrows, total, with_maps, clean):
+    '''the (offset, nbytes) of each array in the shared block'''
+    sizes = [('offsets', 8*(nrows+1)), ('codepoints', 4*total), ('visual', 4*total)]
+    if with_maps:
+        sizes += [('positions_L_to_V', 4*total), ('positions_V_to_L', 4*total), ('embedding_levels', total)]
+    if clean:
+        sizes.append(('lengths', 4*nrows))
+    layout = {}
+    pos = 0
+    for name, n in sizes:
+        layout[name] = (pos, n)
+        pos += (n + 7) & ~7
+    return layout, pos
+
+_formats = dict(offsets='q', codepoints='I', visual='I', positions_L_to_V='i', positions_V_to_L='i',
+                embedding_levels='B', lengths='i')
+
+def _views(buf, layout):
+    mv = memoryview(buf)
+    return {name: mv[pos:pos+n].cast(_formats[name]) for name, (pos, n) in layout.items()}
+
+def _reorderRows(buf, layout, row0, row1, kw):
+    '''reorder rows row0 to row1 of the arrays in buf'''
+    V = _views(buf, layout)
+    try:
+        lengths = V.get('lengths')
+        rlbidi.log2vis_ragged(V['codepoints'], V['offsets'][row0:row1+1], V['visual'],
+                    V.get('positions_L_to_V'), V.get('positions_V_to_L'), V.get('embedding_levels'),
+                    None if lengths is None else lengths[row0:row1], **kw)
+    finally:
+        for v in V.values(): v.release()
+
+def _attach(name):
+    # pool processes share the creator's resource tracker, which unlinks the block
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    return shared_memory.SharedMemory(name)
+
+def _work(name, layout, row0, row1, kw):
+    shm = _attach(name)
+    try:
+        _reorderRows(shm.buf, layout, row0, row1, kw)
+    finally:
+        shm.close()
+
+def _chunkRows(offsets, size):
+    '''split the rows into (row0, row1) ranges of about size characters'''
+    chunks = []
+    nrows = len(offsets) - 1
+    row0 = 0
+    while row0 < nrows:
+        row1 = min(nrows, max(row0 + 1, bisect_right(offsets, offsets[row0] + size) - 1))
+        chunks.append((row0, row1))
+        row0 = row1
+    return chunks
+
+def reorder_corpus(texts, workers=None, base_direction=RTL, clean=False, reordernsm=True, shape=True,
+                    with_maps=False, chunk_chars=None, executor=None):
+    """
+    Return the list of texts reordered visually according to base
+    direction, as log2vis_many(texts, ...) does, using a pool of worker
+    processes.
+
+    Arguments:
+    - texts: iterable of str
+    - workers: the number of processes, by default os.cpu_count(); with
+      one the work is done in this process
+    - base_direction, clean, reordernsm & shape: as for log2vis
+    - with_maps: if true each result is a tuple
+      (visual, positions_L_to_V, positions_V_to_L, embedding_levels)
+    - chunk_chars: the characters in a chunk of rows given to a worker,
+      by default about a quarter of each worker's share
+    - executor: an optional concurrent.futures.ProcessPoolExecutor to use
+      instead of starting one
+    """
+    texts = list(texts)
+    nrows = len(texts)
+    offsets = array('q', [0])
+    total = 0
+    for t in texts:
+        if not isinstance(t, str):
+            raise TypeError(f'reorder_corpus texts must be str not {type(t)!r}')
+        total += len(t)
+        offsets.append(total)
+    if not workers:
+        workers = getattr(executor, '_max_workers', None) or os.cpu_count() or 1
+    if chunk_chars is None:
+        chunk_chars = max(4096, -(-total // (4*workers)))
+    kw = dict(base_direction=_baseDirection(base_direction), clean=clean, reordernsm=reordernsm, shape=shape)
+    layout, size = _layout(nrows, total, with_maps, clean)
+
+    shm = None
+    if workers > 1 or executor is not None:
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        buf = shm.buf
+    else:
+        buf = bytearray(size)
+    try:
+        pos, n = layout['offsets']
+        buf[pos:pos+n] = offsets.tobytes()
+        pos, n = layout['codepoints']
+        buf[pos:pos+n] = ''.join(texts).encode('utf-32-le')
+        chunks = _chunkRows(offsets, chunk_chars)
+        if shm is None:
+            for row0, row1 in chunks:
+                _reorderRows(buf, layout, row0, row1, kw)
+        else:
+            pool = executor
+            if pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+                pool = ProcessPoolExecutor(workers)
+            try:
+                for f in [pool.submit(_work, shm.name, layout, row0, row1, kw) for row0, row1 in chunks]:
+                    f.result()
+            finally:
+                if pool is not executor: pool.shutdown()
+        return _results(buf, layout, offsets, with_maps, clean)
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+def _results(buf, layout, offsets, with_maps, clean):
+    V = _views(buf, layout)
+    try:
+        pos, n = layout['visual']
+        visual = bytes(buf[pos:pos+n]).decode('utf-32-le')
+        lengths = V['lengths'].tolist() if clean else [b - a for a, b in zip(offsets, offsets[1:])]
+        starts = offsets[:-1]
+        if not with_maps:
+            return [visual[a:a+n] for a, n in zip(starts, lengths)]
+        L_to_V, V_to_L, levels = V['positions_L_to_V'], V['positions_V_to_L'], V['embedding_levels']
+        return [(visual[a:a+n], L_to_V[a:a+n].tolist(), V_to_L[a:a+n].tolist(), levels[a:a+n].tolist())
+                for a, n in zip(starts, lengths)]
+    finally:
+        for v in V.values(): v.release()
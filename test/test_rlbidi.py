@@ -9,7 +9,7 @@ of base_dir for those tests.
 import sys
 import unittest
 import rlbidi
-from rlbidi import RTL, LTR, ON
+from rlbidi import RTL, LTR, ON, WRTL
 
 def U(b):
     return b.decode('utf8')
@@ -187,6 +187,1197 @@ class OtherEncodingsTests(unittest.TestCase):
                                            encoding=charset),
                          U(b'hello - \xd7\x9d\xd7\x95\xd7\x9c\xd7\xa9').encode(charset))
 
+class NativeBytesTests(unittest.TestCase):
+    texts = [U(b'\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d - hello 123'), 'hello, world', '',
+             U(b'(\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d) [a] 1.5%'), U(b'\xd8\xb3\xd9\x84\xd8\xa7\xd9\x85 abc')]
+
+    def check(self, text, encoding, base_direction=RTL):
+        L = []
+        try:
+            b = text.encode(encoding)
+        except UnicodeError:
+            return
+        try:
+            expected = rlbidi.log2vis(text, base_direction, positions_L_to_V=L).encode(encoding)
+        except UnicodeError:
+            # shaping can produce presentation forms the charset lacks
+            self.assertRaises(UnicodeError, rlbidi.log2vis, b, base_direction, encoding=encoding)
+            return
+        M = []
+        self.assertEqual(rlbidi.log2vis(b, base_direction, encoding=encoding, positions_L_to_V=M), expected)
+        self.assertEqual(M, L)
+
+    def testSameAsCodec(self):
+        '''native bytes: the same results as the python codecs'''
+        texts = self.texts + ['\U0001F600 ' + self.texts[0], '\xe9\u20ac ' + self.texts[0]]
+        for encoding in ('utf-8', 'utf8', 'UTF_8', 'iso8859-8', 'hebrew', 'cp1255', 'windows-1255',
+                            'iso8859-6', 'cp1256', 'latin-1', 'utf-16'):
+            for text in texts:
+                for base_direction in (RTL, LTR, ON):
+                    self.check(text, encoding, base_direction)
+        self.assertEqual(rlbidi.log2vis_many([t.encode('cp1255') for t in self.texts[:4]], encoding='cp1255'),
+                         [rlbidi.log2vis(t).encode('cp1255') for t in self.texts[:4]])
+
+    def testNoReorder(self):
+        '''native bytes: bytes which need no reordering are returned as they are'''
+        b = b'hello world 123'
+        self.assertTrue(rlbidi.log2vis(b) is b)
+        self.assertTrue(rlbidi.log2vis(b, encoding='cp1255') is b)
+        self.assertEqual(rlbidi.log2vis(bytearray(b)), b)
+
+    def testInvalid(self):
+        '''native bytes: invalid input raises the codec's error'''
+        for b in (b'\xd7', b'\xc0\x80', b'\xed\xa0\x80', b'\xf4\x90\x80\x80', b'\xe0\x80\x80', b'a\xffb', b'\xd7\xa9\xd7'):
+            self.assertRaises(UnicodeDecodeError, rlbidi.log2vis, b)
+            self.assertRaises(UnicodeDecodeError, rlbidi.log2vis_many, [b])
+        self.assertRaises(UnicodeDecodeError, rlbidi.log2vis, b'\xd7\xa9\xff', encoding='iso8859-8')
+        self.assertRaises(TypeError, rlbidi._log2vis, b'abc', encoding=None)
+
+class KindTests(unittest.TestCase):
+    heb = U(b'\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d')
+
+    def testNarrowResult(self):
+        '''kinds: results are in the narrowest kind which holds them'''
+        r = rlbidi.log2vis(self.heb * 50)
+        self.assertEqual(r, self.heb[::-1] * 50)
+        self.assertEqual(sys.getsizeof(r), sys.getsizeof(self.heb[::-1] * 50))
+        r = rlbidi.log2vis(self.heb + ' \U0001F600', LTR)
+        self.assertEqual(sys.getsizeof(r[:4]), sys.getsizeof(self.heb))
+
+    def testAllKinds(self):
+        '''kinds: 1, 2 and 4 byte kind input give the same ordering'''
+        for text in ('abc \xe9 123', 'abc \u0100 ' + self.heb, 'abc \U0001F600 ' + self.heb):
+            L = []
+            r = rlbidi.log2vis(text, LTR, positions_L_to_V=L)
+            self.assertEqual(r, rlbidi.BidiParagraph(text, 'LTR').reorder_line(clean=True))
+            self.assertEqual(len(L), len(text))
+            self.assertEqual(''.join(text[i] for i in sorted(range(len(text)), key=L.__getitem__)), r)
+        self.assertEqual(rlbidi.log2vis('\U0001F600 ' + self.heb, LTR), '\U0001F600 ' + self.heb[::-1])
+        self.assertEqual(rlbidi.log2vis_many(['\U0001F600 ' + self.heb, self.heb + '\xe9'], LTR),
+                         ['\U0001F600 ' + self.heb[::-1], self.heb[::-1] + '\xe9'])
+
+class ManyTests(unittest.TestCase):
+    '''log2vis_many must agree with log2vis'''
+    lines = [U(b'hello - \xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d'), '',
+            U(b'\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d - hello'), 'plain ascii',
+            U(b'\xd7\x97\xd6\xb7\xd7\x99\xd6\xb0\xd7\xa4\xd6\xb7\xd7\x90')*50]
+
+    def testUnicode(self):
+        '''many: str lines'''
+        for base in (RTL, LTR, ON):
+            self.assertEqual(rlbidi.log2vis_many(self.lines, base),
+                             [rlbidi.log2vis(l, base) for l in self.lines])
+
+    def testBytes(self):
+        '''many: mixed str and bytes lines keep their type'''
+        lines = [l.encode('utf8') if i%2 else l for i,l in enumerate(self.lines)]
+        self.assertEqual(rlbidi.log2vis_many(lines), [rlbidi.log2vis(l) for l in lines])
+        lines = [l.encode('cp1255') for l in self.lines]
+        self.assertEqual(rlbidi.log2vis_many(lines, encoding='cp1255'),
+                         [rlbidi.log2vis(l, encoding='cp1255') for l in lines])
+
+    def testIterable(self):
+        '''many: any iterable is accepted'''
+        self.assertEqual(rlbidi.log2vis_many(iter(self.lines), 'ON'),
+                         [rlbidi.log2vis(l, ON) for l in self.lines])
+        self.assertEqual(rlbidi.log2vis_many([]), [])
+
+    def testMaps(self):
+        '''many: maps=True gives the same maps as log2vis'''
+        for clean in (False, True):
+            for l, r in zip(self.lines, rlbidi.log2vis_many(self.lines, clean=clean, maps=True)):
+                L_to_V = []
+                V_to_L = []
+                levels = []
+                v = rlbidi.log2vis(l, clean=clean, positions_L_to_V=L_to_V, positions_V_to_L=V_to_L,
+                                   embedding_levels=levels)
+                self.assertEqual(r, (v, L_to_V, V_to_L, levels))
+
+    def testErrors(self):
+        '''many: bad items and arguments'''
+        self.assertRaises(TypeError, rlbidi.log2vis_many, ['abc', 1])
+        self.assertRaises(TypeError, rlbidi.log2vis_many, 1)
+        self.assertRaises(ValueError, rlbidi.log2vis_many, ['abc'], base_direction=1)
+        self.assertRaises(LookupError, rlbidi.log2vis_many, [b'abc'], encoding='foo')
+
+class BufferTests(unittest.TestCase):
+    '''positions and levels written to buffer protocol objects'''
+    text = U(b'hello - \xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d \xd7\x97\xd6\xb7\xd7\x99\xd6\xb0') + '\u200f123'
+
+    def lists(self, **kw):
+        L_to_V = []
+        V_to_L = []
+        levels = []
+        v = rlbidi.log2vis(self.text, positions_L_to_V=L_to_V, positions_V_to_L=V_to_L,
+                           embedding_levels=levels, **kw)
+        return v, L_to_V, V_to_L, levels
+
+    def testArrays(self):
+        '''buffers: arrays of any integer size'''
+        from array import array
+        for clean in (False, True):
+            v, L_to_V, V_to_L, levels = self.lists(clean=clean)
+            n = len(v)
+            for pcode, lcode in (('i','B'), ('q','b'), ('l','h'), ('I','i')):
+                a = array(pcode, [99])*len(self.text)
+                b = array(pcode, [99])*len(self.text)
+                c = array(lcode, [99])*len(self.text)
+                self.assertEqual(rlbidi.log2vis(self.text, clean=clean, positions_L_to_V=a, positions_V_to_L=b,
+                                                embedding_levels=c), v)
+                if pcode != 'I':
+                    self.assertEqual(a.tolist()[:n], L_to_V)
+                self.assertEqual(b.tolist()[:n], V_to_L)
+                self.assertEqual(c.tolist()[:n], levels)
+
+    def testOtherBuffers(self):
+        '''buffers: bytearray and memoryview'''
+        from array import array
+        v, L_to_V, V_to_L, levels = self.lists(clean=False)
+        m = array('i', bytes(4*len(self.text)+8))
+        b = bytearray(len(self.text))
+        self.assertEqual(rlbidi.log2vis(self.text, clean=False, positions_V_to_L=memoryview(m),
+                                        embedding_levels=b), v)
+        self.assertEqual(m.tolist()[:len(v)], V_to_L)
+        self.assertEqual(list(b), levels)
+
+    def testNumpy(self):
+        '''buffers: numpy arrays'''
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('numpy is not available')
+        v, L_to_V, V_to_L, levels = self.lists(clean=False)
+        a = numpy.zeros(len(self.text), dtype=numpy.int32)
+        b = numpy.zeros(len(self.text), dtype=numpy.int64)
+        c = numpy.zeros(len(self.text), dtype=numpy.uint8)
+        rlbidi.log2vis(self.text, clean=False, positions_L_to_V=a, positions_V_to_L=b, embedding_levels=c)
+        self.assertEqual((a.tolist(), b.tolist(), c.tolist()), (L_to_V, V_to_L, levels))
+
+    def testErrors(self):
+        '''buffers: unsuitable buffers'''
+        from array import array
+        n = len(self.text)
+        self.assertRaises(ValueError, rlbidi.log2vis, self.text, positions_L_to_V=array('i', [0])*(n-1))
+        self.assertRaises(ValueError, rlbidi.log2vis, self.text, embedding_levels=bytearray(n-1))
+        self.assertRaises(TypeError, rlbidi.log2vis, self.text, embedding_levels=bytes(n))
+        self.assertRaises(TypeError, rlbidi.log2vis, self.text, positions_V_to_L=array('d', [0])*n)
+        self.assertRaises(TypeError, rlbidi.log2vis, self.text, positions_V_to_L=(1,2))
+        self.assertRaises(OverflowError, rlbidi.log2vis, 'a'*300, positions_V_to_L=bytearray(300))
+
+class ParagraphTests(unittest.TestCase):
+    heb = U(b'\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d')
+
+    def testWholeLine(self):
+        '''paragraph: a single line agrees with log2vis'''
+        text = U(b'hello - \xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d \xd7\x97\xd6\xb7\xd7\x99\xd6\xb0 (12) ') + '\u200f!'
+        for base in (RTL, LTR, ON):
+            for reordernsm in (True, False):
+                p = rlbidi.BidiParagraph(text, base, reordernsm=reordernsm)
+                self.assertEqual(len(p), len(text))
+                self.assertEqual(p.text, text)
+                for clean in (False, True):
+                    L_to_V = []
+                    V_to_L = []
+                    levels = []
+                    v = rlbidi.log2vis(text, base, clean=clean, reordernsm=reordernsm, positions_L_to_V=L_to_V,
+                                       positions_V_to_L=V_to_L, embedding_levels=levels)
+                    self.assertEqual(p.reorder_line(clean=clean), v)
+                    self.assertEqual(p.reorder_line(0, len(text), clean=clean, maps=True), (v, L_to_V, V_to_L, levels))
+
+    def testParagraphContext(self):
+        '''paragraph: lines keep the resolved paragraph direction'''
+        text = self.heb + ' abc. def.'
+        p = rlbidi.BidiParagraph(text, 'on')
+        self.assertEqual(p.base_direction, RTL)
+        self.assertEqual(p.reorder_line(0, 5), rlbidi.log2vis(text[:5], RTL))
+        self.assertEqual(p.reorder_line(5), rlbidi.log2vis(text[5:], RTL))
+        self.assertNotEqual(p.reorder_line(5), rlbidi.log2vis(text[5:], ON))
+        self.assertEqual(rlbidi.BidiParagraph('abc', ON).base_direction, LTR)
+        self.assertEqual(rlbidi.BidiParagraph('', WRTL).base_direction, RTL)
+        self.assertEqual(rlbidi.BidiParagraph('').reorder_line(), '')
+
+    def testLevels(self):
+        '''paragraph: levels are computed for the whole paragraph'''
+        text = 'abc ' + self.heb
+        levels = []
+        rlbidi.log2vis(text, LTR, embedding_levels=levels)
+        p = rlbidi.BidiParagraph(text, LTR)
+        self.assertEqual(p.embedding_levels, levels)
+        self.assertEqual(p.max_level, 1)
+
+    def testErrors(self):
+        '''paragraph: bad arguments'''
+        self.assertRaises(TypeError, rlbidi.BidiParagraph, b'abc')
+        self.assertRaises(ValueError, rlbidi.BidiParagraph, 'abc', 1)
+        self.assertRaises(ValueError, rlbidi.BidiParagraph, 'abc', 'rll')
+        p = rlbidi.BidiParagraph('abc')
+        self.assertRaises(IndexError, p.reorder_line, 2, 1)
+        self.assertRaises(IndexError, p.reorder_line, -1)
+
+class FastPathTests(unittest.TestCase):
+    '''latin-1 text that needs no reordering skips fribidi'''
+    texts = ['', 'abc', 'hello world', 'INV-2024-00017', '12 abc', 'abc.', 'abc ', '(abc)', 'a\tb', 'a\nb',
+            'x = (1+2)*3', 'caf\xe9 cr\xe8me 12\xb3', 'soft\xadhyphen', 'abc\x07', '123', '...', ' abc',
+            'a (b) c 1', '$100 and 50%']
+
+    def testAgreesWithParagraph(self):
+        '''fast path: results agree with the full algorithm'''
+        for text in self.texts:
+            for base in (RTL, LTR, ON, WRTL, 'WLTR'):
+                for clean in (False, True):
+                    L_to_V = []
+                    V_to_L = []
+                    levels = []
+                    v = rlbidi.log2vis(text, base, clean=clean, positions_L_to_V=L_to_V, positions_V_to_L=V_to_L,
+                                       embedding_levels=levels)
+                    expected = rlbidi.BidiParagraph(text, base).reorder_line(clean=clean, maps=True)
+                    self.assertEqual((v, L_to_V, V_to_L, levels), expected, (text, base, clean))
+                    self.assertEqual(rlbidi.log2vis_many([text], base, clean=clean, maps=True), [expected])
+
+    def testIdentity(self):
+        '''fast path: the input object itself is returned'''
+        for text in ('hello world', 'INV-2024-00017', 'caf\xe9 12'):
+            self.assertTrue(rlbidi.log2vis(text) is text)
+            self.assertTrue(rlbidi.log2vis_many([text])[0] is text)
+        self.assertEqual(rlbidi.log2vis('abc.'), '.abc')
+        self.assertEqual(rlbidi.log2vis('abc.', LTR), 'abc.')
+
+class CacheTests(unittest.TestCase):
+    heb = U(b'\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d')
+
+    def setUp(self):
+        rlbidi.enable_cache(maxsize=4, max_chars=200)
+
+    def tearDown(self):
+        rlbidi.disable_cache()
+
+    def testHitsAndMisses(self):
+        '''cache: repeated calls are hits and keyed on all the options'''
+        text = 'hello - ' + self.heb
+        r = rlbidi.log2vis(text)
+        self.assertEqual(rlbidi.log2vis(text), r)
+        self.assertEqual(rlbidi.log2vis(text, 'RTL'), r)
+        self.assertEqual(rlbidi.log2vis(text, LTR), U(b'hello - \xd7\x9d\xd7\x95\xd7\x9c\xd7\xa9'))
+        self.assertEqual(rlbidi.log2vis(text.encode('utf8')), r.encode('utf8'))
+        self.assertEqual(rlbidi.log2vis(text.encode('cp1255'), encoding='cp1255'), r.encode('cp1255'))
+        info = rlbidi.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (2, 4, 4))
+        rlbidi.cache_clear()
+        self.assertEqual(rlbidi.cache_info(), rlbidi.CacheInfo(0, 0, 0, 4, 0, 200, 0))
+
+    def testEviction(self):
+        '''cache: least recently used entries are evicted by count and size'''
+        for i in range(6):
+            rlbidi.log2vis('%d %s' % (i, self.heb))
+        self.assertEqual(rlbidi.cache_info().currsize, 4)
+        rlbidi.log2vis('5 ' + self.heb)
+        self.assertEqual(rlbidi.cache_info().hits, 1)
+        rlbidi.log2vis('0 ' + self.heb)
+        self.assertEqual(rlbidi.cache_info().hits, 1)
+        rlbidi.log2vis(self.heb * 24)
+        info = rlbidi.cache_info()
+        self.assertTrue(info.currchars <= 200)
+        self.assertEqual(info.currsize, 1)
+        rlbidi.log2vis(self.heb * 30)
+        self.assertEqual(rlbidi.cache_info().currsize, 1)
+
+    def testBypass(self):
+        '''cache: calls with outputs bypass the cache'''
+        levels = []
+        rlbidi.log2vis(self.heb, embedding_levels=levels)
+        rlbidi.log2vis(self.heb, embedding_levels=levels)
+        self.assertEqual(levels, [1, 1, 1, 1])
+        info = rlbidi.cache_info()
+        self.assertEqual((info.hits, info.misses, info.bypasses, info.currsize), (0, 0, 2, 0))
+
+    def testDisabled(self):
+        '''cache: disabled cache'''
+        rlbidi.disable_cache()
+        self.assertEqual(rlbidi.cache_info(), None)
+        rlbidi.cache_clear()
+        self.assertEqual(rlbidi.log2vis(self.heb), self.heb[::-1])
+        self.assertRaises(ValueError, rlbidi.enable_cache, 0)
+
+class BenchTests(unittest.TestCase):
+
+    def testRun(self):
+        '''bench: run cases and compare them with a baseline'''
+        from rlbidi import bench
+        C = [c for c in bench.cases() if c.name in ('short-rtl', 'short-ltr-utf8', 'corpus-hebrew-many')]
+        self.assertEqual(len(C), 3)
+        res = bench.run(C, repeat=3, min_time=0.0001)
+        self.assertEqual(sorted(res), ['corpus-hebrew-many', 'short-ltr-utf8', 'short-rtl'])
+        for r in res.values():
+            self.assertTrue(0 < r['min'] <= r['p50'] <= r['p90'] <= r['p99'])
+            self.assertTrue(r['chars_per_sec'] > 0)
+        base = dict((k, dict(v, p50=v['p50']*2)) for k, v in res.items())
+        self.assertEqual(set(r[4] for r in bench.compare(res, base, 0.1)), set(['improvement']))
+        base['short-rtl']['p50'] = res['short-rtl']['p50']/2
+        self.assertEqual([r[0] for r in bench.compare(res, base, 0.1) if r[4]=='regression'], ['short-rtl'])
+
+    def testMain(self):
+        '''bench: json output and baseline exit status'''
+        import os, json, tempfile
+        from rlbidi import bench
+        fd, fn = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            args = ['-q', '-k', 'short-mixed-utf8', '-r', '2', '-t', '0.0001']
+            self.assertEqual(bench.main(args + ['--json', fn]), 0)
+            with open(fn) as f:
+                data = json.load(f)
+            self.assertEqual(list(data['results']), ['short-mixed-utf8'])
+            self.assertEqual(data['environment']['rlbidi'], rlbidi.__version__)
+            data['results']['short-mixed-utf8']['p50'] /= 1000
+            with open(fn, 'w') as f:
+                json.dump(data, f)
+            self.assertEqual(bench.main(args + ['--baseline', fn, '--tolerance', '0.5']), 1)
+        finally:
+            os.remove(fn)
+
+class StatsTests(unittest.TestCase):
+    heb = U(b'\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d')
+
+    def setUp(self):
+        rlbidi.reset_stats()
+
+    def tearDown(self):
+        rlbidi.disable_stats()
+        rlbidi.enable_arena()
+        rlbidi.reset_stats()
+
+    def testDisabled(self):
+        '''stats: nothing is counted unless enabled'''
+        rlbidi.log2vis(self.heb)
+        st = rlbidi.stats()
+        self.assertEqual((st['enabled'], st['calls'], st['chars'], st['reorder_ns']), (False, 0, 0, 0))
+
+    def testCounters(self):
+        '''stats: calls, strings, characters and phase timers'''
+        rlbidi.disable_arena()  # so that bytes_allocated counts every block
+        rlbidi.enable_stats()
+        rlbidi.log2vis(self.heb * 100, clean=True)
+        rlbidi.log2vis('plain text')
+        rlbidi.log2vis((self.heb + ' abc').encode('utf8'), embedding_levels=[])
+        rlbidi.log2vis_many([self.heb, 'abc', self.heb.encode('cp1255')], encoding='cp1255')
+        rlbidi.BidiParagraph(self.heb + ' abc').reorder_line(0, 3)
+        st = rlbidi.stats()
+        self.assertEqual(st['enabled'], True)
+        self.assertEqual(st['calls'], 5)
+        self.assertEqual(st['strings'], 7)
+        self.assertEqual(st['fast'], 2)
+        self.assertEqual(st['chars'], 400 + 10 + 8 + 4 + 3 + 4 + 3)
+        self.assertEqual(st['max_length'], 400)
+        self.assertTrue(st['bytes_allocated'] > 0)
+        for k in ('input_ns', 'reorder_ns', 'clean_ns', 'output_ns'):
+            self.assertTrue(st[k] > 0, k)
+        rlbidi.reset_stats()
+        self.assertEqual(rlbidi.stats()['calls'], 0)
+        self.assertEqual(rlbidi.stats()['enabled'], True)
+
+    def testSlowCallback(self):
+        '''stats: the slow call callback'''
+        calls = []
+        rlbidi.enable_stats(lambda *args: calls.append(args), 0)
+        rlbidi.log2vis(self.heb)
+        rlbidi.log2vis_many([self.heb, self.heb])
+        self.assertEqual([c[:2] for c in calls], [('log2vis', 4), ('log2vis_many', 8)])
+        self.assertTrue(all(c[2] >= 0 for c in calls))
+        del calls[:]
+        rlbidi.enable_stats(lambda *args: calls.append(args), 1000)
+        rlbidi.log2vis(self.heb)
+        self.assertEqual(calls, [])
+        self.assertEqual(rlbidi.stats()['slow_threshold'], 1000)
+        self.assertRaises(TypeError, rlbidi.enable_stats, 1)
+        self.assertRaises(ValueError, rlbidi.enable_stats, None, -1)
+
+    def testCallbackError(self):
+        '''stats: errors in the callback do not fail the call'''
+        def cb(*args):
+            raise RuntimeError('boom')
+        rlbidi.enable_stats(cb)
+        hook = sys.unraisablehook
+        seen = []
+        sys.unraisablehook = seen.append
+        try:
+            self.assertEqual(rlbidi.log2vis(self.heb), self.heb[::-1])
+        finally:
+            sys.unraisablehook = hook
+        self.assertEqual(len(seen), 1)
+        self.assertTrue(isinstance(seen[0].exc_value, RuntimeError))
+
+class IterTests(unittest.TestCase):
+    heb = U(b'\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d')
+
+    def paragraphs(self):
+        h = self.heb
+        return [(h + ' one', '\n'), ('two ' + h, '\r\n'), ('', '\n'), (h + ' (3)', '\r'), ('four', '\u2029'),
+                (h, '\x1c'), ('6 ' + h, '\x85'), (h + ' last', '')]
+
+    def expected(self, encoding=None, keepends=True):
+        r = [rlbidi.log2vis(p, encoding=None) + (sep if keepends else '') for p, sep in self.paragraphs()]
+        return [x.encode(encoding) for x in r] if encoding else r
+
+    def text(self):
+        return ''.join(p + sep for p, sep in self.paragraphs())
+
+    def testStr(self):
+        '''iter: paragraphs of str split anywhere'''
+        text = self.text()
+        self.assertEqual(list(rlbidi.log2vis_iter(text)), self.expected())
+        self.assertEqual(list(rlbidi.log2vis_iter(text, keepends=False)), self.expected(keepends=False))
+        for n in (1, 2, 3, 5, 7):
+            chunks = [text[i:i+n] for i in range(0, len(text), n)]
+            self.assertEqual(list(rlbidi.log2vis_iter(chunks, batch=2)), self.expected())
+        self.assertEqual(list(rlbidi.log2vis_iter('')), [])
+        self.assertEqual(list(rlbidi.log2vis_iter([])), [])
+        self.assertEqual(list(rlbidi.log2vis_iter(['abc\r'])), ['abc\r'])
+
+    def testBytes(self):
+        '''iter: encoded paragraphs split anywhere'''
+        text = self.text()
+        b = text.encode('utf8')
+        for n in (1, 3, 100):
+            chunks = [b[i:i+n] for i in range(0, len(b), n)]
+            self.assertEqual(list(rlbidi.log2vis_iter(chunks)), self.expected('utf8'))
+        paragraphs = [(p, sep.replace('\u2029', '\n').replace('\x85', '\n')) for p, sep in self.paragraphs()]
+        for encoding in ('cp1255', 'utf-16-le'):
+            b = ''.join(p + sep for p, sep in paragraphs).encode(encoding)
+            chunks = [b[i:i+3] for i in range(0, len(b), 3)]
+            expected = [(rlbidi.log2vis(p, encoding=None) + sep).encode(encoding) for p, sep in paragraphs]
+            self.assertEqual(list(rlbidi.log2vis_iter(chunks, encoding=encoding)), expected)
+
+    def testFiles(self):
+        '''iter: files, read or memory mapped'''
+        import io, os, tempfile
+        text = self.text()
+        self.assertEqual(list(rlbidi.log2vis_iter(io.StringIO(text, newline=''))), self.expected())
+        fd, fn = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(text.encode('utf8'))
+            expected = self.expected('utf8')
+            with open(fn, 'rb') as f:
+                self.assertEqual(list(rlbidi.log2vis_iter(f)), expected)
+            self.assertEqual(list(rlbidi.log2vis_iter(fn, mmap=True, batch=3)), expected)
+            with open(fn, 'rb') as f:
+                self.assertEqual(list(rlbidi.log2vis_iter(f, mmap=True)), expected)
+            self.assertRaises(ValueError, list, rlbidi.log2vis_iter(fn, mmap=True, encoding='utf-16'))
+            open(fn, 'wb').close()
+            self.assertEqual(list(rlbidi.log2vis_iter(fn, mmap=True)), [])
+        finally:
+            os.remove(fn)
+
+class RaggedTests(unittest.TestCase):
+    heb = U(b'\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d')
+
+    def rows(self):
+        h = self.heb
+        return [h + ' abc', 'plain', '', h * 3 + ' 12', '\U0001F600' + h, 'a\u200f' + h + '\u200eb']
+
+    def batch(self, rows, cptype='I', offtype='q'):
+        from array import array
+        cps = array(cptype, [ord(c) for r in rows for c in r])
+        offsets = array(offtype, [0])
+        for r in rows: offsets.append(offsets[-1] + len(r))
+        return cps, offsets
+
+    def expected(self, rows, clean=False, **kw):
+        V, L2V, V2L, levels, lengths = [], [], [], [], []
+        for r in rows:
+            l2v, v2l, lv = [], [], []
+            v = rlbidi.log2vis(r, clean=clean, positions_L_to_V=l2v, positions_V_to_L=v2l, embedding_levels=lv, **kw)
+            n = len(r) - len(v)
+            V.extend([ord(c) for c in v] + [0]*n)
+            L2V.extend(l2v)
+            V2L.extend(v2l + [-1]*n)
+            levels.extend(lv + [255]*n)
+            lengths.append(len(v))
+        return V, L2V, V2L, levels, lengths
+
+    def testArrays(self):
+        '''ragged: array buffers'''
+        from array import array
+        rows = self.rows()
+        for base_direction in (RTL, LTR, ON):
+            cps, offsets = self.batch(rows)
+            n = len(cps)
+            visual, l2v, v2l, levels, lengths = array('I', [7])*n, array('i', [7])*n, array('i', [7])*n, bytearray(n), array('H', [0])*len(rows)
+            rlbidi.log2vis_ragged(cps, offsets, visual, l2v, v2l, levels, lengths, base_direction=base_direction)
+            V, L2V, V2L, LV, LN = self.expected(rows, base_direction=base_direction)
+            self.assertEqual(list(visual), V)
+            self.assertEqual(list(l2v), L2V)
+            self.assertEqual(list(v2l), V2L)
+            self.assertEqual(list(levels), LV)
+            self.assertEqual(list(lengths), LN)
+        rows = rows[:4]
+        cps, offsets = self.batch(rows, 'H', 'i')
+        visual, levels = [], array('b', [0])*len(cps)
+        rlbidi.log2vis_ragged(cps, offsets, visual, embedding_levels=levels)
+        V, L2V, V2L, LV, LN = self.expected(rows)
+        self.assertEqual((visual, list(levels)), (V, LV))
+
+    def testClean(self):
+        '''ragged: clean shortens rows'''
+        from array import array
+        rows = self.rows()
+        cps, offsets = self.batch(rows)
+        n = len(cps)
+        visual, v2l, levels, lengths = array('I', [7])*n, array('q', [7])*n, bytearray(n), []
+        rlbidi.log2vis_ragged(cps, offsets, visual, None, v2l, levels, lengths, clean=True)
+        V, L2V, V2L, LV, LN = self.expected(rows, clean=True)
+        self.assertEqual((list(visual), list(v2l), list(levels), lengths), (V, V2L, LV, LN))
+        self.assertTrue(LN[-1] < len(rows[-1]))
+        self.assertRaises(ValueError, rlbidi.log2vis_ragged, cps, offsets, visual, clean=True)
+
+    def testNumpy(self):
+        '''ragged: numpy arrays'''
+        try:
+            import numpy as np
+        except ImportError:
+            raise unittest.SkipTest('numpy is not installed')
+        rows = self.rows()
+        cps, offsets = self.batch(rows)
+        cps = np.frombuffer(cps, dtype=np.uint32)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        n = len(cps)
+        visual, l2v, levels = np.zeros(n, np.uint32), np.zeros(n, np.int32), np.zeros(n, np.uint8)
+        rlbidi.log2vis_ragged(cps, offsets, visual, l2v, embedding_levels=levels)
+        V, L2V, V2L, LV, LN = self.expected(rows)
+        self.assertEqual((visual.tolist(), l2v.tolist(), levels.tolist()), (V, L2V, LV))
+
+    def testOffsets(self):
+        '''ragged: rows before offsets[0] are left alone'''
+        from array import array
+        rows = self.rows()
+        cps, offsets = self.batch(['xyz'] + rows)
+        offsets = offsets[1:]
+        visual = array('I', [9])*len(cps)
+        rlbidi.log2vis_ragged(cps, offsets, visual)
+        self.assertEqual(list(visual[:3]), [9, 9, 9])
+        self.assertEqual(list(visual[3:]), self.expected(rows)[0])
+        visual = array('q', [9])*len(cps)
+        rlbidi.log2vis_ragged(cps, offsets, visual)
+        self.assertEqual(list(visual[:3]), [9, 9, 9])
+        self.assertEqual(list(visual[3:]), self.expected(rows)[0])
+        self.assertRaises(ValueError, rlbidi.log2vis_ragged, cps, offsets, [])
+        rlbidi.log2vis_ragged(array('I'), array('i', [0]))
+
+    def testErrors(self):
+        '''ragged: invalid arguments'''
+        from array import array
+        cps, offsets = self.batch(self.rows())
+        n = len(cps)
+        self.assertRaises(ValueError, rlbidi.log2vis_ragged, cps, array('i'))
+        self.assertRaises(ValueError, rlbidi.log2vis_ragged, cps, array('i', [0, 5, 3]))
+        self.assertRaises(ValueError, rlbidi.log2vis_ragged, cps, array('i', [0, n+1]))
+        self.assertRaises(ValueError, rlbidi.log2vis_ragged, array('i', [65, -1]), array('i', [0, 2]))
+        self.assertRaises(ValueError, rlbidi.log2vis_ragged, array('I', [0x110000]), array('i', [0, 1]))
+        self.assertRaises(TypeError, rlbidi.log2vis_ragged, array('d', [1.0]), array('i', [0, 1]))
+        self.assertRaises(TypeError, rlbidi.log2vis_ragged, 'abc', array('i', [0, 1]))
+        self.assertRaises(ValueError, rlbidi.log2vis_ragged, cps, offsets, array('I', [0])*(n-1))
+        self.assertRaises(OverflowError, rlbidi.log2vis_ragged, cps, offsets, array('B', [0])*n)
+        self.assertRaises(TypeError, rlbidi.log2vis_ragged, cps, offsets, bytes(4*n))
+
+class ShapeTests(unittest.TestCase):
+    ara = U(b'\xd8\xb3\xd9\x84\xd9\x85')     # seen lam meem
+    heb = U(b'\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d')
+
+    def testArabic(self):
+        '''shape: arabic presentation forms only when asked for'''
+        forms = '\ufee2\ufee0\ufeb3'
+        self.assertEqual(rlbidi.log2vis(self.ara), forms)
+        self.assertEqual(rlbidi.log2vis(self.ara, shape=rlbidi.SHAPE_ARAB_PRES), forms)
+        self.assertEqual(rlbidi.log2vis(self.ara, shape=False), self.ara[::-1])
+        self.assertEqual(rlbidi.log2vis(self.ara, shape=rlbidi.SHAPE_MIRRORING), self.ara[::-1])
+        # unshaped arabic survives a charset without presentation forms
+        b = self.ara.encode('cp1256')
+        self.assertEqual(rlbidi.log2vis(b, encoding='cp1256', shape=False), b[::-1])
+
+    def testMirroring(self):
+        '''shape: mirroring of brackets in RTL runs'''
+        text = '(%s)' % self.heb
+        self.assertEqual(rlbidi.log2vis(text), '(%s)' % self.heb[::-1])
+        self.assertEqual(rlbidi.log2vis(text, shape=rlbidi.SHAPE_ARABIC), ')%s(' % self.heb[::-1])
+        self.assertEqual(rlbidi.log2vis(text, shape=False), ')%s(' % self.heb[::-1])
+
+    def testMaps(self):
+        '''shape: shaping does not change the reordering'''
+        text = '(%s) %s abc' % (self.heb, self.ara)
+        maps = []
+        for shape in (True, False, rlbidi.SHAPE_MIRRORING, rlbidi.SHAPE_ARABIC):
+            L, V, E = [], [], []
+            rlbidi.log2vis(text, positions_L_to_V=L, positions_V_to_L=V, embedding_levels=E, shape=shape)
+            maps.append((L, V, E))
+        for m in maps[1:]:
+            self.assertEqual(m, maps[0])
+
+    def testOtherFunctions(self):
+        '''shape: log2vis_many, log2vis_iter, log2vis_ragged and BidiParagraph agree with log2vis'''
+        from array import array
+        texts = ['(%s) %s' % (self.heb, self.ara), self.ara + ' abc']
+        for shape in (True, False, rlbidi.SHAPE_MIRRORING):
+            expected = [rlbidi.log2vis(t, shape=shape) for t in texts]
+            self.assertEqual(rlbidi.log2vis_many(texts, shape=shape), expected)
+            self.assertEqual(list(rlbidi.log2vis_iter(texts[0] + '\n' + texts[1], shape=shape, keepends=False)),
+                             expected)
+            for t, e in zip(texts, expected):
+                self.assertEqual(rlbidi.BidiParagraph(t, shape=shape).reorder_line(), e)
+                cps = array('I', [ord(c) for c in t])
+                visual = array('I', cps)
+                rlbidi.log2vis_ragged(cps, array('q', [0, len(t)]), visual, shape=shape)
+                self.assertEqual(''.join(map(chr, visual)), e)
+
+    def testCache(self):
+        '''shape: cached results depend on shape'''
+        rlbidi.enable_cache()
+        try:
+            self.assertEqual(rlbidi.log2vis(self.ara), '\ufee2\ufee0\ufeb3')
+            self.assertEqual(rlbidi.log2vis(self.ara, shape=False), self.ara[::-1])
+            self.assertEqual(rlbidi.log2vis(self.ara, shape=rlbidi.SHAPE_MIRRORING), self.ara[::-1])
+            self.assertEqual(rlbidi.log2vis(self.ara, shape=True), '\ufee2\ufee0\ufeb3')
+        finally:
+            rlbidi.disable_cache()
+
+    def testInvalid(self):
+        '''shape: invalid values raise errors'''
+        self.assertRaises(ValueError, rlbidi.log2vis, self.heb, shape=0x10000)
+        self.assertRaises(ValueError, rlbidi.log2vis_many, [self.heb], shape=-1)
+        self.assertRaises(TypeError, rlbidi.log2vis, self.heb, shape='arabic')
+        self.assertRaises(TypeError, rlbidi.BidiParagraph, self.heb, shape=None)
+
+class ClassifyTests(unittest.TestCase):
+    heb = U(b'\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d')
+
+    def testHasRTL(self):
+        '''classify: has_rtl'''
+        for text in ('', 'hello', '\xe9t\xe9 123', '\u20ac 5', '\U0001F600 \u0416', '\u200e'):
+            self.assertFalse(rlbidi.has_rtl(text), ascii(text))
+        for text in (self.heb, 'abc ' + self.heb, '\u0661\u0662', '\U0001F600' + self.heb, 'a\u200fb', 'a\u202eb'):
+            self.assertTrue(rlbidi.has_rtl(text), ascii(text))
+        texts = ['abc', self.heb, '', 'x\u05d0']
+        self.assertEqual(rlbidi.has_rtl(texts), [False, True, False, True])
+        self.assertEqual(rlbidi.has_rtl(iter(texts)), [False, True, False, True])
+        self.assertEqual(rlbidi.has_rtl([]), [])
+
+    def testHasRTLAgreesWithLog2vis(self):
+        '''classify: text without RTL is not reordered in an LTR paragraph'''
+        for text in ('hello (world) 1.5%', '\u0416\u0437 [\xe9]', 'a \U0001F600 b'):
+            self.assertFalse(rlbidi.has_rtl(text))
+            self.assertEqual(rlbidi.log2vis(text, LTR), text)
+
+    def testBidiTypes(self):
+        '''classify: bidi_types'''
+        names = rlbidi.BIDI_TYPE_NAMES
+        t = rlbidi.bidi_types('a1 (' + self.heb[0] + ')\u0661\u202b\u2067\u2069\u0628')
+        self.assertTrue(isinstance(t, bytes))
+        self.assertEqual([names[c] for c in t], ['L', 'EN', 'WS', 'ON', 'R', 'ON', 'AN', 'RLE', 'RLI', 'PDI', 'AL'])
+        self.assertEqual([names[c] for c in rlbidi.bidi_types('\t\n\u05b7\xad,+$')], ['S', 'B', 'NSM', 'BN', 'CS', 'ES', 'ET'])
+        self.assertEqual(rlbidi.bidi_types(''), b'')
+        self.assertEqual(rlbidi.bidi_types(['ab', self.heb]), [b'\0\0', b'\1'*4])
+        self.assertEqual(len(names), len(set(names)))
+
+    def testParDirection(self):
+        '''classify: par_direction'''
+        self.assertEqual(rlbidi.par_direction('hello ' + self.heb), LTR)
+        self.assertEqual(rlbidi.par_direction('123 ' + self.heb + ' hello'), RTL)
+        self.assertEqual(rlbidi.par_direction('123 ...'), ON)
+        self.assertEqual(rlbidi.par_direction(''), ON)
+        self.assertEqual(rlbidi.par_direction('\xe9'), LTR)
+        # characters in isolates are skipped
+        self.assertEqual(rlbidi.par_direction('\u2066abc\u2069 ' + self.heb), RTL)
+        texts = ['abc', self.heb, '42', '\u20ac \u0628']
+        self.assertEqual(rlbidi.par_direction(texts), [LTR, RTL, ON, RTL])
+        for text in texts:
+            L = []
+            rlbidi.log2vis(text, ON, embedding_levels=L)
+            if text!='42':
+                self.assertEqual(L[0] & 1, rlbidi.par_direction(text)==RTL)
+
+    def testInvalid(self):
+        '''classify: arguments must be str or an iterable of str'''
+        for f in (rlbidi.has_rtl, rlbidi.bidi_types, rlbidi.par_direction):
+            self.assertRaises(TypeError, f, 1)
+            self.assertRaises(TypeError, f, ['abc', b'abc'])
+            self.assertRaises(TypeError, f, [None])
+
+class RunsTests(unittest.TestCase):
+    heb = U(b'\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d')
+    marks = '\u200e\u200f\u202a\u202b\u202c\u202d\u202e\u2066\u2067\u2068\u2069'
+
+    def texts(self):
+        h = self.heb
+        return ['', 'hello', h, 'abc %s 123 def' % h, '%s (abc) 1.5%% %s' % (h, h), '\U0001F600 %s \U0001F600' % h,
+                'a\u200f%s\u202b%s\u202c e' % (h, h), '\u202eabc\u202c %s \u2067xyz\u2069' % h, '\u200f']
+
+    def check(self, text, base_direction, clean):
+        runs, levels = [], []
+        visual = rlbidi.log2vis(text, base_direction, clean=clean, shape=False, runs=runs, embedding_levels=levels)
+        logical = ''.join(c for c in text if c not in self.marks) if clean else text
+        parts = []
+        for start, end, level, vstart in runs:
+            self.assertTrue(0 <= start < end <= len(text))
+            self.assertEqual(vstart, sum(map(len, parts)))
+            seg = text[start:end]
+            if clean: seg = ''.join(c for c in seg if c not in self.marks)
+            parts.append(seg[::-1] if level & 1 else seg)
+            if not clean:
+                self.assertEqual(levels[start:end], [level]*(end-start))
+        self.assertEqual(''.join(parts), visual)
+        self.assertEqual(len(visual), len(logical))
+        # runs are maximal so neighbours differ in level or are not adjacent logically
+        for a, b in zip(runs, runs[1:]):
+            if a[2]==b[2]:
+                self.assertFalse(a[1]==b[0] if a[2]%2==0 else b[1]==a[0], (text, runs))
+
+    def testRuns(self):
+        '''runs: the runs rebuild the visual string'''
+        for text in self.texts():
+            for base_direction in (RTL, LTR, ON):
+                for clean in (False, True):
+                    self.check(text, base_direction, clean)
+
+    def testSimple(self):
+        '''runs: the runs of simple text'''
+        runs = []
+        rlbidi.log2vis('hello', LTR, runs=runs)
+        self.assertEqual(runs, [(0, 5, 0, 0)])
+        rlbidi.log2vis('abc %s' % self.heb, LTR, runs=runs)
+        self.assertEqual(runs, [(0, 4, 0, 0), (4, 8, 1, 4)])
+        rlbidi.log2vis('', runs=runs)
+        self.assertEqual(runs, [])
+        rlbidi.log2vis(b'hello', LTR, runs=runs)
+        self.assertEqual(runs, [(0, 5, 0, 0)])
+
+    def testCacheAndErrors(self):
+        '''runs: runs is filled when caching and must be a list'''
+        rlbidi.enable_cache()
+        try:
+            rlbidi.log2vis(self.heb)
+            runs = []
+            rlbidi.log2vis(self.heb, runs=runs)
+            self.assertEqual(runs, [(0, 4, 1, 0)])
+        finally:
+            rlbidi.disable_cache()
+        self.assertRaises(TypeError, rlbidi.log2vis, self.heb, runs=())
+
+class AioTests(unittest.TestCase):
+    heb = U(b'\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d')
+
+    def run_async(self, coro):
+        import asyncio
+        return asyncio.run(coro)
+
+    def lines(self):
+        return ['%s %d abc' % (self.heb * (i % 7), i) for i in range(300)]
+
+    def testLog2vis(self):
+        '''aio: log2vis inline and in an executor'''
+        from rlbidi import aio
+        for text in (self.heb + ' abc', (self.heb + ' abc ') * 2000, b'\xd7\xa9 abc'):
+            self.assertEqual(self.run_async(aio.log2vis(text)), rlbidi.log2vis(text))
+            self.assertEqual(self.run_async(aio.log2vis(text, LTR, inline_chars=0, shape=False)),
+                             rlbidi.log2vis(text, LTR, shape=False))
+
+    def testLog2visMany(self):
+        '''aio: log2vis_many gives the results in order for any chunking'''
+        from rlbidi import aio
+        lines = self.lines()
+        expected = rlbidi.log2vis_many(lines)
+        self.assertEqual(self.run_async(aio.log2vis_many(lines)), expected)
+        self.assertEqual(self.run_async(aio.log2vis_many(iter(lines), inline_chars=0, chunk_chars=50)), expected)
+        self.assertEqual(self.run_async(aio.log2vis_many(lines, inline_chars=0, chunk_chars=1, max_in_flight=1)), expected)
+        self.assertEqual(self.run_async(aio.log2vis_many([], inline_chars=0)), [])
+        self.assertEqual(self.run_async(aio.log2vis_many(lines[:5], 'LTR', inline_chars=0, maps=True)),
+                         rlbidi.log2vis_many(lines[:5], LTR, maps=True))
+
+    def testChunks(self):
+        '''aio: chunks are bounded by characters but never empty'''
+        from rlbidi.aio import _chunks
+        self.assertEqual(list(_chunks(['ab', 'c', 'de', 'fghij', 'k'], 3)), [['ab', 'c'], ['de'], ['fghij'], ['k']])
+        self.assertEqual(list(_chunks([], 3)), [])
+
+    def testInFlight(self):
+        '''aio: at most max_in_flight chunks are submitted at once'''
+        from rlbidi import aio
+        from concurrent.futures import ThreadPoolExecutor
+        import threading
+        class Executor(ThreadPoolExecutor):
+            active = peak = 0
+            lock = threading.Lock()
+            def submit(self, fn, *args):
+                def wrapped():
+                    with self.lock:
+                        self.active += 1
+                        self.peak = max(self.peak, self.active)
+                    try:
+                        return fn(*args)
+                    finally:
+                        with self.lock: self.active -= 1
+                return ThreadPoolExecutor.submit(self, wrapped)
+        lines = self.lines()
+        with Executor(4) as ex:
+            r = self.run_async(aio.log2vis_many(lines, executor=ex, inline_chars=0, chunk_chars=100, max_in_flight=2))
+        self.assertEqual(r, rlbidi.log2vis_many(lines))
+        self.assertTrue(1 <= ex.peak <= 2, ex.peak)
+
+    def testProcessExecutor(self):
+        '''aio: a process executor may be used'''
+        from rlbidi import aio
+        from concurrent.futures import ProcessPoolExecutor
+        lines = self.lines()
+        with ProcessPoolExecutor(1) as ex:
+            self.assertEqual(self.run_async(aio.log2vis_many(lines, executor=ex, inline_chars=0, chunk_chars=2000)),
+                             rlbidi.log2vis_many(lines))
+
+    def testErrors(self):
+        '''aio: errors in a chunk are raised'''
+        from rlbidi import aio
+        self.assertRaises(UnicodeError, self.run_async, aio.log2vis_many(['abc', b'\xff'], inline_chars=0, chunk_chars=1))
+        self.assertRaises(ValueError, self.run_async, aio.log2vis('abc', base_direction='up'))
+
+class ParallelTests(unittest.TestCase):
+    heb = U(b'\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d')
+
+    def texts(self):
+        h = self.heb
+        return ['%s %d abc' % (h * (i % 5), i) for i in range(500)] + ['', 'a\u200f%s\u202b%s\u202c e' % (h, h), '\U0001F600' + h]
+
+    def testInProcess(self):
+        '''parallel: one worker reorders in this process'''
+        from rlbidi.parallel import reorder_corpus
+        texts = self.texts()
+        for clean in (False, True):
+            for with_maps in (False, True):
+                self.assertEqual(reorder_corpus(texts, workers=1, clean=clean, with_maps=with_maps, chunk_chars=100),
+                                 rlbidi.log2vis_many(texts, clean=clean, maps=with_maps))
+        self.assertEqual(reorder_corpus(texts, 1, 'LTR', shape=False), rlbidi.log2vis_many(texts, LTR, clean=False, shape=False))
+        self.assertEqual(reorder_corpus([], workers=1), [])
+
+    def testProcesses(self):
+        '''parallel: worker processes give the same results in order'''
+        from rlbidi.parallel import reorder_corpus
+        from concurrent.futures import ProcessPoolExecutor
+        texts = self.texts()
+        self.assertEqual(reorder_corpus(texts, workers=2, chunk_chars=500), rlbidi.log2vis_many(texts, clean=False))
+        with ProcessPoolExecutor(2) as ex:
+            self.assertEqual(reorder_corpus(texts, executor=ex, clean=True, with_maps=True, chunk_chars=300),
+                             rlbidi.log2vis_many(texts, clean=True, maps=True))
+
+    def testChunks(self):
+        '''parallel: chunks depend only on the offsets and size'''
+        from array import array
+        from rlbidi.parallel import _chunkRows
+        self.assertEqual(_chunkRows(array('q', [0, 3, 3, 10, 11, 11, 20]), 5), [(0, 2), (2, 3), (3, 5), (5, 6)])
+        self.assertEqual(_chunkRows(array('q', [0]), 5), [])
+
+    def testErrors(self):
+        '''parallel: texts must be str'''
+        from rlbidi.parallel import reorder_corpus
+        self.assertRaises(TypeError, reorder_corpus, ['abc', b'abc'], workers=1)
+
+class ReordererTests(unittest.TestCase):
+    heb = U(b'\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d')
+
+    def texts(self):
+        h = self.heb
+        return ['', 'hello', h, 'abc %s 123 def' % h, 'a\u200f%s\u202b%s\u202c e' % (h, h), '\U0001F600 %s' % h,
+                'caf\xe9 %s' % h, (h + ' abc ') * 100]
+
+    def testSameAsLog2vis(self):
+        '''reorderer: calls give the log2vis results'''
+        for kw in (dict(), dict(base_direction=LTR), dict(base_direction='ON', clean=False),
+                    dict(reordernsm=False, shape=False), dict(encoding='cp1255', clean=False)):
+            r = rlbidi.Reorderer(**kw)
+            encoding = kw.pop('encoding', 'utf-8')
+            for text in self.texts():
+                self.assertEqual(r(text), rlbidi.log2vis(text, encoding=encoding, **kw))
+                try:
+                    data = text.encode(encoding)
+                except UnicodeError:
+                    continue
+                self.assertEqual(r(data), rlbidi.log2vis(data, encoding=encoding, **kw))
+
+    def testOptions(self):
+        '''reorderer: the options are validated once and readable'''
+        r = rlbidi.Reorderer('LTR', False, False, 'cp1256', rlbidi.SHAPE_MIRRORING)
+        self.assertEqual((r.base_direction, r.clean, r.reordernsm, r.encoding, r.shape),
+                         (LTR, False, False, 'cp1256', rlbidi.SHAPE_MIRRORING))
+        r = rlbidi.Reorderer(encoding=None)
+        self.assertEqual((r.base_direction, r.clean, r.encoding), (RTL, True, None))
+        self.assertEqual(r.shape, rlbidi.SHAPE_MIRRORING | rlbidi.SHAPE_ARABIC)
+        self.assertRaises(TypeError, r, b'abc')
+        self.assertRaises(ValueError, rlbidi.Reorderer, 'XXX')
+        self.assertRaises(LookupError, rlbidi.Reorderer, encoding='no-such-codec')
+        self.assertRaises(ValueError, rlbidi.Reorderer, shape=4)
+
+    def testCall(self):
+        '''reorderer: exactly one positional str or bytes argument'''
+        r = rlbidi.Reorderer()
+        self.assertRaises(TypeError, r)
+        self.assertRaises(TypeError, r, 'abc', RTL)
+        self.assertRaises(TypeError, r, logical='abc')
+        self.assertRaises(TypeError, r, 1)
+        self.assertRaises(TypeError, r, bytearray(b'abc'))
+        self.assertRaises(UnicodeError, r, b'\xff')
+        self.assertEqual(r('abc'), 'abc')
+
+    def testScratch(self):
+        '''reorderer: the kept buffers grow and are freed when much too big'''
+        r = rlbidi.Reorderer()
+        self.assertEqual(r.scratch_size, 0)
+        h = self.heb * 10000
+        r(h)
+        big = r.scratch_size
+        self.assertGreaterEqual(big, len(h))
+        r(self.heb)
+        self.assertEqual(r.scratch_size, big)
+        for i in range(512): r(self.heb)
+        self.assertLess(r.scratch_size, big)
+        self.assertEqual(r(h), rlbidi.log2vis(h))
+
+    def testThreads(self):
+        '''reorderer: one reorderer used from several threads'''
+        from concurrent.futures import ThreadPoolExecutor
+        r = rlbidi.Reorderer()
+        texts = [(self.heb + ' abc %d ' % i) * (i * 37 % 200 + 1) for i in range(200)]
+        with ThreadPoolExecutor(4) as ex:
+            self.assertEqual(list(ex.map(r, texts)), [rlbidi.log2vis(t) for t in texts])
+
+class LayoutTests(unittest.TestCase):
+    heb = U(b'\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d')
+    marks = '\u200e\u200f\u202a\u202b\u202c\u202d\u202e\u2066\u2067\u2068\u2069'
+
+    def texts(self):
+        h = self.heb
+        return ['', 'hello', h, 'abc %s 123 def' % h, '%s (abc) 1.5%% %s' % (h, h), '\U0001F600 %s \U0001F600' % h,
+                'a\u200f%s\u202b%s\u202c e' % (h, h), '\u202eabc\u202c %s \u2067xyz\u2069' % h, '\u200f']
+
+    def spans(self, layout, start, end):
+        '''the visual spans of [start, end) found the slow way'''
+        V = sorted(v for v in map(layout.to_visual, range(len(layout))[start:end]) if v>=0)
+        spans = []
+        for v in V:
+            if spans and spans[-1][1]==v: spans[-1] = (spans[-1][0], v+1)
+            else: spans.append((v, v+1))
+        return spans
+
+    def testMaps(self):
+        '''layout: the maps agree with log2vis'''
+        for text in self.texts():
+            for base_direction in (RTL, LTR, ON):
+                L_to_V, V_to_L, levels = [], [], []
+                visual = rlbidi.log2vis(text, base_direction, clean=False, shape=False, positions_L_to_V=L_to_V,
+                                        positions_V_to_L=V_to_L, embedding_levels=levels)
+                layout = rlbidi.BidiLayout(text, base_direction, clean=False, shape=False)
+                self.assertEqual(layout.visual, visual)
+                self.assertEqual(len(layout), len(text))
+                self.assertEqual([layout.to_visual(i) for i in range(len(text))], L_to_V)
+                self.assertEqual([layout.to_logical(j) for j in range(len(visual))], V_to_L)
+                runs = []
+                rlbidi.log2vis(text, base_direction, clean=True, shape=False, runs=runs)
+                layout = rlbidi.BidiLayout(text, base_direction, shape=False)
+                self.assertEqual(layout.visual, rlbidi.log2vis(text, base_direction, clean=True, shape=False))
+                self.assertEqual(layout.runs, runs)
+                for j, c in enumerate(layout.visual):
+                    self.assertEqual(layout.to_visual(layout.to_logical(j)), j)
+                    self.assertEqual(text[layout.to_logical(j)], c)
+                for i, c in enumerate(text):
+                    self.assertEqual(layout.to_visual(i)<0, c in self.marks)
+
+    def testSpans(self):
+        '''layout: visual_spans gives the fewest visual ranges'''
+        for text in self.texts():
+            for clean in (False, True):
+                layout = rlbidi.BidiLayout(text, clean=clean)
+                n = len(text)
+                for start in range(-1, n+1):
+                    for end in range(start, n+2):
+                        self.assertEqual(layout.visual_spans(start, end), self.spans(layout, start, end), (text, start, end))
+                self.assertEqual(layout.visual_spans(n, 0), [])
+
+    def testOptions(self):
+        '''layout: bytes, the resolved direction and bad arguments'''
+        h = self.heb
+        layout = rlbidi.BidiLayout(('abc ' + h).encode('utf-8'), ON)
+        self.assertEqual(layout.visual, rlbidi.log2vis(('abc ' + h).encode('utf-8'), ON))
+        self.assertEqual((layout.base_direction, len(layout)), (LTR, 8))
+        layout = rlbidi.BidiLayout(h.encode('cp1255'), encoding='cp1255')
+        self.assertEqual(layout.visual, h[::-1].encode('cp1255'))
+        self.assertEqual(layout.to_visual(-1), 0)
+        self.assertRaises(IndexError, layout.to_visual, 4)
+        self.assertRaises(IndexError, layout.to_logical, -5)
+        self.assertRaises(TypeError, rlbidi.BidiLayout, 1)
+        self.assertRaises(TypeError, rlbidi.BidiLayout, b'abc', encoding=None)
+        self.assertRaises(UnicodeError, rlbidi.BidiLayout, b'\xff')
+
+    def testEx(self):
+        '''layout: log2vis_ex gives the log2vis maps as lists and views'''
+        for text in self.texts():
+            for base_direction in (RTL, 'LTR', ON):
+                L_to_V, V_to_L, levels = [], [], []
+                visual = rlbidi.log2vis(text, base_direction, clean=False, positions_L_to_V=L_to_V,
+                                        positions_V_to_L=V_to_L, embedding_levels=levels)
+                r = rlbidi.log2vis_ex(text, base_direction, clean=False)
+                self.assertEqual((r.visual, r.positions_L_to_V, r.positions_V_to_L, r.embedding_levels),
+                                 (visual, L_to_V, V_to_L, levels))
+                for name, fmt in (('positions_L_to_V', 'i'), ('positions_V_to_L', 'i'), ('embedding_levels', 'b')):
+                    v = r.view(name)
+                    self.assertEqual((v.format, v.readonly), (fmt, True))
+                    self.assertEqual(v.tolist(), getattr(r, name))
+                self.assertIsNot(r.positions_L_to_V, r.positions_L_to_V)
+                r = rlbidi.log2vis_ex(text, base_direction)
+                self.assertEqual(r.visual, rlbidi.log2vis(text, base_direction))
+                self.assertEqual(len(r.embedding_levels), len(text))
+                self.assertEqual(len(r.positions_V_to_L), len(r.visual))
+        self.assertEqual(rlbidi.log2vis_ex(self.heb + ' abc', ON).base_direction, RTL)
+        self.assertEqual(rlbidi.log2vis_ex('abc ' + self.heb, ON).base_direction, LTR)
+        self.assertRaises(ValueError, rlbidi.log2vis_ex('abc').view, 'levels')
+
+class MainTests(unittest.TestCase):
+    heb = U(b'\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d')
+
+    def setUp(self):
+        import tempfile
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def path(self, name):
+        import os
+        return os.path.join(self.dir.name, name)
+
+    def run_main(self, text, *args, encoding='utf-8', output_encoding=None):
+        from rlbidi.__main__ import main
+        src, out = self.path('in.txt'), self.path('out.txt')
+        with open(src, 'w', encoding=encoding, newline='') as f:
+            f.write(text)
+        self.assertEqual(main(['-q', '-e', encoding, '-o', out, src] + list(args)), 0)
+        with open(out, encoding=output_encoding or encoding, newline='') as f:
+            return f.read()
+
+    def testLines(self):
+        '''main: lines are reordered keeping their endings'''
+        h = self.heb
+        lines = ['abc %s 123\r\n' % h, '\n', '%s \u200f(x)\n' % h, 'last %s' % h]
+        expected = ''.join(rlbidi.log2vis(l.rstrip('\r\n')) + l[len(l.rstrip('\r\n')):] for l in lines)
+        self.assertEqual(self.run_main(''.join(lines)), expected)
+        self.assertEqual(self.run_main(''.join(lines), '-j', '2', '-b', '1'), expected)
+        self.assertEqual(self.run_main(''.join(lines), encoding='utf-16'), expected)
+        self.assertEqual(self.run_main('abc %s\n' % h, '--output-encoding', 'cp1255', output_encoding='cp1255'),
+                         rlbidi.log2vis('abc %s' % h) + '\n')
+        self.assertEqual(self.run_main('abc %s (x)\n' % h, '-d', 'ltr', '--no-clean', '--no-shape'),
+                         rlbidi.log2vis('abc %s (x)' % h, LTR, clean=False, shape=False) + '\n')
+
+    def testCSV(self):
+        '''main: only the chosen csv columns are reordered'''
+        h = self.heb
+        text = 'id,name,note\r\n1,"%s, x",%s 2\r\n2,"a\nb %s",\r\n' % (h, h, h)
+        self.assertEqual(self.run_main(text, '--csv', '--header', '-c', 'name'),
+                         'id,name,note\n1,"%s",%s 2\n2,"%s",\n' % (rlbidi.log2vis('%s, x' % h), h, rlbidi.log2vis('a\nb %s' % h)))
+        self.assertEqual(self.run_main(text, '--csv', '-c', '3', '-j', '2', '-b', '1'),
+                         'id,name,note\n1,"%s, x",%s\n2,"a\nb %s",\n' % (h, rlbidi.log2vis('%s 2' % h), h))
+
+    def testErrors(self):
+        '''main: bad columns, files and encodings are reported'''
+        from rlbidi.__main__ import main
+        import contextlib, io
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            self.assertEqual(main(['-o', self.path('out'), self.path('missing')]), 1)
+            with open(self.path('in'), 'wb') as f: f.write(b'a,b\n\xff\n')
+            self.assertEqual(main(['-o', self.path('out'), '--csv', '--header', '-c', 'c', self.path('in')]), 1)
+            self.assertEqual(main(['-o', self.path('out'), self.path('in')]), 1)
+        self.assertEqual(len(err.getvalue().splitlines()), 3)
+
+    def testStdin(self):
+        '''main: python -m rlbidi filters stdin to stdout'''
+        import subprocess, os
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        r = subprocess.run([sys.executable, '-m', 'rlbidi'], input=('abc %s\n' % self.heb).encode('utf-8'),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, check=True)
+        self.assertEqual(r.stdout.decode('utf-8'), rlbidi.log2vis('abc %s' % self.heb) + '\n')
+        self.assertIn(b'chars/s', r.stderr)
+
+class ArenaTests(unittest.TestCase):
+    heb = U(b'\xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d')
+
+    def tearDown(self):
+        rlbidi.enable_arena()
+        rlbidi.reset_stats()
+
+    def testReuse(self):
+        '''arena: short strings use the stack and longer ones reuse blocks'''
+        short, medium = 'abc %s' % self.heb, ('abc %s ' % self.heb) * 50
+        rlbidi.enable_arena()
+        rlbidi.log2vis(medium)
+        rlbidi.reset_stats()
+        for i in range(10):
+            self.assertEqual(rlbidi.log2vis(short), self.heb[::-1] + ' abc')
+            rlbidi.log2vis(medium)
+        a = rlbidi.arena_stats()
+        self.assertEqual((a['stack'], a['reuses'], a['allocations'], a['reuse_rate']), (10, 10, 0, 1.0))
+        self.assertTrue(a['enabled'])
+        self.assertGreaterEqual(a['blocks'], 1)
+        self.assertGreater(a['bytes'], 0)
+
+    def testDisabled(self):
+        '''arena: when disabled every call allocates'''
+        rlbidi.disable_arena()
+        a = rlbidi.arena_stats()
+        self.assertEqual((a['enabled'], a['blocks'], a['bytes']), (False, 0, 0))
+        rlbidi.reset_stats()
+        for i in range(5):
+            rlbidi.log2vis('abc %s' % self.heb)
+        self.assertEqual(rlbidi.arena_stats()['allocations'], 5)
+
+    def testHighWater(self):
+        '''arena: a block much bigger than recent strings is freed'''
+        rlbidi.enable_arena()
+        rlbidi.log2vis(self.heb * 100000)
+        self.assertGreater(rlbidi.arena_stats()['bytes'], 100000)
+        for i in range(600):
+            rlbidi.log2vis(self.heb * 100)
+        a = rlbidi.arena_stats()
+        self.assertLess(a['bytes'], 100000)
+        self.assertGreater(a['releases'], 0)
+        self.assertGreaterEqual(a['high_water'], 400)
+
+    def testThreads(self):
+        '''arena: threads releasing the GIL each get their own storage'''
+        from concurrent.futures import ThreadPoolExecutor
+        texts = [(self.heb + ' abc %d ' % i) * (i % 97 + 1) for i in range(300)]
+        with ThreadPoolExecutor(4) as ex:
+            self.assertEqual(list(ex.map(rlbidi.log2vis, texts)), [rlbidi.log2vis(t) for t in texts])
+        self.assertLessEqual(rlbidi.arena_stats()['blocks'], 4)
+
+class ThreadTests(unittest.TestCase):
+
+    def testThreadedStress(self):
+        '''threads: concurrent calls with mixed options agree with single threaded calls'''
+        import threading
+        nsm = U(b'\xd7\x97\xd6\xb7\xd7\x99\xd6\xb0\xd7\xa4\xd6\xb7\xd7\x90')
+        texts = [(U(b'hello - \xd7\xa9\xd7\x9c\xd7\x95\xd7\x9d ') + nsm + ' (123) ') * k for k in (1, 7, 40, 300)]
+        cases = [(t, base, clean, reordernsm) for t in texts for base in (RTL, LTR, ON)
+                    for clean in (False, True) for reordernsm in (False, True)]
+        expected = [rlbidi.log2vis(*c) for c in cases]
+        errors = []
+        def worker(k):
+            try:
+                for i in range(10):
+                    for j in range(len(cases)):
+                        j = (j+k) % len(cases)
+                        if rlbidi.log2vis(*cases[j]) != expected[j]:
+                            errors.append(cases[j])
+                    if rlbidi.log2vis_many(texts, reordernsm=k%2) != [rlbidi.log2vis(t, reordernsm=k%2) for t in texts]:
+                        errors.append(('log2vis_many', k))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker, args=(k,)) for k in range(8)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(errors, [])
+
 class Crasher(unittest.TestCase):
     def test_glibc_free_invalid_next_size(self):
         # *** glibc detected *** /home/ralf/py27/bin/python2: free(): invalid next size (fast): 0x00000000011cff00 ***
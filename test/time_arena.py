@@ -0,0 +1,36 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+time log2vis of short and medium strings with the scratch arena disabled
+and enabled and show the heap allocations per call; takes -r/-t as for
+python -m rlbidi.bench.
+"""
+import sys, argparse
+import rlbidi
+from rlbidi import bench
+
+def main(argv=None):
+    P = argparse.ArgumentParser(prog='time_arena.py', description='time the rlbidi scratch arena')
+    P.add_argument('-r', '--repeat', type=int, default=5, help='samples per case (default %(default)s)')
+    P.add_argument('-t', '--min-time', type=float, default=0.2, help='minimum seconds per sample (default %(default)s)')
+    args = P.parse_args(argv)
+    heb = u'שלום'
+    texts = dict(short=u'Total %s 12.50' % heb, medium=(u'Total %s 12.50, ' % heb) * 40)
+    print('%-12s %8s %10s %12s %10s' % ('case', 'arena', 'p50 usec', 'allocs/call', 'reuse'))
+    try:
+        for name, text in texts.items():
+            for enabled in (False, True):
+                (rlbidi.enable_arena if enabled else rlbidi.disable_arena)()
+                case = bench.Case(name, lambda text=text: rlbidi.log2vis(text), len(text), 'arena')
+                rlbidi.reset_stats()
+                r = bench.run([case], repeat=args.repeat, min_time=args.min_time)[name]
+                a = rlbidi.arena_stats()
+                calls = a['allocations'] + a['stack'] + a['reuses']
+                print('%-12s %8s %10.2f %12.4f %10.4f' % (name, 'on' if enabled else 'off', 1e6*r['p50'],
+                        a['allocations']/calls if calls else 0.0, a['reuse_rate']))
+    finally:
+        rlbidi.enable_arena()
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())
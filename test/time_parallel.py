@@ -0,0 +1,25 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+time rlbidi.parallel.reorder_corpus with 1 to N worker processes and show
+the speedup over one; takes -r/-t as for python -m rlbidi.bench.
+"""
+import sys, argparse
+from rlbidi import bench
+
+def main(argv=None):
+    P = argparse.ArgumentParser(prog='time_parallel.py', description='time rlbidi.parallel scaling')
+    P.add_argument('-r', '--repeat', type=int, default=5, help='samples per case (default %(default)s)')
+    P.add_argument('-t', '--min-time', type=float, default=0.2, help='minimum seconds per sample (default %(default)s)')
+    args = P.parse_args(argv)
+    C = [c for c in bench.cases() if c.group=='parallel']
+    results = bench.run(C, repeat=args.repeat, min_time=args.min_time)
+    one = results['parallel-1']['p50']
+    print('%-12s %10s %14s %8s' % ('workers', 'p50 msec', 'chars/s', 'speedup'))
+    for c in C:
+        r = results[c.name]
+        print('%-12s %10.1f %14.0f %8.2f' % (c.name.split('-')[1], 1e3*r['p50'], r['chars_per_sec'], one/r['p50']))
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())